@@ -0,0 +1,7 @@
+'''
+Standalone performance benchmarks. Run them from the project root, e.g.
+
+    python -m benchmarks.login_lookup --users 100000
+
+Each benchmark works on a throwaway SQLite database, never on db.sqlite3.
+'''
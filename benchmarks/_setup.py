@@ -0,0 +1,59 @@
+import os
+import tempfile
+import time
+
+
+def setup_django(db_name=None, migrate=True, **overrides):
+    '''
+    Configure Django against a scratch SQLite file and return its path.
+    '''
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'whatbytes_assignment.settings')
+    from django.conf import settings
+
+    if db_name is None:
+        handle, db_name = tempfile.mkstemp(prefix='wbytes-bench-', suffix='.sqlite3')
+        os.close(handle)
+    settings.DATABASES['default']['NAME'] = db_name
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+
+    import django
+    django.setup()
+    if migrate:
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+    return db_name
+
+
+def seed_users(count, password='benchpass123', batch_size=5000):
+    '''
+    Insert ``count`` users sharing one precomputed hash, as fast as SQLite allows.
+    '''
+    from django.contrib.auth.hashers import make_password
+    from users.models import CustomUser
+
+    encoded = make_password(password)
+    existing = CustomUser.objects.count()
+    for start in range(existing, count, batch_size):
+        CustomUser.objects.bulk_create([
+            CustomUser(email=f'user{i}@example.com', username=f'user{i}', password=encoded)
+            for i in range(start, min(start + batch_size, count))
+        ])
+    return encoded
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Timer:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
@@ -0,0 +1,107 @@
+'''
+CustomUser admin changelist at a million rows: stock ModelAdmin vs. CustomUserAdmin.
+
+    python -m benchmarks.admin_changelist --users 1000000 --repeat 5
+
+Seeds a scratch SQLite database (one user in a thousand is staff, one in a
+hundred inactive; seeding a million rows takes a few minutes), then renders
+the changelist through each admin:
+
+    stock   ModelAdmin with the same list_display/list_filter/search_fields:
+            OFFSET pages, COUNT(*) of the filtered and the whole table,
+            icontains search
+    tuned   users.admin.CustomUserAdmin: keyset pages, estimated counts,
+            prefix search over the Lower() indexes
+
+The deep page is row 500 000 (half way for the default size): ?p= for
+stock, an ?after= cursor for tuned. "(db)" is the time spent in
+cursor.execute(); the rest of the total is mostly rendering the rows.
+'''
+import argparse
+import os
+import statistics
+
+from benchmarks._setup import Timer, seed_users, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=5, help='Renders per case, the median is reported.')
+    parser.add_argument('--db', help='Reuse (or create) this SQLite file instead of a scratch one.')
+    args = parser.parse_args()
+
+    db_name = setup_django(db_name=args.db, ALLOWED_HOSTS=['*'])
+    with Timer() as seeding:
+        seed_users(args.users)
+    from django.contrib import admin
+    from django.db import connection
+    from django.test import RequestFactory
+    from users.admin import AFTER_VAR, CustomUserAdmin
+    from users.models import CustomUser
+
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE users_customuser SET is_staff = (id % 1000 = 0), is_active = (id % 100 != 0)')
+        cursor.execute('ANALYZE')
+    print(f'{CustomUser.objects.count()} users ready in {seeding.elapsed:.0f} s')
+
+    superuser = CustomUser(pk=1, username='bench', is_staff=True, is_superuser=True, is_active=True)
+    stock = admin.ModelAdmin(CustomUser, admin.site)
+    stock.list_display = CustomUserAdmin.list_display
+    stock.list_filter = CustomUserAdmin.list_filter
+    stock.search_fields = CustomUserAdmin.search_fields
+    stock.list_per_page = CustomUserAdmin.list_per_page
+    tuned = admin.site._registry[CustomUser]
+
+    deep_row = min(500_000, args.users // 2)
+    anchor = CustomUser.objects.order_by('-date_joined', '-pk')[deep_row - 1]
+    cursor = f'{anchor.date_joined.isoformat()}_{anchor.pk}'
+    needle = f'user{args.users // 3}'
+    cases = [
+        ('first page', {}, {}),
+        (f'row {deep_row}', {'p': str(deep_row // stock.list_per_page + 1)}, {AFTER_VAR: cursor}),
+        ('staff filter', {'is_staff__exact': '1'}, {'is_staff__exact': '1'}),
+        ('inactive filter', {'is_active__exact': '0'}, {'is_active__exact': '0'}),
+        (f'search {needle}', {'q': needle}, {'q': needle}),
+    ]
+
+    factory = RequestFactory()
+    db_time = [0.0]
+
+    def timed_query(execute, sql, params, many, context):
+        with Timer() as timer:
+            result = execute(sql, params, many, context)
+        db_time[0] += timer.elapsed
+        return result
+
+    def render(model_admin, params):
+        request = factory.get('/admin/users/customuser/', params)
+        request.user = superuser
+        response = model_admin.changelist_view(request)
+        response.render()
+        return response
+
+    print(f"{'case':<22}{'stock total':>12}{'(db)':>8}{'tuned total':>13}{'(db)':>8}   ms")
+    for label, stock_params, tuned_params in cases:
+        row = ''
+        for model_admin, params in ((stock, stock_params), (tuned, tuned_params)):
+            render(model_admin, params)
+            totals, queries = [], []
+            for _ in range(args.repeat):
+                db_time[0] = 0.0
+                with connection.execute_wrapper(timed_query), Timer() as timer:
+                    render(model_admin, params)
+                totals.append(timer.elapsed * 1000)
+                queries.append(db_time[0] * 1000)
+            row += f'{statistics.median(totals):>12.1f}{statistics.median(queries):>8.1f} '
+        print(f'{label:<22}{row}')
+
+    if not args.db:
+        connection.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_name + suffix):
+                os.unlink(db_name + suffix)
+
+
+if __name__ == '__main__':
+    main()
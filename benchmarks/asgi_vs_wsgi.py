@@ -0,0 +1,94 @@
+'''
+Concurrent clients against the ASGI and the WSGI request paths.
+
+    python -m benchmarks.asgi_vs_wsgi --clients 50 --requests 20
+
+Every client logs in once and then loads the dashboard and profile pages.
+The ASGI run drives Django's async handler with one coroutine per client
+on a single event loop; the WSGI run drives the sync handler with one
+thread per client, the way a threaded WSGI server would.
+'''
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks._setup import percentile, seed_users, setup_django
+
+PAGES = ('/dashboard/', '/profile/')
+
+
+def report(label, latencies, elapsed):
+    print(
+        f'{label:<6} {len(latencies) / elapsed:8.1f} req/s   '
+        f'p50 {percentile(latencies, 50) * 1000:7.1f} ms   p99 {percentile(latencies, 99) * 1000:7.1f} ms'
+    )
+
+
+async def run_asgi(clients, requests):
+    from django.test import AsyncClient
+
+    async def login(n):
+        client = AsyncClient()
+        await client.post('/', {'email_or_username': f'user{n}', 'password': 'benchpass123'})
+        return client
+
+    sessions = [await login(n) for n in range(clients)]
+    latencies = []
+
+    async def browse(client):
+        for i in range(requests):
+            started = time.perf_counter()
+            response = await client.get(PAGES[i % len(PAGES)])
+            assert response.status_code == 200, response.status_code
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(browse(client) for client in sessions))
+    return latencies, time.perf_counter() - started
+
+
+def run_wsgi(clients, requests):
+    from django.test import Client
+
+    def login(n):
+        client = Client()
+        client.post('/', {'email_or_username': f'user{n}', 'password': 'benchpass123'})
+        return client
+
+    sessions = [login(n) for n in range(clients)]
+    latencies = []
+
+    def browse(client):
+        for i in range(requests):
+            started = time.perf_counter()
+            response = client.get(PAGES[i % len(PAGES)])
+            assert response.status_code == 200, response.status_code
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        list(executor.map(browse, sessions))
+    return latencies, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=20, help='Page loads per client.')
+    args = parser.parse_args()
+
+    db_name = setup_django(
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+        ALLOWED_HOSTS=['*'],
+    )
+    seed_users(args.clients)
+    print(f'{args.clients} concurrent clients x {args.requests} page loads')
+    report('ASGI', *asyncio.run(run_asgi(args.clients, args.requests)))
+    report('WSGI', *run_wsgi(args.clients, args.requests))
+    os.unlink(db_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+'''
+Time to first response and memory of freshly forked web workers, with
+and without the warm-up of users.warmup.
+
+    python -m benchmarks.cold_start --workers 4
+
+Each mode runs in its own process, which plays a preforking server's
+master and forks --workers workers one after the other:
+
+    spawn     nothing loaded before the fork: the worker imports Django,
+              as a newly started process (or a non-preloading server) does
+    preload   wsgi.py imported in the master with WARM_UP off (gunicorn
+              --preload): the first request still loads URLs, templates,
+              validators, hashers and the database connection
+    warm      wsgi.py imported with WARM_UP on
+    frozen    warm, and gc.freeze() before forking (gunicorn.conf.py)
+
+Every worker, measured from the fork, serves the login page, the signup
+page and a signup POST with a common password (validators and a uniqueness
+query, no hashing). It then serves them --repeat more times and runs a
+full garbage collection, as a worker that has been up for a while has.
+Reported: time to the first response, time to the end of the first
+three, and per worker memory from /proc/self/smaps_rollup while all
+workers are alive: RSS, PSS (shared pages split between the processes
+sharing them) and private (pages no other process shares). Linux only.
+'''
+import argparse
+import gc
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+from benchmarks._setup import setup_django
+
+MODES = ('spawn', 'preload', 'warm', 'frozen')
+## An unmasked CSRF secret is also a valid token
+CSRF_SECRET = 'c0ld5tart' * 3 + 'bench'
+
+
+def environ(method, path, data=None):
+    body = urlencode(data or {}).encode()
+    return {
+        'REQUEST_METHOD': method, 'PATH_INFO': path, 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_COOKIE': f'csrftoken={CSRF_SECRET}', 'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http', 'wsgi.multithread': False, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+    }
+
+
+REQUESTS = [
+    ('GET', '/', None),
+    ('GET', '/signup/', None),
+    ('POST', '/signup/', {
+        'email': 'coldstart@example.com', 'username': 'coldstart', 'password1': 'password', 'password2': 'password',
+        'csrfmiddlewaretoken': CSRF_SECRET,
+    }),
+]
+
+
+def memory():
+    fields = {}
+    with open('/proc/self/smaps_rollup') as handle:
+        for line in handle:
+            name, _, value = line.partition(':')
+            if value.strip().endswith('kB'):
+                fields[name] = int(value.split()[0])
+    return {
+        'rss': fields['Rss'] / 1024, 'pss': fields['Pss'] / 1024,
+        'private': (fields['Private_Clean'] + fields['Private_Dirty']) / 1024,
+    }
+
+
+def serve(mode, forked_at, repeat):
+    if mode == 'spawn':
+        from whatbytes_assignment.wsgi import application
+    else:
+        application = sys.modules['whatbytes_assignment.wsgi'].application
+    times = []
+    for method, path, data in REQUESTS:
+        statuses = []
+        body = b''.join(application(environ(method, path, data), lambda status, headers, *args: statuses.append(status)))
+        assert statuses[0].startswith('200') and body, (method, path, statuses)
+        times.append((time.perf_counter() - forked_at) * 1000)
+    ## A worker that has been serving for a while
+    for _ in range(repeat):
+        for method, path, data in REQUESTS:
+            b''.join(application(environ(method, path, data), lambda *args: None))
+    ## ... and went through a full collection, which a long running one eventually does
+    gc.collect()
+    return times
+
+
+def master(mode, workers, repeat):
+    '''
+    One mode, run as its own process: prints the workers' results as JSON.
+    '''
+    os.environ['WARM_UP'] = str(mode in ('warm', 'frozen'))
+    if mode != 'spawn':
+        import whatbytes_assignment.wsgi  # noqa: F401
+    if mode == 'frozen':
+        from users.warmup import freeze
+        freeze()
+
+    children = []
+    for _ in range(workers):
+        results, report = os.pipe()
+        proceed, wait = os.pipe()
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(results)
+            os.close(wait)
+            times = serve(mode, forked_at, repeat)
+            os.write(report, b'+')
+            ## Memory is measured once every worker is up, as they share pages
+            os.read(proceed, 1)
+            os.write(report, json.dumps({'times': times, **memory()}).encode())
+            os._exit(0)
+        os.close(report)
+        os.close(proceed)
+        children.append((pid, results, wait))
+        ## One at a time: on few cores, parallel workers would measure each other
+        os.read(results, 1)
+
+    rows = []
+    for pid, results, wait in children:
+        os.write(wait, b'x')
+        with os.fdopen(results) as handle:
+            rows.append(json.loads(handle.read()))
+        os.waitpid(pid, 0)
+    print(json.dumps(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=100, help='Rounds of the requests each worker serves before memory is measured.')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--master', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.master:
+        master(args.master, args.workers, args.repeat)
+        return
+
+    db_name = setup_django()
+    env = {**os.environ, 'DB_NAME': db_name, 'DEBUG': 'False', 'ALLOWED_HOSTS': '*', 'PERF_ENABLED': 'False'}
+    print(f"{'mode':<10}{'first ms':>10}{'3 requests ms':>15}{'RSS MiB':>10}{'PSS MiB':>10}{'private MiB':>13}")
+    for mode in args.modes:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.cold_start', '--master', mode, '--workers', str(args.workers), '--repeat', str(args.repeat)],
+            env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        rows = json.loads(output.strip().splitlines()[-1])
+        median = lambda values: statistics.median(values)
+        print(
+            f'{mode:<10}{median([row["times"][0] for row in rows]):>10.1f}{median([row["times"][-1] for row in rows]):>15.1f}'
+            f'{median([row["rss"] for row in rows]):>10.1f}{median([row["pss"] for row in rows]):>10.1f}'
+            f'{median([row["private"] for row in rows]):>13.1f}'
+        )
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_name + suffix):
+            os.unlink(db_name + suffix)
+
+
+if __name__ == '__main__':
+    main()
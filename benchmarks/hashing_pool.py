@@ -0,0 +1,93 @@
+'''
+Login and page latency with and without the password hashing pool.
+
+    python -m benchmarks.hashing_pool --logins 40 --rate 4 --iterations 100000
+
+Models one ASGI worker with an open-loop workload: logins arrive at
+``--rate`` per second, interleaved with cheap page requests at ten times
+that rate. Latency is measured from each request's scheduled arrival, so
+time spent stuck behind somebody else's hash is included. Without the
+pool every PBKDF2 check runs on the event loop and stalls all other
+requests; with it the loop awaits users.hashing while the checks run on
+the worker threads (in parallel when there are several cores).
+'''
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks._setup import percentile, setup_django
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+
+class BenchPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    iterations = int(os.environ.get('BENCH_PBKDF2_ITERATIONS', PBKDF2PasswordHasher.iterations))
+
+
+async def _login(check, encoded, due, latencies):
+    await check('benchpass123', encoded)
+    latencies.append(time.perf_counter() - due)
+
+
+async def _page(due, latencies):
+    await asyncio.sleep(0)
+    latencies.append(time.perf_counter() - due)
+
+
+async def drive(check, encoded, logins, rate):
+    login_latencies, page_latencies, tasks = [], [], []
+    started = time.perf_counter()
+    pages_per_login = 10
+    for n in range(logins * pages_per_login):
+        due = started + n / (rate * pages_per_login)
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if n % pages_per_login == 0:
+            tasks.append(asyncio.ensure_future(_login(check, encoded, due, login_latencies)))
+        else:
+            tasks.append(asyncio.ensure_future(_page(due, page_latencies)))
+    await asyncio.gather(*tasks)
+    return login_latencies, page_latencies, time.perf_counter() - started
+
+
+def report(label, logins, pages, elapsed):
+    def fmt(samples):
+        return f'p50 {percentile(samples, 50) * 1000:8.1f} ms  p99 {percentile(samples, 99) * 1000:8.1f} ms'
+    print(f'{label:<18} login {fmt(logins)}   page {fmt(pages)}   {len(logins) / elapsed:6.1f} logins/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=40)
+    parser.add_argument('--rate', type=float, default=4, help='Login arrivals per second.')
+    parser.add_argument('--iterations', type=int, default=None, help='PBKDF2 iterations (default: Django default).')
+    parser.add_argument('--workers', type=int, default=None, help='Pool size (default: CPU count).')
+    args = parser.parse_args()
+
+    if args.iterations:
+        BenchPBKDF2PasswordHasher.iterations = args.iterations
+    setup_django(
+        migrate=False,
+        PASSWORD_HASHERS=['benchmarks.hashing_pool.BenchPBKDF2PasswordHasher'],
+        PASSWORD_HASHING_EXECUTOR='thread',
+        PASSWORD_HASHING_WORKERS=args.workers,
+        PASSWORD_HASHING_MAX_PENDING=args.logins,
+    )
+    from django.contrib.auth import hashers
+    from users import hashing
+
+    encoded = hashers.make_password('benchpass123')
+    print(f'{BenchPBKDF2PasswordHasher.iterations} PBKDF2 iterations, {args.logins} logins at {args.rate}/s, '
+          f'{hashing.get_pool().workers} pool worker(s), {os.cpu_count()} CPU(s)')
+
+    async def inline_check(password, encoded):
+        return hashers.check_password(password, encoded)
+
+    report('inline (no pool)', *asyncio.run(drive(inline_check, encoded, args.logins, args.rate)))
+    report('hashing pool', *asyncio.run(drive(hashing.acheck_password, encoded, args.logins, args.rate)))
+    hashing.get_pool().shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+Login lookup throughput of EmailOrUsernameModelBackend against SQLite.
+
+    python -m benchmarks.login_lookup --users 100000 --logins 5000
+
+Password checks use the MD5 hasher by default so the numbers reflect the
+lookup path (query shape, projection, negative cache) rather than PBKDF2;
+pass --real-hasher to measure with the configured hashers.
+'''
+import argparse
+import os
+import random
+
+from benchmarks._setup import Timer, seed_users, setup_django
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+def legacy_authenticate(username, password):
+    ## The backend as it was before the fast path, kept for comparison
+    from users.models import CustomUser
+
+    if '@' in username:
+        kwargs = {'email': username}
+    else:
+        kwargs = {'username': username}
+    try:
+        user = CustomUser.objects.get(**kwargs)
+        if user.check_password(password):
+            return user
+    except CustomUser.DoesNotExist:
+        return None
+
+
+def run(label, authenticate, identifiers, password):
+    with Timer() as timer:
+        for identifier in identifiers:
+            authenticate(identifier, password)
+    rate = len(identifiers) / timer.elapsed
+    print(f'{label:<40} {rate:>10.0f} logins/s  ({timer.elapsed * 1000 / len(identifiers):.3f} ms/login)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--logins', type=int, default=5000)
+    parser.add_argument('--db', default=None, help='Reuse an existing benchmark database file.')
+    parser.add_argument('--real-hasher', action='store_true')
+    args = parser.parse_args()
+
+    overrides = {} if args.real_hasher else {'PASSWORD_HASHERS': FAST_HASHERS}
+    db_name = setup_django(args.db, **overrides)
+    print(f'Seeding {args.users} users into {db_name} ...')
+    seed_users(args.users)
+
+    from users.caching import missing_identifiers
+    from users.custom_auth import EmailOrUsernameModelBackend
+
+    backend = EmailOrUsernameModelBackend()
+    password = 'benchpass123'
+    rng = random.Random(42)
+    known = [
+        f'user{i}@example.com' if n % 2 else f'user{i}'
+        for n, i in enumerate(rng.randrange(args.users) for _ in range(args.logins))
+    ]
+    ## A credential stuffing style workload: a small set of unknown identifiers retried
+    unknown = [f'nobody{rng.randrange(200)}@example.com' for _ in range(args.logins)]
+
+    def new_authenticate(identifier, password):
+        return backend.authenticate(None, username=identifier, password=password)
+
+    run('legacy backend, existing users', legacy_authenticate, known, password)
+    run('fast path, existing users', new_authenticate, known, password)
+    run('legacy backend, unknown identifiers', legacy_authenticate, unknown, password)
+    missing_identifiers.clear()
+    run('fast path, unknown identifiers', new_authenticate, unknown, password)
+
+    if args.db is None:
+        os.unlink(db_name)
+
+
+if __name__ == '__main__':
+    main()
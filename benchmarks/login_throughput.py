@@ -0,0 +1,107 @@
+'''
+Concurrent logins with last_login written per login vs. buffered (users.activity).
+
+    python -m benchmarks.login_throughput --threads 8 --logins 200
+
+Every thread posts the login form for its own users through the full
+middleware stack against a scratch SQLite database (tuned profile).
+
+    direct       Django's update_last_login: one UPDATE inside every login
+    per-request  users.activity with ACTIVITY_FLUSH_INTERVAL = 0: UPDATE and
+                 audit INSERT right after every login request
+    buffered     users.activity defaults: bulk writes every 5 s / 500 entries
+
+"direct" writes no audit rows. With db sessions (the default, cached_db
+on a shared cache) every login also inserts a session row; SESSION_MODE=signed_cookies leaves only
+the last_login/audit writes. Each mode runs in its own process and database.
+'''
+import argparse
+import os
+import subprocess
+import sys
+import threading
+
+from benchmarks._setup import Timer, percentile, seed_users, setup_django
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+def run_mode(args):
+    overrides = {
+        'ALLOWED_HOSTS': ['*'], 'PASSWORD_HASHERS': FAST_HASHERS, 'PASSWORD_HASHING_EXECUTOR': 'inline',
+        'RATELIMIT_ENABLED': False,
+    }
+    if args.mode == 'per-request':
+        overrides['ACTIVITY_FLUSH_INTERVAL'] = 0
+    db_name = setup_django(**overrides)
+    seed_users(args.threads * args.logins, password='benchpass123')
+
+    import logging
+
+    from django.contrib.auth.models import update_last_login
+    from django.contrib.auth.signals import user_logged_in
+    from django.db import connections
+    from django.test import Client
+    from django.urls import reverse
+    from users import activity
+    from users.models import CustomUser, LoginAudit
+
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    if args.mode == 'direct':
+        user_logged_in.disconnect(dispatch_uid='users.activity.buffer_last_login')
+        user_logged_in.connect(update_last_login, dispatch_uid='update_last_login')
+
+    url = reverse('login')
+    latencies, failures = [], [0]
+    lock = threading.Lock()
+
+    def worker(n):
+        client = Client()
+        for i in range(args.logins):
+            username = f'user{n * args.logins + i}'
+            with Timer() as timer:
+                response = client.post(url, {'email_or_username': username, 'password': 'benchpass123'})
+            with lock:
+                latencies.append(timer.elapsed * 1000)
+                failures[0] += response.status_code != 302
+        connections.close_all()
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    pending = len(activity.get_writer())
+    with Timer() as flush:
+        activity.get_writer().flush()
+
+    logged_in = CustomUser.objects.filter(last_login__isnull=False).count()
+    print(
+        f'{args.mode:<12} {len(latencies) / timer.elapsed:7.0f} logins/s   '
+        f'p50 {percentile(latencies, 50):6.2f} ms   p99 {percentile(latencies, 99):7.2f} ms   '
+        f'{failures[0]} failed   final flush {pending} entries in {flush.elapsed * 1000:.1f} ms   '
+        f'last_login set {logged_in}, audit rows {LoginAudit.objects.count()}'
+    )
+    connections.close_all()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_name + suffix):
+            os.unlink(db_name + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=200, help='Logins per thread.')
+    parser.add_argument('--mode', choices=['direct', 'per-request', 'buffered'], help='Run a single mode in this process.')
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        return
+    for mode in ('direct', 'per-request', 'buffered'):
+        subprocess.run([sys.executable, '-m', 'benchmarks.login_throughput', *sys.argv[1:], '--mode', mode], check=True)
+
+
+if __name__ == '__main__':
+    main()
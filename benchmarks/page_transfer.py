@@ -0,0 +1,75 @@
+'''
+Bytes sent and time per request for the logged in pages, by encoding, and
+for a revisit answered from the ETag (users.decorators.conditional_page).
+
+    python -m benchmarks.page_transfer --requests 300
+
+    identity    no Accept-Encoding
+    gzip        Accept-Encoding: gzip
+    br          Accept-Encoding: gzip, br (when brotli is installed)
+    304         a revisit sending back the ETag of the last page
+
+Bytes are the response body, time is the median of the whole request
+through django.test.Client.
+'''
+import argparse
+import os
+import statistics
+
+from benchmarks._setup import Timer, setup_django
+
+PAGES = ['dashboard', 'profile']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300, help='Requests per page and case, the median is reported.')
+    args = parser.parse_args()
+
+    db_name = setup_django(ALLOWED_HOSTS=['*'])
+    from django.db import connection
+    from django.test import Client
+    from django.urls import reverse
+    from users import activity
+    from users.middleware import brotli
+    from users.models import CustomUser
+
+    user = CustomUser.objects.create_user(email='pages@example.com', username='pages', password='benchpass123')
+    client = Client()
+    client.force_login(user)
+    cases = [('identity', {}), ('gzip', {'HTTP_ACCEPT_ENCODING': 'gzip'})]
+    if brotli is not None:
+        cases.append(('br', {'HTTP_ACCEPT_ENCODING': 'gzip, br'}))
+
+    print(f"{'page':<12}" + ''.join(f'{label + " bytes":>14}{"ms":>8}' for label, _ in [*cases, ('304', None)]))
+    for name in PAGES:
+        url = reverse(name)
+        ## Sets the CSRF cookie the ETag depends on
+        client.get(url)
+        row = ''
+        for label, headers in cases:
+            times = []
+            for _ in range(args.requests):
+                with Timer() as timer:
+                    response = client.get(url, **headers)
+                times.append(timer.elapsed * 1000)
+            row += f'{len(response.content):>14}{statistics.median(times):>8.2f}'
+        etag = response['ETag']
+        times = []
+        for _ in range(args.requests):
+            with Timer() as timer:
+                response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            times.append(timer.elapsed * 1000)
+        assert response.status_code == 304
+        row += f'{len(response.content):>14}{statistics.median(times):>8.2f}'
+        print(f'{name:<12}{row}')
+
+    activity.get_writer().flush()
+    connection.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_name + suffix):
+            os.unlink(db_name + suffix)
+
+
+if __name__ == '__main__':
+    main()
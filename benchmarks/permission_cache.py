@@ -0,0 +1,88 @@
+'''
+Admin pages for a staff user in many groups: ModelBackend permission
+loading vs. the cross-request cache of users.permissions.
+
+    python -m benchmarks.permission_cache --groups 50 --perms 20 --repeat 20
+
+Gives a non-superuser staff account --groups groups of --perms permissions
+each, logs it in through the test client and renders the admin index, the
+user changelist and a user change form with:
+
+    off     AUTH_PERMISSION_CACHE_TTL = 0, ModelBackend as shipped: the
+            user's and groups' permissions are queried on every request
+    cold    cache on, emptied before every request
+    warm    cache on, filled by an earlier request
+
+Reports queries per request, how many of them touch auth_permission, and
+the median render time.
+'''
+import argparse
+import os
+import statistics
+
+from benchmarks._setup import Timer, seed_users, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--perms', type=int, default=20, help='Permissions per group, drawn from all of them.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20, help='Requests per case, the median is reported.')
+    args = parser.parse_args()
+
+    db_name = setup_django(ALLOWED_HOSTS=['*'], DEBUG=True)
+    seed_users(args.users)
+    from django.contrib.auth.models import Group, Permission
+    from django.core.cache import cache
+    from django.db import connection
+    from django.test import Client, override_settings
+    from django.test.utils import CaptureQueriesContext
+    from users import activity
+    from users.models import CustomUser
+
+    staff = CustomUser.objects.create_user(email='staff@example.com', username='staff', password='benchpass123')
+    CustomUser.objects.filter(pk=staff.pk).update(is_staff=True)
+    permissions = list(Permission.objects.order_by('pk').values_list('pk', flat=True))
+    for n in range(args.groups):
+        group = Group.objects.create(name=f'group{n}')
+        group.permissions.set(permissions[(n * 7 + k) % len(permissions)] for k in range(args.perms))
+    staff.groups.set(Group.objects.all())
+    other = CustomUser.objects.exclude(pk=staff.pk).first()
+    pages = [
+        ('admin index', '/admin/'),
+        ('user changelist', '/admin/users/customuser/'),
+        ('user change form', f'/admin/users/customuser/{other.pk}/change/'),
+    ]
+    print(f'staff user in {args.groups} groups, {len(staff.get_all_permissions())} distinct permissions')
+
+    client = Client()
+    client.force_login(staff)
+    modes = [('off', 0, False), ('cold', 300, True), ('warm', 300, False)]
+    print(f"{'page':<20}" + ''.join(f'{mode + " queries":>16}{"(perm)":>8}{"ms":>8}' for mode, _, _ in modes))
+    for label, url in pages:
+        row = ''
+        for mode, ttl, clear in modes:
+            with override_settings(AUTH_PERMISSION_CACHE_TTL=ttl):
+                assert client.get(url).status_code == 200
+                times, counts, perm_counts = [], [], []
+                for _ in range(args.repeat):
+                    if clear:
+                        cache.clear()
+                    with CaptureQueriesContext(connection) as queries, Timer() as timer:
+                        client.get(url)
+                    times.append(timer.elapsed * 1000)
+                    counts.append(len(queries))
+                    perm_counts.append(sum('auth_permission' in query['sql'] for query in queries.captured_queries))
+            row += f'{statistics.median(counts):>16.0f}{statistics.median(perm_counts):>8.0f}{statistics.median(times):>8.1f}'
+        print(f'{label:<20}{row}')
+
+    activity.get_writer().flush()
+    connection.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_name + suffix):
+            os.unlink(db_name + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+'''
+Cost of rejecting a rate limited login, compared with a full failed login.
+
+    python -m benchmarks.ratelimit --requests 2000
+
+Reports the limiter check on its own and the whole request through the
+test client (middleware, session, view). A rejected login should stay
+well under a millisecond whatever the password hasher costs.
+'''
+import argparse
+import logging
+import os
+
+from benchmarks._setup import Timer, percentile, seed_users, setup_django
+
+
+def measure(label, func, count):
+    samples = []
+    for _ in range(count):
+        with Timer() as timer:
+            func()
+        samples.append(timer.elapsed * 1000)
+    print(
+        f'{label:<40} p50 {percentile(samples, 50):7.3f} ms   '
+        f'p99 {percentile(samples, 99):7.3f} ms'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--store', choices=['locmem', 'cache'], default='locmem')
+    args = parser.parse_args()
+
+    db_name = setup_django(ALLOWED_HOSTS=['*'], RATELIMIT_STORE=args.store)
+    seed_users(10)
+    ## Every 429 is logged as a warning otherwise
+    logging.getLogger('django.request').setLevel(logging.ERROR)
+
+    from django.test import Client
+    from django.urls import reverse
+    from users.ratelimit import login_limiter
+
+    client = Client()
+    url = reverse('login')
+    data = {'email_or_username': 'user1', 'password': 'wrong'}
+
+    ## Full failed logins, password hashing included, until the limiter trips
+    measure('failed login (not limited)', lambda: client.post(url, data), 5)
+    assert client.post(url, data).status_code == 429
+
+    measure('limiter check (locked out)', lambda: login_limiter.check('127.0.0.1', 'user1'), args.requests)
+    measure('rejected login request', lambda: client.post(url, data), args.requests)
+
+    os.unlink(db_name)
+
+
+if __name__ == '__main__':
+    main()
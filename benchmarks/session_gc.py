@@ -0,0 +1,93 @@
+'''
+Expired session cleanup: Django's clearsessions vs. users.cleanup.collect().
+
+    python -m benchmarks.session_gc --expired 500000 --live 50000
+
+Each mode starts from the same table of --expired expired and --live live
+sessions on the SQLite profile, while a writer thread keeps saving new
+sessions the way logins do. Reports how long the cleanup took, rows
+reclaimed per second, and the latency of the writer's saves meanwhile:
+clearsessions holds the write lock for its whole DELETE, collect() only
+for one batch at a time.
+'''
+import argparse
+import os
+import threading
+from datetime import timedelta
+
+from benchmarks._setup import Timer, percentile, setup_django
+
+
+def seed_sessions(expired, live, batch_size=10000):
+    from django.contrib.sessions.models import Session
+    from django.utils import timezone
+
+    now = timezone.now()
+    for start in range(0, expired + live, batch_size):
+        Session.objects.bulk_create([
+            Session(
+                session_key=f'seed{n:032d}', session_data='e30:seed',
+                expire_date=now + (timedelta(days=1) if n >= expired else -timedelta(seconds=n)),
+            )
+            for n in range(start, min(start + batch_size, expired + live))
+        ])
+
+
+def run(mode, args):
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.contrib.sessions.models import Session
+    from django.core.management import call_command
+    from django.db import connections
+
+    from users import cleanup
+
+    Session.objects.all().delete()
+    seed_sessions(args.expired, args.live)
+    done = threading.Event()
+    latencies = []
+
+    def writer():
+        while not done.is_set():
+            with Timer() as timer:
+                store = SessionStore()
+                store['user'] = 1
+                store.save(must_create=True)
+            latencies.append(timer.elapsed * 1000)
+        connections.close_all()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    with Timer() as elapsed:
+        if mode == 'clearsessions':
+            call_command('clearsessions')
+        else:
+            cleanup.collect(['sessions'], batch_size=args.batch_size, budget=float('inf'), pause=args.pause)
+    done.set()
+    thread.join()
+    remaining = Session.objects.filter(session_key__startswith='seed').count()
+    reclaimed = args.expired + args.live - remaining
+    print(
+        f'{mode:<14}{elapsed.elapsed:>7.2f} s{reclaimed / elapsed.elapsed:>10.0f} rows/s   '
+        f'writer p50 {percentile(latencies, 50):6.1f} ms  p99 {percentile(latencies, 99):7.1f} ms  '
+        f'max {max(latencies):7.1f} ms  ({len(latencies)} saves)'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--expired', type=int, default=500_000)
+    parser.add_argument('--live', type=int, default=50_000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.01)
+    args = parser.parse_args()
+
+    db_name = setup_django(SESSION_ENGINE='django.contrib.sessions.backends.db')
+    for mode in ('clearsessions', 'collect'):
+        run(mode, args)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_name + suffix):
+            os.unlink(db_name + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''
+Concurrent user writes on one SQLite database vs. users spread over shards (users.sharding).
+
+    python -m benchmarks.sharding --shards 0 2 4 --threads 8 --users 2000 --writes 4000
+
+For each shard count, on fresh SQLite files: --threads threads sign up
+--users users between them, then make --writes password changes on random
+users (set_password + save, as the change password view does). Reports
+throughput and write latency. SQLite takes one writer at a time per file,
+so shards let writes to different shards proceed together, but here they
+share one process, CPU and disk: what this mostly shows is the cost of
+the directory lookup. Then adds one more shard and times the rebalance. Password hashing is the MD5
+test hasher so the database is what is measured.
+'''
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+
+from benchmarks._setup import Timer, percentile, setup_django
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+def add_shards(directory, count):
+    from django.core.management import call_command
+    from django.db import connections
+    from django.test import override_settings
+
+    aliases = []
+    for index in range(1, count + 1):
+        alias = f'shard{index}'
+        if alias not in connections.settings:
+            connections.settings[alias] = {
+                **connections.settings['default'], 'NAME': os.path.join(directory, f'{alias}.sqlite3'),
+            }
+            with override_settings(DATABASE_ROUTERS=['users.sharding.ShardRouter']):
+                call_command('migrate', database=alias, verbosity=0)
+        aliases.append(alias)
+    return aliases
+
+
+def run_threads(threads, work):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(index):
+        from django.db import connections
+
+        mine = []
+        for item in work[index::threads]:
+            with Timer() as timer:
+                item()
+            mine.append(timer.elapsed * 1000)
+        with lock:
+            latencies.extend(mine)
+        connections.close_all()
+
+    with Timer() as elapsed:
+        pool = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+    return elapsed.elapsed, latencies
+
+
+def report(label, elapsed, latencies):
+    print(
+        f'{label:<28}{len(latencies) / elapsed:>9.0f} /s   p50 {percentile(latencies, 50):6.1f} ms  '
+        f'p99 {percentile(latencies, 99):7.1f} ms'
+    )
+
+
+def run(shard_count, args):
+    from django.core.management import call_command
+    from django.db import connections
+    from django.test import override_settings
+
+    from users import sharding
+    from users.models import CustomUser
+
+    directory = tempfile.mkdtemp(prefix='wbytes-shards-', dir=args.dir)
+    default_name = os.path.join(directory, 'default.sqlite3')
+    connections['default'].close()
+    connections.settings['default']['NAME'] = default_name
+    call_command('migrate', verbosity=0)
+    aliases = add_shards(directory, shard_count)
+    routers = ['users.sharding.ShardRouter'] if aliases else []
+    try:
+        with override_settings(DATABASE_SHARDS=aliases, DATABASE_ROUTERS=routers):
+            def signup(n):
+                return lambda: CustomUser.objects.create_user(email=f'user{n}@example.com', username=f'user{n}', password='benchpass123')
+
+            elapsed, latencies = run_threads(args.threads, [signup(n) for n in range(args.users)])
+            label = f'{shard_count} shards' if shard_count else 'default only'
+            report(f'{label}: signups', elapsed, latencies)
+
+            ids = list(CustomUser.objects.values_list('pk', flat=True))
+            for alias in aliases:
+                ids += CustomUser.objects.using(alias).values_list('pk', flat=True)
+            random.seed(1)
+
+            def change_password(user_id):
+                def change():
+                    user = CustomUser.objects.db_manager(sharding.db_for_user(user_id)).get(pk=user_id)
+                    user.set_password('n3w-benchpass')
+                    user.save(update_fields=['password', 'password_stamp'])
+                return change
+
+            elapsed, latencies = run_threads(args.threads, [change_password(random.choice(ids)) for _ in range(args.writes)])
+            report(f'{label}: password changes', elapsed, latencies)
+
+        if aliases:
+            grown = add_shards(directory, shard_count + 1)
+            with override_settings(DATABASE_SHARDS=grown, DATABASE_ROUTERS=routers):
+                with Timer() as timer:
+                    moved = sharding.rebalance(batch_size=500)
+            count = sum(moved.values())
+            print(f'{label}: rebalance to {len(grown)} shards moved {count} users in {timer.elapsed:.2f} s ({count / timer.elapsed:.0f} users/s)')
+    finally:
+        connections.close_all()
+        for alias in [alias for alias in connections.settings if alias.startswith('shard')]:
+            del connections.settings[alias]
+            del connections[alias]
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--writes', type=int, default=4000)
+    parser.add_argument('--synchronous', default='FULL', help='SQLite synchronous pragma: FULL syncs every commit, as a durable primary does.')
+    parser.add_argument('--dir', help='Where to put the database files (default: a temporary directory).')
+    args = parser.parse_args()
+
+    db_name = setup_django(migrate=False, PASSWORD_HASHERS=FAST_HASHERS, DATABASE_REPLICAS=[], RATELIMIT_ENABLED=False)
+    from django.conf import settings
+
+    settings.SQLITE_PRAGMAS = {**settings.SQLITE_PRAGMAS, 'synchronous': args.synchronous}
+    os.unlink(db_name)
+    for shard_count in args.shards:
+        run(shard_count, args)
+
+
+if __name__ == '__main__':
+    main()
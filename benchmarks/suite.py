@@ -0,0 +1,415 @@
+'''
+End-to-end benchmarks of the authentication flows, run by ``manage.py bench``.
+
+Each flow is driven through one or more transports:
+
+    client   django.test.Client, in process: the Django stack without sockets
+    wsgi     Django's threaded WSGI server (the one behind runserver) on a local port
+    asgi     uvicorn on a local port (pip install uvicorn)
+
+and reported as throughput, p50/p95/p99 latency, queries per request (the
+Server-Timing header of users.perf) and the peak RSS of the process while
+the flow ran; servers run in process, so that covers them too.
+
+A run is a plain dict that saves as a JSON baseline. compare() lists what
+regressed between a baseline and a run: any failed request, more queries
+per request, or latency, throughput or memory worse than the tolerance.
+'''
+import gc
+import http.client
+import json
+import math
+import platform
+import re
+import resource
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+import django
+from django.urls import reverse
+
+from benchmarks._setup import Timer, percentile
+
+PASSWORD = 'benchpass123'
+TRANSPORTS = ('client', 'wsgi', 'asgi')
+## Latency differences below this many ms are noise, whatever the tolerance says
+LATENCY_SLACK_MS = 1.0
+
+_server_timing_queries = re.compile(r'desc="(\d+) queries"')
+
+
+def queries_from(server_timing):
+    match = _server_timing_queries.search(server_timing or '')
+    return int(match.group(1)) if match else None
+
+
+def encode(data, as_json):
+    if as_json:
+        return json.dumps(data), 'application/json'
+    return urlencode(data), 'application/x-www-form-urlencoded'
+
+
+class ClientSession:
+    '''
+    One browser, through django.test.Client.
+    '''
+    def __init__(self):
+        from django.test import Client
+
+        self.client = Client()
+        ## Sent as a bearer token when set (JSON API flows)
+        self.access_token = None
+        self.last_body = b''
+
+    def request(self, method, path, data=None, as_json=False):
+        body, content_type = encode(data, as_json) if data is not None else ('', 'text/plain')
+        headers = {'Authorization': f'Bearer {self.access_token}'} if self.access_token else {}
+        response = self.client.generic(method, path, body, content_type=content_type, headers=headers)
+        self.last_body = response.content
+        return response.status_code, queries_from(response.get('Server-Timing'))
+
+
+class HttpSession:
+    '''
+    One browser against a local server: cookies and the CSRF header, a connection per request.
+    '''
+    def __init__(self, address):
+        self.host, self.port = address
+        self.cookies = {}
+        self.access_token = None
+        self.last_body = b''
+
+    def request(self, method, path, data=None, as_json=False):
+        headers = {'Connection': 'close'}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+        if self.access_token:
+            headers['Authorization'] = f'Bearer {self.access_token}'
+        body = None
+        if data is not None:
+            body, headers['Content-Type'] = encode(data, as_json)
+            if 'csrftoken' in self.cookies:
+                headers['X-CSRFToken'] = self.cookies['csrftoken']
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            self.last_body = response.read()
+        finally:
+            connection.close()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                if morsel['max-age'] == '0':
+                    self.cookies.pop(name, None)
+                else:
+                    self.cookies[name] = morsel.value
+        return response.status, queries_from(response.getheader('Server-Timing'))
+
+
+@contextmanager
+def wsgi_server():
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler, allow_reuse_address=False)
+    server.set_app(get_internal_wsgi_application())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_address
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@contextmanager
+def asgi_server():
+    import uvicorn
+    from django.core.asgi import get_asgi_application
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(get_asgi_application(), lifespan='off', log_level='warning', access_log=False))
+    thread = threading.Thread(target=server.run, kwargs={'sockets': [sock]}, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError('uvicorn did not start')
+        time.sleep(0.01)
+    try:
+        yield sock.getsockname()
+    finally:
+        server.should_exit = True
+        thread.join()
+        sock.close()
+
+
+@contextmanager
+def transport(name):
+    '''
+    Yield a factory of sessions for transport ``name``.
+    '''
+    if name == 'client':
+        yield ClientSession
+        return
+    with (wsgi_server() if name == 'wsgi' else asgi_server()) as address:
+        yield lambda: HttpSession(address)
+
+
+def reset_peak_rss():
+    ## Linux: writing 5 resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as handle:
+            handle.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mib():
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    ## Peak of the whole process lifetime, in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Flow:
+    '''
+    A benchmarked flow: ``prepare`` runs once per session, ``step`` returns
+    the (method, path, data, expected status) of its i-th request; both
+    are outside the timings. ``as_json`` flows send JSON bodies.
+    '''
+    login_first = False
+    as_json = False
+
+    def __init__(self, users, run_id):
+        self.users = users
+        self.run_id = run_id
+
+    def user(self, worker, i):
+        return f'user{(worker * 7919 + i) % self.users}'
+
+    def prepare(self, session, worker):
+        ## The login page hands out the CSRF cookie the server transports need
+        session.request('GET', reverse('login'))
+        if self.login_first:
+            session.request('POST', reverse('login'), {'email_or_username': self.user(worker, 0), 'password': PASSWORD})
+
+
+class Signup(Flow):
+    def step(self, worker, i):
+        username = f'new{self.run_id}w{worker}n{i}'
+        return 'POST', reverse('signup'), {
+            'email': f'{username}@example.com', 'username': username, 'password1': PASSWORD, 'password2': PASSWORD,
+        }, 302
+
+
+class LoginByEmail(Flow):
+    def step(self, worker, i):
+        return 'POST', reverse('login'), {'email_or_username': f'{self.user(worker, i)}@example.com', 'password': PASSWORD}, 302
+
+
+class LoginByUsername(Flow):
+    def step(self, worker, i):
+        return 'POST', reverse('login'), {'email_or_username': self.user(worker, i), 'password': PASSWORD}, 302
+
+
+class Dashboard(Flow):
+    login_first = True
+
+    def step(self, worker, i):
+        return 'GET', reverse('dashboard'), None, 200
+
+
+class ChangePassword(Flow):
+    ## Changed to the same password, so the other flows keep logging in
+    login_first = True
+
+    def step(self, worker, i):
+        return 'POST', reverse('change_password'), {
+            'old_password': PASSWORD, 'new_password1': PASSWORD, 'new_password2': PASSWORD,
+        }, 302
+
+
+class ForgotPassword(Flow):
+    def step(self, worker, i):
+        return 'POST', reverse('forgot_password'), {'email': f'{self.user(worker, i)}@example.com'}, 302
+
+
+class ResetPassword(Flow):
+    def step(self, worker, i):
+        from users import tokens
+        from users.models import CustomUser
+
+        ## Tokens are single use, each request gets a fresh one
+        token = tokens.make_token(CustomUser.objects.get(username=self.user(worker, i)))
+        return 'POST', f"{reverse('reset_password')}?token={token}", {
+            'new_password': PASSWORD, 'confirm_password': PASSWORD,
+        }, 302
+
+
+class ApiFlow(Flow):
+    '''
+    JSON API (users.api): no CSRF cookie to fetch, logins hand out a bearer token.
+    '''
+    as_json = True
+
+    def prepare(self, session, worker):
+        if self.login_first:
+            session.request('POST', reverse('api_login'), {'email_or_username': self.user(worker, 0), 'password': PASSWORD}, as_json=True)
+            session.access_token = json.loads(session.last_body)['access_token']
+
+
+class ApiSignup(ApiFlow):
+    def step(self, worker, i):
+        username = f'api{self.run_id}w{worker}n{i}'
+        return 'POST', reverse('api_signup'), {
+            'email': f'{username}@example.com', 'username': username, 'password1': PASSWORD, 'password2': PASSWORD,
+        }, 201
+
+
+class ApiLogin(ApiFlow):
+    def step(self, worker, i):
+        return 'POST', reverse('api_login'), {'email_or_username': self.user(worker, i), 'password': PASSWORD}, 200
+
+
+class ApiMe(ApiFlow):
+    ## The API's counterpart of the dashboard: an authenticated read
+    login_first = True
+
+    def step(self, worker, i):
+        return 'GET', reverse('api_me'), None, 200
+
+
+FLOWS = {
+    'signup': Signup,
+    'login_email': LoginByEmail,
+    'login_username': LoginByUsername,
+    'dashboard': Dashboard,
+    'change_password': ChangePassword,
+    'forgot_password': ForgotPassword,
+    'reset_password': ResetPassword,
+    'api_signup': ApiSignup,
+    'api_login': ApiLogin,
+    'api_me': ApiMe,
+}
+
+
+def run_flow(open_session, name, requests, concurrency, users, run_id):
+    '''
+    Run ``requests`` requests of flow ``name`` split over ``concurrency`` sessions (one thread each).
+    '''
+    from django.db import connections
+    from users import activity
+
+    flow = FLOWS[name](users, run_id)
+    per_worker = math.ceil(requests / concurrency)
+    sessions = [open_session() for _ in range(concurrency)]
+    for worker, session in enumerate(sessions):
+        flow.prepare(session, worker)
+    ## Writes left over from the previous flow are not this one's to pay for
+    activity.get_writer().flush()
+    gc.collect()
+
+    latencies, queries, errors = [], [], [0]
+    lock = threading.Lock()
+
+    def work(worker):
+        session = sessions[worker]
+        for i in range(per_worker):
+            method, path, data, expected = flow.step(worker, i)
+            with Timer() as timer:
+                status, count = session.request(method, path, data, flow.as_json)
+            with lock:
+                latencies.append(timer.elapsed * 1000)
+                errors[0] += status != expected
+                if count is not None:
+                    queries.append(count)
+        if concurrency > 1:
+            connections.close_all()
+
+    reset_peak_rss()
+    with Timer() as elapsed:
+        if concurrency == 1:
+            work(0)
+        else:
+            threads = [threading.Thread(target=work, args=(worker,)) for worker in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed.elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'queries': percentile(queries, 50) if queries else None,
+        'peak_rss_mib': round(peak_rss_mib(), 1),
+    }
+
+
+def run_suite(transports, flows, requests, concurrency, users, progress=None):
+    started = int(time.time())
+    results = {}
+    for name in transports:
+        with transport(name) as open_session:
+            results[name] = {}
+            for flow in flows:
+                ## Signups of every transport and run need their own usernames
+                results[name][flow] = run_flow(open_session, flow, requests, concurrency, users, f'{name}{started}')
+                if progress:
+                    progress(name, flow, results[name][flow])
+    return {
+        'meta': {
+            'users': users, 'requests': requests, 'concurrency': concurrency,
+            'python': platform.python_version(), 'django': django.get_version(), 'machine': platform.machine(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, tolerance=0.2):
+    '''
+    Regressions of ``current`` against ``baseline``, as messages; flows missing from either are skipped.
+
+    Runs with different parameters are not comparable, that is the only regression reported then.
+    '''
+    regressions = []
+    for key in ('users', 'requests', 'concurrency', 'hasher'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            regressions.append(f"baseline ran with {key} {baseline['meta'].get(key)}, this run with {current['meta'].get(key)}")
+    if regressions:
+        return regressions
+    for name, flows in current['results'].items():
+        for flow, now in flows.items():
+            label = f'{name}/{flow}'
+            if now['errors']:
+                regressions.append(f"{label}: {now['errors']} of {now['requests']} requests failed")
+            before = baseline.get('results', {}).get(name, {}).get(flow)
+            if before is None:
+                continue
+            if None not in (now['queries'], before['queries']) and now['queries'] > before['queries']:
+                regressions.append(f"{label}: {now['queries']} queries per request, was {before['queries']}")
+            if now['p95_ms'] > before['p95_ms'] * (1 + tolerance) + LATENCY_SLACK_MS:
+                regressions.append(f"{label}: p95 {now['p95_ms']} ms, was {before['p95_ms']} ms")
+            if now['rps'] < before['rps'] * (1 - tolerance):
+                regressions.append(f"{label}: {now['rps']} req/s, was {before['rps']}")
+            if now['peak_rss_mib'] > before['peak_rss_mib'] * (1 + tolerance):
+                regressions.append(f"{label}: peak RSS {now['peak_rss_mib']} MiB, was {before['peak_rss_mib']} MiB")
+    return regressions
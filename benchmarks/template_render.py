@@ -0,0 +1,82 @@
+'''
+Template render time per page, layering the rendering caches one by one.
+
+    python -m benchmarks.template_render --requests 300
+
+Render time is the "template" entry of the Server-Timing header written by
+users.perf, so it covers only template work (loading, rendering, shell
+splicing), not the rest of the request.
+
+    uncached      filesystem/app_directories loaders, no shells
+    +loader       the cached loader from the settings
+    +shells       anonymous form pages served from prerendered shells
+'''
+import argparse
+import atexit
+import os
+import shutil
+import tempfile
+
+from benchmarks._setup import percentile, seed_users, setup_django
+
+PAGES = [('login', False), ('signup', False), ('forgot_password', False), ('dashboard', True), ('profile', True)]
+
+
+def template_ms(response):
+    for part in response['Server-Timing'].split(', '):
+        if part.startswith('template;'):
+            return float(part.split('dur=')[1])
+    return 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300, help='Requests per page and configuration.')
+    args = parser.parse_args()
+
+    db_name = setup_django(ALLOWED_HOSTS=['*'], PERF_ENABLED=True, PERF_DIR=tempfile.mkdtemp(prefix='wbytes-perf-'))
+    seed_users(1)
+
+    from django.conf import settings
+    from django.core.cache import cache
+    from django.test import Client, override_settings
+    from django.urls import reverse
+    from users.models import CustomUser
+    from users.perf import get_recorder
+    from users.rendering import clear_shells
+
+    timed = {**settings.TEMPLATES[0], 'BACKEND': 'users.perf.TimedDjangoTemplates'}
+    uncached = {**timed, 'OPTIONS': {**timed['OPTIONS'], 'loaders': [
+        'django.template.loaders.filesystem.Loader', 'django.template.loaders.app_directories.Loader',
+    ]}}
+    configurations = [
+        ('uncached', {'TEMPLATES': [uncached], 'TEMPLATE_SHELLS': False}),
+        ('+loader', {'TEMPLATES': [timed], 'TEMPLATE_SHELLS': False}),
+        ('+shells', {'TEMPLATES': [timed], 'TEMPLATE_SHELLS': True}),
+    ]
+
+    user = CustomUser.objects.get()
+    results = {}
+    for label, overrides in configurations:
+        with override_settings(**overrides):
+            cache.clear()
+            clear_shells()
+            anonymous, member = Client(), Client()
+            member.force_login(user)
+            for page, logged_in in PAGES:
+                client = member if logged_in else anonymous
+                url = reverse(page)
+                client.get(url)
+                results[label, page] = [template_ms(client.get(url)) for _ in range(args.requests)]
+
+    print(f"{'page':<16}" + ''.join(f'{label:>14}' for label, _ in configurations) + '   (p50 ms)')
+    for page, _ in PAGES:
+        print(f'{page:<16}' + ''.join(f'{percentile(results[label, page], 50):>14.3f}' for label, _ in configurations))
+    os.unlink(db_name)
+    ## Histograms were only a means to read the timings, drop them
+    atexit.unregister(get_recorder().flush)
+    shutil.rmtree(settings.PERF_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
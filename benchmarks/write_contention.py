@@ -0,0 +1,116 @@
+'''
+Concurrent signups against the SQLite profile: stock settings vs. the tuned ones.
+
+    python -m benchmarks.write_contention --writers 8 --signups 200 --readers 2
+
+Writer threads validate and save CustomUserCreationForm (uniqueness
+queries + INSERT) while reader threads keep looking users up, like logins
+hitting the database during a signup burst. "stock" is what the project
+used to run with (rollback journal, synchronous=FULL, 5 s busy timeout);
+"tuned" is the DATABASE_PROFILE=sqlite default (WAL, synchronous=NORMAL,
+20 s busy timeout). Each profile runs in its own process and database.
+'''
+import argparse
+import os
+import subprocess
+import sys
+import threading
+
+from benchmarks._setup import Timer, percentile, setup_django
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+def run_profile(args):
+    overrides = {'PASSWORD_HASHERS': FAST_HASHERS, 'PASSWORD_HASHING_EXECUTOR': 'inline'}
+    if args.profile == 'stock':
+        overrides['SQLITE_PRAGMAS'] = {}
+    db_name = setup_django(migrate=False, **overrides)
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import OperationalError, connection, connections
+
+    if args.profile == 'stock':
+        settings.DATABASES['default']['OPTIONS'] = {'timeout': 5}
+        settings.DATABASES['default']['CONN_MAX_AGE'] = 0
+    call_command('migrate', verbosity=0)
+    connection.close()
+
+    from users.custom_auth import EmailOrUsernameModelBackend
+    from users.forms.user_form import CustomUserCreationForm
+
+    latencies, errors, reads = [], [], [0]
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def writer(n):
+        for i in range(args.signups):
+            name = f'w{n}u{i}'
+            data = {'email': f'{name}@example.com', 'username': name, 'password1': 'Bench-pass-123', 'password2': 'Bench-pass-123'}
+            try:
+                with Timer() as timer:
+                    form = CustomUserCreationForm(data)
+                    if form.is_valid():
+                        form.save()
+                with lock:
+                    latencies.append(timer.elapsed * 1000)
+            except OperationalError as error:
+                with lock:
+                    errors.append(str(error))
+        connections.close_all()
+
+    def reader(n):
+        backend = EmailOrUsernameModelBackend()
+        count = 0
+        while not done.is_set():
+            try:
+                backend.get_login_user(f'w{count % args.writers}u{count % args.signups}')
+                count += 1
+            except OperationalError as error:
+                with lock:
+                    errors.append(str(error))
+        with lock:
+            reads[0] += count
+        connections.close_all()
+
+    writers = [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    readers = [threading.Thread(target=reader, args=(n,)) for n in range(args.readers)]
+    with Timer() as timer:
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    print(
+        f'{args.profile:<6} {len(latencies) / timer.elapsed:8.0f} signups/s   '
+        f'p50 {percentile(latencies, 50):7.2f} ms   p99 {percentile(latencies, 99):8.2f} ms   '
+        f'{reads[0] / timer.elapsed:8.0f} reads/s   {len(errors)} error(s)'
+    )
+    for error in sorted(set(errors)):
+        print(f'       {errors.count(error)} x {error}')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_name + suffix):
+            os.unlink(db_name + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--signups', type=int, default=200, help='Signups per writer thread.')
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--profile', choices=['stock', 'tuned'], help='Run a single profile in this process.')
+    args = parser.parse_args()
+
+    if args.profile:
+        run_profile(args)
+        return
+    for profile in ('stock', 'tuned'):
+        subprocess.run([sys.executable, '-m', 'benchmarks.write_contention', *sys.argv[1:], '--profile', profile], check=True)
+
+
+if __name__ == '__main__':
+    main()
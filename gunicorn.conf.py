@@ -0,0 +1,43 @@
+'''
+gunicorn -c gunicorn.conf.py whatbytes_assignment.wsgi
+
+(pip install gunicorn.) The application is loaded once, in the master:
+wsgi.py warms it up (users/warmup.py), the garbage collector is frozen,
+and every worker forked from there, on start or when scaling up, serves
+its first request right away and shares the master's memory. python -m
+benchmarks.cold_start measures both.
+
+Settings come from the environment, the usual gunicorn ones through
+GUNICORN_CMD_ARGS. Sessions, cached users and login lockouts live in
+CACHES["default"]: on the default locmem cache each worker would have its
+own, so there is one worker unless CACHE_BACKEND is a shared one.
+'''
+import multiprocessing
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'whatbytes_assignment.settings')
+
+from django.conf import settings  # noqa: E402
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1 if settings.CACHE_SHARED else 1))
+if workers > 1 and not settings.CACHE_SHARED:
+    raise RuntimeError(
+        f'WEB_CONCURRENCY={workers} with a locmem cache: set CACHE_BACKEND to a cache the workers share '
+        '(redis, memcached, database), or run a single worker'
+    )
+preload_app = True
+
+
+def when_ready(server):
+    ## After the preload, before the first worker is forked
+    from users.warmup import freeze
+
+    freeze()
+
+
+def post_fork(server, worker):
+    ## Sync workers serve from this thread; the connections of the master were closed before forking
+    from users.warmup import connect
+
+    connect()
@@ -0,0 +1,169 @@
+'''
+Buffered last_login and login audit writes.
+
+Django saves CustomUser.last_login with its own UPDATE on every login,
+which on SQLite takes the database write lock in the middle of the login
+request. Instead, the user_logged_in receiver below only notes the login
+in a per-process buffer, together with a LoginAudit row (failed attempts
+are added by the login view). The buffer is written with one bulk_update
+and one bulk_create:
+
+* after a request, once the oldest entry has waited ACTIVITY_FLUSH_INTERVAL
+  seconds or ACTIVITY_BATCH_SIZE entries are pending,
+* when the process exits.
+
+ACTIVITY_FLUSH_INTERVAL = 0 writes after every request that logged someone
+in. Entries of a process that gets killed are lost. Password reset tokens
+hash last_login, so one issued between a login and its flush stops working
+at the flush, as it would after any later login.
+'''
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.core.signals import request_finished, setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import sharding
+from .caching import invalidate_users
+from .models import CustomUser, LoginAudit
+from .ratelimit import client_ip
+
+logger = logging.getLogger(__name__)
+
+clock = time.monotonic
+
+
+class ActivityWriter:
+    '''
+    Pending last_login values ({user id: time}, the latest wins) and LoginAudit rows.
+
+    At most ``max_pending`` audit rows are kept while the database is
+    unreachable; the oldest are dropped first.
+    '''
+    def __init__(self, flush_interval=5, batch_size=500, max_pending=10000):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        ## Held for a whole flush so a process never writes an older last_login over a newer one
+        self._flush_lock = threading.Lock()
+        self._last_logins = {}
+        self._audits = deque(maxlen=max_pending)
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._last_logins) + len(self._audits)
+
+    def record_login(self, user, ip='', when=None):
+        when = when or timezone.now()
+        audit = LoginAudit(
+            user_id=user.pk, identifier=user.get_username(), ip=ip or None,
+            outcome=LoginAudit.OUTCOME_SUCCESS, created_at=when,
+        )
+        with self._lock:
+            self._last_logins[user.pk] = when
+            self._add(audit)
+
+    def record_failure(self, identifier, ip=''):
+        audit = LoginAudit(
+            identifier=identifier[:254], ip=ip or None,
+            outcome=LoginAudit.OUTCOME_FAILURE, created_at=timezone.now(),
+        )
+        with self._lock:
+            self._add(audit)
+
+    def _add(self, audit):
+        self._audits.append(audit)
+        if self._oldest is None:
+            self._oldest = clock()
+
+    def due(self):
+        with self._lock:
+            if self._oldest is None:
+                return False
+            return len(self) >= self.batch_size or clock() - self._oldest >= self.flush_interval
+
+    def discard(self):
+        with self._lock:
+            self._last_logins, self._oldest = {}, None
+            self._audits.clear()
+
+    def flush(self):
+        '''
+        Write everything buffered so far and return the number of entries written.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                last_logins, audits = self._last_logins, list(self._audits)
+                self._last_logins, self._oldest = {}, None
+                self._audits.clear()
+            if not last_logins and not audits:
+                return 0
+            try:
+                with transaction.atomic():
+                    ## One UPDATE per database the users live on (users.sharding)
+                    sharding.write(last_logins, lambda using, user_ids: CustomUser.objects.db_manager(using).bulk_update(
+                        [CustomUser(pk=pk, last_login=last_logins[pk]) for pk in user_ids], ['last_login'],
+                    ))
+                    LoginAudit.objects.bulk_create(audits)
+            except Exception:
+                logger.exception('Could not write %s login records, retrying with the next flush', len(last_logins) + len(audits))
+                self._restore(last_logins, audits)
+                return 0
+        ## Cached copies of these users still hold the previous last_login
+        invalidate_users(last_logins)
+        return len(last_logins) + len(audits)
+
+    def _restore(self, last_logins, audits):
+        with self._lock:
+            for pk, when in last_logins.items():
+                self._last_logins[pk] = max(when, self._last_logins.get(pk, when))
+            for audit in reversed(audits):
+                audit.pk = None
+                self._audits.appendleft(audit)
+            if self._oldest is None:
+                self._oldest = clock()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ActivityWriter(
+                    settings.ACTIVITY_FLUSH_INTERVAL, settings.ACTIVITY_BATCH_SIZE, settings.ACTIVITY_MAX_PENDING,
+                )
+                atexit.register(_writer.flush)
+    return _writer
+
+
+@receiver(user_logged_in, dispatch_uid='users.activity.buffer_last_login')
+def buffer_last_login(sender, request, user, **kwargs):
+    ## Replaces django.contrib.auth.models.update_last_login, minus the UPDATE (see UsersConfig.ready)
+    user.last_login = timezone.now()
+    get_writer().record_login(user, client_ip(request) if request is not None else '', user.last_login)
+
+
+@receiver(request_finished, dispatch_uid='users.activity.flush_due')
+def flush_due(sender, **kwargs):
+    if _writer is not None and _writer.due():
+        _writer.flush()
+
+
+@receiver(setting_changed)
+def reset_writer(*, setting, **kwargs):
+    global _writer
+    if setting.startswith('ACTIVITY_') and _writer is not None:
+        atexit.unregister(_writer.flush)
+        _writer.discard()
+        _writer = None
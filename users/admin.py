@@ -1,8 +1,236 @@
-from django.contrib import admin
+'''
+CustomUser admin that stays fast with millions of rows.
 
-from users.models import CustomUser
+* The changelist is paged with a (date_joined, id) cursor instead of
+  OFFSET, so every page is an index range scan (see KeysetChangeList).
+* Nothing runs COUNT(*) over the table: the unfiltered total is estimated
+  and filtered results are counted up to a limit (EstimatedCountPaginator).
+* Search matches email/username prefixes as ranges over their Lower()
+  indexes.
+* Actions are single UPDATEs over the selection.
+
+With users.sharding on, users added here go through sharding.create().
+'''
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.utils import build_q_object_from_lookup_parameters
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Q
+from django.db.models.functions import Lower
+from django.db.models.lookups import GreaterThanOrEqual, LessThan
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+from users import sharding
+from users.caching import invalidate_all_users, invalidate_users
+from users.models import CustomUser, new_password_stamp
 
 # Register your models here.
 admin.site.site_header = "WhatBytes Assignment"
 admin.site.site_title = "WhatBytes Assignment"
-admin.site.register(CustomUser)
\ No newline at end of file
+
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+
+
+def estimated_row_count(model, using):
+    '''
+    Rows in ``model``'s table without scanning it.
+    '''
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+            row = cursor.fetchone()
+        ## -1 until the table has been vacuumed or analyzed once
+        if row and row[0] >= 0:
+            return int(row[0])
+    ## Ids are not reused, the highest one is the row count minus deletions
+    return model._default_manager.using(using).aggregate(highest=Max('pk'))['highest'] or 0
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Estimates the unfiltered total and counts filtered lists up to COUNT_LIMIT rows.
+    '''
+    COUNT_LIMIT = 10000
+    is_estimate = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            self.is_estimate = True
+            return estimated_row_count(queryset.model, queryset.db)
+        counted = queryset.order_by()[:self.COUNT_LIMIT + 1].count()
+        if counted > self.COUNT_LIMIT:
+            self.is_estimate = True
+            return self.COUNT_LIMIT
+        return counted
+
+
+def prefix_filter(field, prefix):
+    '''
+    Q for Lower(field) starting with ``prefix`` (lowercase) as a range, which the Lower() index serves.
+
+    Ranges match prefixes under byte-wise collation: SQLite, or Postgres with the C collation.
+    '''
+    expression = Lower(field)
+    condition = Q(GreaterThanOrEqual(expression, prefix))
+    if ord(prefix[-1]) < 0x10FFFF:
+        condition &= Q(LessThan(expression, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+    return condition
+
+
+class IndexedBooleanFieldListFilter(admin.BooleanFieldListFilter):
+    '''
+    Yes/No filter written as ``field IN (value)``.
+
+    For ``field=True`` Django emits a bare ``WHERE field`` (``NOT field``
+    for False), which SQLite cannot match against the flag indexes.
+    '''
+    def queryset(self, request, queryset):
+        parameters = dict(self.used_parameters)
+        values = parameters.pop(self.lookup_kwarg, None)
+        try:
+            if values is not None:
+                queryset = queryset.filter(**{f'{self.field_path}__in': [self.field.to_python(value) for value in values]})
+            return queryset.filter(build_q_object_from_lookup_parameters(parameters))
+        except (ValueError, ValidationError) as error:
+            raise IncorrectLookupParameters(error)
+
+
+class KeysetChangeList(ChangeList):
+    '''
+    Changelist paged by (date_joined, id) cursors.
+
+    ``?after=<cursor>`` lists the rows following that row in the current
+    order, ``?before=<cursor>`` the ones preceding it. Only date_joined is
+    sortable and id follows its direction, so each page is one range scan
+    of customuser_joined_idx (or of the is_active/is_staff variants when
+    filtered) however deep it is.
+    '''
+    def get_queryset(self, request, exclude_parameters=None):
+        ## Cursors are not lookups, and sort/filter links must start again from the top
+        for name in (AFTER_VAR, BEFORE_VAR):
+            self.params.pop(name, None)
+            self.filter_params.pop(name, None)
+        return super().get_queryset(request, exclude_parameters)
+
+    def get_ordering(self, request, queryset):
+        ordering = super().get_ordering(request, queryset)
+        self.descending = not ordering or str(ordering[0]).startswith('-')
+        return ['-date_joined', '-pk'] if self.descending else ['date_joined', 'pk']
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        after, before = self._cursor(request, AFTER_VAR), self._cursor(request, BEFORE_VAR)
+
+        queryset = self.queryset
+        if before is not None:
+            queryset = self._seek(queryset, before, forward=False).reverse()
+        elif after is not None:
+            queryset = self._seek(queryset, after, forward=True)
+        rows = list(queryset[:self.list_per_page + 1])
+        more = len(rows) > self.list_per_page
+        rows = rows[:self.list_per_page]
+        if before is not None:
+            rows.reverse()
+        has_next = more if before is None else True
+        has_previous = after is not None or (before is not None and more)
+
+        self.next_url = self.get_query_string({AFTER_VAR: self._encode(rows[-1])}) if rows and has_next else None
+        self.previous_url = self.get_query_string({BEFORE_VAR: self._encode(rows[0])}) if rows and has_previous else None
+        self.result_count = paginator.count
+        self.count_is_estimate = paginator.is_estimate
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = has_next or has_previous
+        self.paginator = paginator
+
+    def _seek(self, queryset, cursor, forward):
+        joined, pk = cursor
+        ## The redundant bound on date_joined alone is what turns this into an index range
+        if forward == self.descending:
+            return queryset.filter(Q(date_joined__lte=joined), Q(date_joined__lt=joined) | Q(pk__lt=pk))
+        return queryset.filter(Q(date_joined__gte=joined), Q(date_joined__gt=joined) | Q(pk__gt=pk))
+
+    def _cursor(self, request, name):
+        value = request.GET.get(name)
+        if value is None:
+            return None
+        joined, _, pk = value.rpartition('_')
+        try:
+            joined, pk = parse_datetime(joined), int(pk)
+        except ValueError as error:
+            raise IncorrectLookupParameters(error)
+        if joined is None:
+            raise IncorrectLookupParameters(f'Invalid cursor {value!r}')
+        return joined, pk
+
+    def _encode(self, user):
+        return f'{user.date_joined.isoformat()}_{user.pk}'
+
+
+@admin.register(CustomUser)
+class CustomUserAdmin(admin.ModelAdmin):
+    list_display = ('email', 'username', 'date_joined', 'is_active', 'is_staff')
+    list_filter = (('is_active', IndexedBooleanFieldListFilter), ('is_staff', IndexedBooleanFieldListFilter))
+    sortable_by = ('date_joined',)
+    ordering = ('-date_joined',)
+    ## Searched by prefix in get_search_results(), listed here so the search box shows
+    search_fields = ('email', 'username')
+    search_help_text = 'Start of an email address or username'
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+    list_per_page = 100
+    actions = ['deactivate_users', 'force_password_reset']
+    ## Listing every selected id to invalidate it stops being worth it past this
+    INVALIDATE_LIMIT = 1000
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def save_model(self, request, obj, form, change):
+        if change or not sharding.shards():
+            return super().save_model(request, obj, form, change)
+        ## The id comes from the directory, the default database's own sequence would reuse a shard user's
+        has_permissions = bool(form.cleaned_data.get('groups') or form.cleaned_data.get('user_permissions'))
+        sharding.create(obj, has_permissions)
+
+    def get_search_results(self, request, queryset, search_term):
+        prefix = search_term.strip().lower()
+        if not prefix:
+            return queryset, False
+        return queryset.filter(prefix_filter('email', prefix) | prefix_filter('username', prefix)), False
+
+    @admin.action(description='Deactivate selected users', permissions=['change'])
+    def deactivate_users(self, request, queryset):
+        updated = self.update_users(queryset, is_active=False)
+        self.message_user(request, f'Deactivated {updated} user(s).', messages.SUCCESS)
+
+    @admin.action(description='Force a password reset for selected users', permissions=['change'])
+    def force_password_reset(self, request, queryset):
+        ## Unusable password: they can only get back in through forgot password; a new stamp ends their sessions
+        updated = self.update_users(queryset, password=make_password(None), password_stamp=new_password_stamp())
+        self.message_user(request, f'Reset the password of {updated} user(s).', messages.SUCCESS)
+
+    def update_users(self, queryset, **values):
+        '''
+        Apply ``values`` to the selection with one UPDATE and drop the cached copies of those users.
+        '''
+        queryset = queryset.order_by()
+        selected = list(queryset.values_list('pk', flat=True)[:self.INVALIDATE_LIMIT + 1])
+        updated = queryset.update(**values)
+        if len(selected) > self.INVALIDATE_LIMIT:
+            invalidate_all_users()
+        else:
+            invalidate_users(selected)
+        return updated
@@ -0,0 +1,216 @@
+'''
+JSON authentication API, next to the HTML views and sharing their forms,
+backend, rate limits and reset tokens.
+
+    POST api/signup/           email, username, password1, password2     201 {id, email, username}
+    POST api/login/            email_or_username, password                200 token pair
+    POST api/refresh/          refresh_token                              200 new token pair
+    POST api/logout/           refresh_token                              204
+    GET  api/me/               (Bearer)                                   200 {id}
+    POST api/change-password/  (Bearer) old_password, new_password1/2     200 new token pair
+    POST api/forgot-password/  email                                      202
+    POST api/reset-password/   token, new_password, confirm_password      204
+
+Bodies are JSON objects (form encoded bodies work too), errors are
+{"errors": {field: [{"message", "code"}]}} with status 400, or 401 for a
+missing or bad token. Authenticated calls carry "Authorization: Bearer
+<access token>" and are checked without the session, cache or database
+(users.api_tokens); no cookies, so no CSRF either.
+'''
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.http import HttpResponse, JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from users import activity, api_tokens, tokens
+from users.caching import aget_cached_user, normalize_identifier
+from users.custom_auth import EmailOrUsernameModelBackend
+from users.email import asend_forgot_email
+from users.forms.user_form import ChangePasswordForm, CustomUserCreationForm, ForgotPasswordForm, LoginForm, ResetPasswordForm
+from users.ratelimit import client_ip, forgot_password_limiter, login_limiter, too_many_requests
+
+
+class BadRequest(Exception):
+    pass
+
+
+def form_errors(form):
+    return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+
+
+def error(field, message, code, status=400):
+    return JsonResponse({'errors': {field: [{'message': message, 'code': code}]}}, status=status)
+
+
+def token_response(pair, status=200):
+    return JsonResponse({
+        'access_token': pair.access,
+        'token_type': 'Bearer',
+        'expires_in': pair.expires_in,
+        'refresh_token': pair.refresh,
+    }, status=status)
+
+
+async def rate_limited(limiter, request, identifier):
+    '''
+    A 429 response if ``identifier`` is locked out on ``limiter``, else None.
+    '''
+    if not getattr(settings, 'RATELIMIT_ENABLED', True):
+        return None
+    retry_after = await limiter.acheck(client_ip(request), identifier)
+    return None if retry_after is None else too_many_requests(retry_after)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ApiView(View):
+    '''
+    Base of the API views: parses the body into ``self.data`` and, for
+    ``token_required`` views, the bearer token into ``self.user_id``.
+    '''
+    token_required = False
+
+    async def dispatch(self, request, *args, **kwargs):
+        method = request.method.lower()
+        if method not in self.http_method_names or not hasattr(self, method):
+            response = error('method', f'{request.method} is not allowed.', 'method_not_allowed', status=405)
+            response['Allow'] = ', '.join(self._allowed_methods())
+            return response
+        if self.token_required:
+            self.user_id = api_tokens.check_access_token(self.bearer_token(request))
+            if self.user_id is None:
+                response = error('token', 'Missing, invalid or expired access token.', 'invalid_token', status=401)
+                response['WWW-Authenticate'] = 'Bearer'
+                return response
+        try:
+            self.data = self.parse_body(request)
+        except BadRequest as exception:
+            return error('body', str(exception), 'invalid')
+        return await super().dispatch(request, *args, **kwargs)
+
+    def bearer_token(self, request):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        return token.strip() if scheme.lower() == 'bearer' else None
+
+    def parse_body(self, request):
+        if request.method != 'POST':
+            return {}
+        if request.content_type != 'application/json':
+            return request.POST
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            raise BadRequest('The body is not valid JSON.')
+        if not isinstance(data, dict):
+            raise BadRequest('The body must be a JSON object.')
+        ## Forms expect strings, like a form encoded body would give them
+        return {key: value if isinstance(value, str) else json.dumps(value) for key, value in data.items()}
+
+
+class SignupApi(ApiView):
+    async def post(self, request):
+        form = CustomUserCreationForm(self.data)
+        ## Model form uniqueness checks only exist on the sync ORM
+        if not await sync_to_async(form.is_valid)():
+            return form_errors(form)
+        user = await form.asave()
+        if user is None:
+            return form_errors(form)
+        return JsonResponse({'id': user.pk, 'email': user.email, 'username': user.username}, status=201)
+
+
+class LoginApi(ApiView):
+    async def post(self, request):
+        form = LoginForm(self.data)
+        if not form.is_valid():
+            return form_errors(form)
+        email_or_username = form.cleaned_data['email_or_username']
+        identifier = normalize_identifier(email_or_username)
+        limited = await rate_limited(login_limiter, request, identifier)
+        if limited is not None:
+            return limited
+        user = await EmailOrUsernameModelBackend().aauthenticate(
+            request, username=email_or_username, password=form.cleaned_data['password'],
+        )
+        if user is None:
+            await login_limiter.ahit(client_ip(request), identifier)
+            activity.get_writer().record_failure(identifier, client_ip(request))
+            return error('__all__', 'Invalid email/username or password', 'invalid_login', status=401)
+        await login_limiter.areset(client_ip(request), identifier)
+        ## last_login and the audit log, as for session logins (users.activity)
+        user_logged_in.send(sender=type(user), request=request, user=user)
+        return token_response(await api_tokens.aissue(user))
+
+
+class RefreshApi(ApiView):
+    async def post(self, request):
+        pair = await api_tokens.arotate(self.data.get('refresh_token'))
+        if pair is None:
+            return error('refresh_token', 'Invalid, expired or already used refresh token.', 'invalid_token', status=401)
+        return token_response(pair)
+
+
+class LogoutApi(ApiView):
+    async def post(self, request):
+        await api_tokens.arevoke(self.data.get('refresh_token'))
+        return HttpResponse(status=204)
+
+
+class MeApi(ApiView):
+    token_required = True
+
+    async def get(self, request):
+        ## Answered from the token alone, the cheapest authenticated call there is
+        return JsonResponse({'id': self.user_id})
+
+
+class ChangePasswordApi(ApiView):
+    token_required = True
+
+    async def post(self, request):
+        user = await aget_cached_user(self.user_id)
+        if user is None or not user.is_active:
+            return error('token', 'Unknown or inactive user.', 'invalid_token', status=401)
+        form = ChangePasswordForm(user=user, data=self.data)
+        await form.acheck_old_password()
+        if not form.is_valid():
+            return form_errors(form)
+        user = await form.asave()
+        ## The new password stamp already voids them, this also drops the rows
+        await api_tokens.arevoke_user(user)
+        return token_response(await api_tokens.aissue(user))
+
+
+class ForgotPasswordApi(ApiView):
+    async def post(self, request):
+        email = str(self.data.get('email', '')).strip().lower()
+        limited = await rate_limited(forgot_password_limiter, request, email)
+        if limited is not None:
+            return limited
+        ## Every attempt counts, valid or not: each one may cost a reset mail
+        await forgot_password_limiter.ahit(client_ip(request), email)
+        form = ForgotPasswordForm(self.data)
+        await form.alookup_user()
+        if not form.is_valid():
+            return form_errors(form)
+        user = form.user
+        link = f"{settings.BASE_URL}reset-password?token={tokens.make_token(user)}"
+        await asend_forgot_email(request, user.username, user.email, link)
+        return JsonResponse({'detail': 'We have sent you a link to reset your password.'}, status=202)
+
+
+class ResetPasswordApi(ApiView):
+    async def post(self, request):
+        user = await tokens.aget_user(self.data.get('token'))
+        if user is None:
+            return error('token', 'Invalid or expired reset token.', 'invalid_token')
+        form = ResetPasswordForm(data=self.data, user=user)
+        if not form.is_valid():
+            return form_errors(form)
+        await form.asave()
+        await api_tokens.arevoke_user(user)
+        return HttpResponse(status=204)
@@ -0,0 +1,124 @@
+'''
+Tokens of the JSON API (users.api).
+
+Access tokens are stateless and short lived (API_ACCESS_TOKEN_TTL):
+
+    <user id, base36>-<expires at, base36>-<signature>
+
+Checking one is an HMAC, with no session, cache or database lookup, so a
+deactivated user or a changed password only stops them at expiry.
+
+Refresh tokens are random, long lived (API_REFRESH_TOKEN_TTL) and stored
+as RefreshToken rows. Every refresh rotates them: the presented token is
+marked used and a new one of the same family is issued. Presenting a used
+token again means two parties hold it, so the whole family is revoked.
+They are also bound to the user's password stamp: a password change or
+reset ends every refresh token of the user.
+'''
+import hashlib
+import secrets
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import base36_to_int, int_to_base36
+
+from users import sharding
+from users.models import RefreshToken
+
+KEY_SALT = 'users.api_tokens.AccessToken'
+## Longer inputs cannot be one of our access tokens, don't spend an HMAC on them
+MAX_TOKEN_LENGTH = 64
+
+TokenPair = namedtuple('TokenPair', ['access', 'refresh', 'expires_in'])
+
+
+def _sign(payload, secret):
+    return salted_hmac(KEY_SALT, payload, secret=secret, algorithm='sha256').hexdigest()[:32]
+
+
+def make_access_token(user_id, expires=None):
+    expires = int(time.time()) + settings.API_ACCESS_TOKEN_TTL if expires is None else expires
+    payload = f'{int_to_base36(user_id)}-{int_to_base36(expires)}'
+    return f'{payload}-{_sign(payload, settings.SECRET_KEY)}'
+
+
+def check_access_token(token):
+    '''
+    The user id of a genuine, unexpired access token, else None. No queries.
+    '''
+    if not token or len(token) > MAX_TOKEN_LENGTH:
+        return None
+    try:
+        uid, expires, signature = token.split('-')
+        user_id, expires = base36_to_int(uid), base36_to_int(expires)
+    except ValueError:
+        return None
+    payload = token.rpartition('-')[0]
+    keys = [settings.SECRET_KEY, *settings.SECRET_KEY_FALLBACKS]
+    if not any(constant_time_compare(signature, _sign(payload, secret)) for secret in keys):
+        return None
+    if time.time() >= expires:
+        return None
+    return user_id
+
+
+def _digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def aissue(user, family=None):
+    '''
+    A new access token and refresh token for ``user``, the refresh token in ``family`` or a new one.
+    '''
+    refresh = secrets.token_urlsafe(32)
+    await RefreshToken.objects.acreate(
+        user=user,
+        family=family or secrets.token_hex(16),
+        digest=_digest(refresh),
+        password_stamp=user.password_stamp,
+        expires_at=timezone.now() + timedelta(seconds=settings.API_REFRESH_TOKEN_TTL),
+    )
+    return TokenPair(make_access_token(user.pk), refresh, settings.API_ACCESS_TOKEN_TTL)
+
+
+async def arotate(refresh):
+    '''
+    Trade a refresh token for a new pair, or None if it is unknown, expired, used or revoked.
+    '''
+    if not refresh or len(refresh) > MAX_TOKEN_LENGTH:
+        return None
+    tokens = RefreshToken.objects.filter(digest=_digest(refresh))
+    ## Users on shards (users.sharding) are not in this database to join
+    sharded = bool(sharding.shards())
+    token = await (tokens if sharded else tokens.select_related('user')).afirst()
+    now = timezone.now()
+    if token is None or token.expires_at <= now:
+        return None
+    ## Only one of two concurrent refreshes with the same token claims it
+    claimed = await RefreshToken.objects.filter(pk=token.pk, used_at__isnull=True).aupdate(used_at=now)
+    user = await sharding.aget_user(token.user_id) if sharded else token.user
+    if not claimed or user is None or not user.is_active or user.password_stamp != token.password_stamp:
+        await RefreshToken.objects.filter(family=token.family).adelete()
+        return None
+    return await aissue(user, token.family)
+
+
+async def arevoke(refresh):
+    '''
+    End the family of a refresh token (logout). Returns whether the token was known.
+    '''
+    if not refresh or len(refresh) > MAX_TOKEN_LENGTH:
+        return False
+    family = await RefreshToken.objects.filter(digest=_digest(refresh)).values_list('family', flat=True).afirst()
+    if family is None:
+        return False
+    await RefreshToken.objects.filter(family=family).adelete()
+    return True
+
+
+async def arevoke_user(user):
+    await RefreshToken.objects.filter(user=user).adelete()
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "users"
+
+    def ready(self):
+        from django.contrib.auth.signals import user_logged_in
+
+        from . import activity, cleanup, db, routers, sharding, signals  # noqa: F401
+
+        ## users.activity buffers the last_login update instead
+        user_logged_in.disconnect(dispatch_uid='update_last_login')
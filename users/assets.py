@@ -0,0 +1,251 @@
+'''
+Vendored front-end assets, cut down to what the templates use.
+
+``manage.py vendor_assets`` reads Bootstrap and Font Awesome from their
+XStatic packages and writes them to users/static/users/vendor/:
+
+* CSS rules whose selectors need a class no template (or form widget)
+  uses are dropped, along with @keyframes and @font-face nobody refers to.
+  The sources are already minified, kept rules are written back as is.
+* The icon font is subset to the glyphs left in the CSS (needs fontTools
+  and brotli; without them the full font is copied).
+
+Bootstrap's JavaScript is not vendored: the templates only use its
+collapse and alert dismiss behaviours, which users/static/users/js/ui.js
+implements without jQuery or Popper.
+'''
+import re
+import shutil
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent
+VENDOR_DIR = APP_DIR / 'static' / 'users' / 'vendor'
+
+## Classes only ever added at runtime, by ui.js or the browser
+SAFELIST = {'show', 'collapsed', 'fade'}
+
+## Sources of the class names the CSS is purged against
+TEMPLATE_DIRS = [APP_DIR / 'templates']
+PYTHON_SOURCES = [APP_DIR / 'forms']
+SCRIPT_SOURCES = [APP_DIR / 'static' / 'users' / 'js']
+
+CLASS_ATTRIBUTE = re.compile(r'''class\s*=\s*["']([^"']*)["']''')
+WIDGET_CLASS = re.compile(r'''['"]class['"]\s*:\s*['"]([^'"]*)['"]''')
+CLASS_LIST_CALL = re.compile(r'''classList\.\w+\(\s*['"]([\w-]+)['"]''')
+SELECTOR_CLASS = re.compile(r'\.(-?[_a-zA-Z][\w-]*)')
+NEGATION = re.compile(r':not\([^)]*\)')
+LICENSE_COMMENT = re.compile(r'/\*!.*?\*/', re.S)
+COMMENT = re.compile(r'/\*.*?\*/', re.S)
+
+
+def used_classes():
+    '''
+    Every class name mentioned in templates, form widgets and our scripts.
+    '''
+    classes = set(SAFELIST)
+    sources = [
+        (TEMPLATE_DIRS, '*.html', [CLASS_ATTRIBUTE]),
+        (PYTHON_SOURCES, '*.py', [WIDGET_CLASS]),
+        (SCRIPT_SOURCES, '*.js', [CLASS_LIST_CALL]),
+    ]
+    for directories, pattern, expressions in sources:
+        for directory in directories:
+            for path in Path(directory).rglob(pattern):
+                text = path.read_text(encoding='utf-8')
+                for expression in expressions:
+                    for match in expression.findall(text):
+                        classes.update(name for name in match.split() if '{' not in name and '%' not in name)
+    return classes
+
+
+def parse_css(css):
+    '''
+    Split a stylesheet into (prelude, body) pairs; body is None for statements like @charset.
+    '''
+    blocks, position, length = [], 0, len(css)
+    while position < length:
+        while position < length and css[position].isspace():
+            position += 1
+        if position >= length:
+            break
+        start = position
+        quote = None
+        while position < length:
+            char = css[position]
+            if quote:
+                if char == '\\':
+                    position += 1
+                elif char == quote:
+                    quote = None
+            elif char in '"\'':
+                quote = char
+            elif char in '{;':
+                break
+            position += 1
+        prelude = css[start:position].strip()
+        if position >= length or css[position] == ';':
+            blocks.append((prelude, None))
+            position += 1
+            continue
+        depth, body_start = 1, position + 1
+        position += 1
+        while position < length and depth:
+            char = css[position]
+            if quote:
+                if char == '\\':
+                    position += 1
+                elif char == quote:
+                    quote = None
+            elif char in '"\'':
+                quote = char
+            elif char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+            position += 1
+        blocks.append((prelude, css[body_start:position - 1]))
+    return blocks
+
+
+def split_selectors(prelude):
+    selectors, depth, current = [], 0, ''
+    for char in prelude:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and not depth:
+            selectors.append(current)
+            current = ''
+        else:
+            current += char
+    selectors.append(current)
+    return [selector.strip() for selector in selectors if selector.strip()]
+
+
+def selector_is_used(selector, classes):
+    required = SELECTOR_CLASS.findall(NEGATION.sub('', selector))
+    return all(name in classes for name in required)
+
+
+def _purge_blocks(blocks, classes):
+    kept = []
+    for prelude, body in blocks:
+        if body is None:
+            kept.append(prelude + ';')
+        elif prelude.startswith('@media') or prelude.startswith('@supports'):
+            inner = [
+                block if isinstance(block, str) else block[0] + '{' + block[1] + '}'
+                for block in _purge_blocks(parse_css(body), classes)
+            ]
+            if inner:
+                kept.append(prelude + '{' + ''.join(inner) + '}')
+        elif prelude.startswith('@'):
+            ## @font-face and @keyframes are decided once we know what survived
+            kept.append((prelude, body))
+        else:
+            selectors = [selector for selector in split_selectors(prelude) if selector_is_used(selector, classes)]
+            if selectors:
+                kept.append(','.join(selectors) + '{' + body + '}')
+    return kept
+
+
+def purge_css(css, classes, fonts=None):
+    '''
+    Drop the rules of ``css`` that no element using ``classes`` can match.
+
+    ``fonts`` lists the font files (without extension) whose @font-face
+    rules are kept; None keeps every @font-face still referenced.
+    '''
+    licenses = LICENSE_COMMENT.findall(css)
+    kept = _purge_blocks(parse_css(COMMENT.sub('', css)), classes)
+    rules = ''.join(block for block in kept if isinstance(block, str))
+
+    output = []
+    for block in kept:
+        if isinstance(block, str):
+            output.append(block)
+            continue
+        prelude, body = block
+        if prelude.startswith('@keyframes') or prelude.startswith('@-webkit-keyframes'):
+            name = prelude.split(None, 1)[1].strip()
+            if re.search(rf'(?<![\w-]){re.escape(name)}(?![\w-])', rules):
+                output.append(prelude + '{' + body + '}')
+        elif prelude == '@font-face':
+            if fonts is None or any(font in body for font in fonts):
+                output.append(prelude + '{' + body + '}')
+        else:
+            output.append(prelude + '{' + body + '}')
+    return '\n'.join(licenses) + '\n' + ''.join(output) + '\n'
+
+
+def used_codepoints(css):
+    '''
+    Icon codepoints left in the CSS, from content:"\\f06e" declarations.
+    '''
+    return {int(code, 16) for code in re.findall(r'content:\s*"\\([0-9a-fA-F]{4,6})"', css)}
+
+
+def subset_font(source, destination, codepoints):
+    '''
+    Write ``source`` reduced to ``codepoints`` as WOFF2. Returns False if fontTools is missing.
+    '''
+    try:
+        from fontTools import subset
+    except ImportError:
+        return False
+    options = subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    font = subset.load_font(str(source), options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=codepoints)
+    subsetter.subset(font)
+    subset.save_font(font, str(destination), options)
+    return True
+
+
+def _xstatic(module_name):
+    import importlib
+
+    return importlib.import_module(f'xstatic.pkg.{module_name}')
+
+
+def vendor_bootstrap(classes, stdout):
+    package = _xstatic('bootstrap')
+    source = Path(package.BASE_DIR) / 'css' / 'bootstrap.min.css'
+    destination = VENDOR_DIR / 'bootstrap' / 'css' / 'bootstrap.min.css'
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    css = purge_css(source.read_text(encoding='utf-8'), classes)
+    destination.write_text(css, encoding='utf-8')
+    stdout.write(f'bootstrap {package.VERSION}: {source.stat().st_size} -> {len(css.encode())} bytes')
+
+
+def vendor_font_awesome(classes, stdout):
+    package = _xstatic('font_awesome')
+    base = Path(package.BASE_DIR)
+    target = VENDOR_DIR / 'fontawesome'
+    (target / 'css').mkdir(parents=True, exist_ok=True)
+    (target / 'webfonts').mkdir(parents=True, exist_ok=True)
+
+    source = base / 'css' / 'all.min.css'
+    css = purge_css(source.read_text(encoding='utf-8'), classes, fonts=['fa-solid-900'])
+    ## Every browser we support reads WOFF2, skip the TrueType fallback
+    css = re.sub(r',\s*url\([^)]*\.ttf\)\s*format\("truetype"\)', '', css)
+    (target / 'css' / 'fontawesome.min.css').write_text(css, encoding='utf-8')
+    stdout.write(f'font awesome {package.VERSION}: {source.stat().st_size} -> {len(css.encode())} bytes')
+
+    font = base / 'webfonts' / 'fa-solid-900.woff2'
+    destination = target / 'webfonts' / 'fa-solid-900.woff2'
+    if subset_font(font, destination, used_codepoints(css)):
+        stdout.write(f'fa-solid-900.woff2: {font.stat().st_size} -> {destination.stat().st_size} bytes')
+    else:
+        shutil.copyfile(font, destination)
+        stdout.write('fontTools is not installed, copied the full icon font')
+    shutil.copyfile(base / 'LICENSE.txt', target / 'LICENSE.txt')
+
+
+def vendor_all(stdout):
+    classes = used_classes()
+    vendor_bootstrap(classes, stdout)
+    vendor_font_awesome(classes, stdout)
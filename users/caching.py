@@ -0,0 +1,199 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+MISSING_GENERATION_KEY = 'users:missing-generation'
+
+
+class MissingIdentifiers:
+    '''
+    Login identifiers (normalized) that recently matched no user.
+
+    Kept in the default cache, so every worker sees the same entries and a
+    signup or an email/username change (users.signals) clears them for all
+    of them. An entry holds the generation it was made in; ``clear()``
+    starts a new generation, which makes every older entry unreachable.
+    '''
+    def _key(self, identifier):
+        ## Identifiers are user input: hashed, they are safe as memcached keys
+        return f'users:missing:{hashlib.sha256(identifier.encode()).hexdigest()[:32]}'
+
+    def _found(self, key, values):
+        return key in values and values[key] == values.get(MISSING_GENERATION_KEY)
+
+    def __contains__(self, identifier):
+        key = self._key(identifier)
+        return self._found(key, cache.get_many([key, MISSING_GENERATION_KEY]))
+
+    async def acontains(self, identifier):
+        key = self._key(identifier)
+        return self._found(key, await cache.aget_many([key, MISSING_GENERATION_KEY]))
+
+    def set(self, identifier):
+        generation = cache.get(MISSING_GENERATION_KEY) or self.clear()
+        cache.set(self._key(identifier), generation, settings.AUTH_NEGATIVE_CACHE_TTL)
+
+    async def aset(self, identifier):
+        generation = await cache.aget(MISSING_GENERATION_KEY) or await self.aclear()
+        await cache.aset(self._key(identifier), generation, settings.AUTH_NEGATIVE_CACHE_TTL)
+
+    def discard(self, *identifiers):
+        cache.delete_many([self._key(identifier) for identifier in identifiers])
+
+    def clear(self):
+        generation = time.time_ns()
+        cache.set(MISSING_GENERATION_KEY, generation, None)
+        return generation
+
+    async def aclear(self):
+        generation = time.time_ns()
+        await cache.aset(MISSING_GENERATION_KEY, generation, None)
+        return generation
+
+
+missing_identifiers = MissingIdentifiers()
+
+
+def normalize_identifier(identifier):
+    '''
+    Emails compare case-insensitively, usernames are matched exactly.
+    '''
+    if '@' in identifier:
+        return identifier.strip().lower()
+    return identifier
+
+
+## Cross-request cache of authenticated users, see EmailOrUsernameModelBackend.get_user().
+## Entries are keyed on a per-user version token plus a generation shared by all users;
+## replacing either on save/logout/bulk changes makes every older entry unreachable,
+## even if the cache evicted the token itself.
+
+USER_GENERATION_KEY = 'users:user-generation'
+
+
+def _user_version_key(user_id):
+    return f'users:user-version:{user_id}'
+
+
+def user_cache_key(user_id):
+    """
+    Key of the current cache entry for ``user_id``.
+
+    Take the key before reading the database: if the user is invalidated
+    meanwhile, the stale row is stored under a key nobody asks for anymore.
+    """
+    version_key = _user_version_key(user_id)
+    tokens = cache.get_many([version_key, USER_GENERATION_KEY])
+    version = tokens.get(version_key) or invalidate_user(user_id)
+    generation = tokens.get(USER_GENERATION_KEY) or invalidate_all_users()
+    return f'users:user:{user_id}:{generation}.{version}'
+
+
+async def auser_cache_key(user_id):
+    version_key = _user_version_key(user_id)
+    tokens = await cache.aget_many([version_key, USER_GENERATION_KEY])
+    version = tokens.get(version_key) or await ainvalidate_user(user_id)
+    generation = tokens.get(USER_GENERATION_KEY) or await ainvalidate_all_users()
+    return f'users:user:{user_id}:{generation}.{version}'
+
+
+def invalidate_user(user_id):
+    version = time.time_ns()
+    cache.set(_user_version_key(user_id), version, None)
+    return version
+
+
+async def ainvalidate_user(user_id):
+    version = time.time_ns()
+    await cache.aset(_user_version_key(user_id), version, None)
+    return version
+
+
+def invalidate_users(user_ids):
+    ## One round trip for a whole batch
+    version = time.time_ns()
+    cache.set_many({_user_version_key(user_id): version for user_id in user_ids}, None)
+
+
+def invalidate_all_users():
+    ## For changes to more users than it is worth listing
+    generation = time.time_ns()
+    cache.set(USER_GENERATION_KEY, generation, None)
+    return generation
+
+
+async def ainvalidate_all_users():
+    generation = time.time_ns()
+    await cache.aset(USER_GENERATION_KEY, generation, None)
+    return generation
+
+
+## Permission sets (users.permissions) live under the user's tokens plus a permission generation,
+## replaced when group permissions or the permissions themselves change
+
+PERMISSION_GENERATION_KEY = 'users:permission-generation'
+
+
+def permission_cache_key(user_id):
+    '''
+    (key of the cached permission set of ``user_id``, current permission generation).
+    '''
+    version_key = _user_version_key(user_id)
+    tokens = cache.get_many([version_key, USER_GENERATION_KEY, PERMISSION_GENERATION_KEY])
+    version = tokens.get(version_key) or invalidate_user(user_id)
+    generation = tokens.get(USER_GENERATION_KEY) or invalidate_all_users()
+    permissions = tokens.get(PERMISSION_GENERATION_KEY) or invalidate_all_permissions()
+    return f'users:perms:{user_id}:{generation}.{permissions}.{version}', permissions
+
+
+def invalidate_all_permissions():
+    generation = time.time_ns()
+    cache.set(PERMISSION_GENERATION_KEY, generation, None)
+    return generation
+
+
+def get_cached_user(user_id):
+    '''
+    The user with ``user_id`` from the cache, else the database (then cached).
+    Straight from the database when AUTH_USER_CACHE_TTL is 0.
+    '''
+    from django.contrib.auth import get_user_model
+
+    from users import sharding
+
+    if not settings.AUTH_USER_CACHE_TTL:
+        UserModel = get_user_model()
+        return UserModel._default_manager.db_manager(sharding.db_for_user(user_id)).filter(pk=user_id).first()
+    key = user_cache_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.db_manager(sharding.db_for_user(user_id)).get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        cache.set(key, user, settings.AUTH_USER_CACHE_TTL)
+    return user
+
+
+async def aget_cached_user(user_id):
+    from django.contrib.auth import get_user_model
+
+    from users import sharding
+
+    if not settings.AUTH_USER_CACHE_TTL:
+        UserModel = get_user_model()
+        return await UserModel._default_manager.db_manager(await sharding.adb_for_user(user_id)).filter(pk=user_id).afirst()
+    key = await auser_cache_key(user_id)
+    user = await cache.aget(key)
+    if user is None:
+        UserModel = get_user_model()
+        try:
+            user = await UserModel._default_manager.db_manager(await sharding.adb_for_user(user_id)).aget(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        await cache.aset(key, user, settings.AUTH_USER_CACHE_TTL)
+    return user
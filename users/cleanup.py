@@ -0,0 +1,192 @@
+'''
+Incremental garbage collection of expired rows.
+
+    sessions   django_session rows past expire_date (db and cached_db session engines)
+    audit      LoginAudit rows older than LOGIN_AUDIT_RETENTION_DAYS
+    mail       sent and dead OutboundEmail rows, which hold password reset
+               links, older than MAIL_RETENTION_DAYS
+    refresh    expired API refresh tokens (users.api_tokens)
+
+Unlike ``clearsessions``, which deletes everything expired in one
+statement and holds the SQLite write lock for as long as that takes,
+collect() deletes CLEANUP_BATCH_SIZE rows at a time, oldest first along an
+index, each batch in its own short transaction with CLEANUP_BATCH_PAUSE
+seconds between batches for other writers, and stops once
+CLEANUP_TIME_BUDGET seconds are spent. Whatever is left goes at the next
+run.
+
+Runs from ``manage.py collect_garbage`` (cron, or --loop), or in process
+with CLEANUP_IN_PROCESS = True: a thread started after the first request
+runs every CLEANUP_INTERVAL seconds. Several processes collecting at once
+only delete the same rows twice, which is harmless.
+'''
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.signals import request_finished
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import LoginAudit, OutboundEmail, RefreshToken
+
+logger = logging.getLogger(__name__)
+
+## Tests replace this to stop the budget from running out
+clock = time.monotonic
+
+DB_SESSION_ENGINES = ('django.contrib.sessions.backends.db', 'django.contrib.sessions.backends.cached_db')
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def expired_sessions(now):
+    if settings.SESSION_ENGINE not in DB_SESSION_ENGINES:
+        return None
+    ## django_session.expire_date has an index (db_index=True on Session)
+    return Session.objects.filter(expire_date__lt=now).order_by('expire_date')
+
+
+def old_audits(now):
+    if not settings.LOGIN_AUDIT_RETENTION_DAYS:
+        return None
+    cutoff = now - timedelta(days=settings.LOGIN_AUDIT_RETENTION_DAYS)
+    return LoginAudit.objects.filter(created_at__lt=cutoff).order_by('created_at')
+
+
+def old_mail(now):
+    if not settings.MAIL_RETENTION_DAYS:
+        return None
+    cutoff = now - timedelta(days=settings.MAIL_RETENTION_DAYS)
+    ## Through outboundemail_cleanup_idx, one range per status
+    return OutboundEmail.objects.filter(
+        status__in=[OutboundEmail.STATUS_SENT, OutboundEmail.STATUS_DEAD], created_at__lt=cutoff,
+    ).order_by('created_at')
+
+
+def expired_refresh_tokens(now):
+    return RefreshToken.objects.filter(expires_at__lt=now).order_by('expires_at')
+
+
+## Name -> function of the current time returning the rows to delete, oldest first (None: nothing to do)
+TARGETS = {
+    'sessions': expired_sessions,
+    'audit': old_audits,
+    'mail': old_mail,
+    'refresh': expired_refresh_tokens,
+}
+
+
+class Report:
+    def __init__(self):
+        self.deleted = {}
+        self.batches = 0
+        self.elapsed = 0.0
+        self.finished = True
+
+    @property
+    def total(self):
+        return sum(self.deleted.values())
+
+    @property
+    def rate(self):
+        '''
+        Rows reclaimed per second.
+        '''
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        counts = ', '.join(f'{count} {name}' for name, count in self.deleted.items())
+        state = '' if self.finished else ', out of time budget'
+        return f'Deleted {counts or "nothing"} in {self.batches} batch(es), {self.elapsed:.2f}s ({self.rate:.0f} rows/s{state})'
+
+
+def delete_batch(queryset, batch_size):
+    '''
+    Delete up to ``batch_size`` of the oldest rows of ``queryset`` and return how many went.
+    '''
+    ## Two indexed statements: a LIMIT inside DELETE ... IN (...) is not portable
+    keys = list(queryset.values_list('pk', flat=True)[:batch_size])
+    if not keys:
+        return 0
+    deleted, _ = queryset.model._default_manager.filter(pk__in=keys).delete()
+    return deleted
+
+
+def collect(targets=None, batch_size=None, budget=None, pause=None):
+    '''
+    Delete expired rows of ``targets`` (names of TARGETS, default all) within ``budget`` seconds.
+    '''
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    budget = settings.CLEANUP_TIME_BUDGET if budget is None else budget
+    pause = settings.CLEANUP_BATCH_PAUSE if pause is None else pause
+    report = Report()
+    started = clock()
+    deadline = started + budget
+    now = timezone.now()
+    for name in targets or TARGETS:
+        queryset = TARGETS[name](now)
+        report.deleted[name] = 0
+        while queryset is not None:
+            if clock() >= deadline:
+                report.finished = False
+                break
+            deleted = delete_batch(queryset, batch_size)
+            report.deleted[name] += deleted
+            report.batches += 1
+            if deleted < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        if not report.finished:
+            break
+    report.elapsed = clock() - started
+    return report
+
+
+class CleanupWorker(threading.Thread):
+    '''
+    Background thread running collect() every CLEANUP_INTERVAL seconds.
+    '''
+    def __init__(self, interval=None):
+        super().__init__(name='cleanup-worker', daemon=True)
+        self.interval = interval or settings.CLEANUP_INTERVAL
+        self._stopped = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                report = collect()
+                if report.total:
+                    logger.info('%s', report)
+            except Exception:
+                logger.exception('Cleanup run failed')
+            finally:
+                close_old_connections()
+            self._stopped.wait(self.interval)
+
+
+def ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = CleanupWorker()
+            _worker.start()
+        return _worker
+
+
+@receiver(request_finished, dispatch_uid='users.cleanup.start_worker')
+def start_worker(sender, **kwargs):
+    ## Started by the first request rather than at import, so management commands never run it
+    if settings.CLEANUP_IN_PROCESS and (_worker is None or not _worker.is_alive()):
+        ensure_worker()
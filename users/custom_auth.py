@@ -1,27 +1,98 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
-from users.models import CustomUser
+from django.db.models.functions import Lower
+from django.db.models.lookups import Exact
+
+from users import permissions, sharding
+from users.caching import get_cached_user, missing_identifiers, normalize_identifier
+from users.routers import replica_reads
+
+## Columns needed to verify a password and establish a session
+LOGIN_FIELDS = ('id', 'password', 'password_stamp', 'username', 'email', 'is_active', 'last_login')
+
+
 class EmailOrUsernameModelBackend(ModelBackend):
     """
     This is a ModelBacked that allows authentication
     with either a username or an email address.
-    
+
+    Emails are matched case-insensitively through the LOWER(email) index,
+    usernames through their unique index. Identifiers that matched nobody
+    are remembered for a short while so repeated failed logins skip the DB.
     """
-    def authenticate(self, username=None, password=None):
-        if '@' in username:
-            kwargs = {'email': username}
-        else:
-            kwargs = {'username': username}
-        try:
-            user = get_user_model().objects.get(**kwargs)
-            if user.check_password(password):
-                return user
-        except CustomUser.DoesNotExist:
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None or password is None:
             return None
+        identifier = normalize_identifier(username)
+        if identifier in missing_identifiers:
+            return None
+
+        user = self.get_login_user(identifier)
+        if user is None:
+            missing_identifiers.set(identifier)
+            return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        """
+        Async counterpart of authenticate(): async ORM plus the hashing pool.
+        """
+        if username is None or password is None:
+            return None
+        identifier = normalize_identifier(username)
+        if await missing_identifiers.acontains(identifier):
+            return None
+
+        using = await sharding.adb_for_identifier(identifier)
+        matches = [user async for user in self._login_queryset(identifier, using)]
+        user = self._pick_login_user(identifier, matches)
+        if user is None:
+            await missing_identifiers.aset(identifier)
+            return None
+        if await user.acheck_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
+
+    def get_login_user(self, identifier):
+        """
+        Fetch the user for an already normalized identifier with one indexed query
+        (two with users.sharding: the directory, then the user's shard).
+        """
+        using = sharding.db_for_identifier(identifier)
+        return self._pick_login_user(identifier, list(self._login_queryset(identifier, using)))
+
+    def _login_queryset(self, identifier, using=None):
+        users = get_user_model()._default_manager.db_manager(using).only(*LOGIN_FIELDS)
+        if '@' in identifier:
+            return users.filter(Exact(Lower('email'), identifier))[:2]
+        return users.filter(username=identifier)[:1]
+
+    def _pick_login_user(self, identifier, matches):
+        if len(matches) > 1:
+            ## Legacy rows that only differ by case: fall back to an exact match
+            matches = [user for user in matches if user.email == identifier]
+        return matches[0] if len(matches) == 1 else None
+
+    def get_user(self, user_id):
+        """
+        Load the session user, served from the cache on warm requests
+        and from a read replica, when there are some, on cold ones.
+        """
+        with replica_reads():
+            user = get_cached_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
 
-    def get_user(self, username):
-        try:
-            return get_user_model().objects.get(pk=username)
-        except get_user_model().DoesNotExist:
-            return None
\ No newline at end of file
+    def get_all_permissions(self, user_obj, obj=None):
+        """
+        ModelBackend's, served from the cross-request cache of users.permissions.
+        """
+        if not settings.AUTH_PERMISSION_CACHE_TTL:
+            return super().get_all_permissions(user_obj, obj)
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            user_obj._perm_cache = permissions.get_permissions(user_obj)
+        return user_obj._perm_cache
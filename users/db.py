@@ -0,0 +1,25 @@
+'''
+Per-connection database tuning, see DATABASE_PROFILE in the settings.
+'''
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    '''
+    Run SQLITE_PRAGMAS on every new SQLite connection.
+
+    journal_mode is stored in the database file, the other pragmas only
+    last as long as the connection, hence doing this on connect.
+    '''
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    if connection.is_in_memory_db():
+        ## In-memory databases (the test runner's) have no journal file to tune
+        pragmas = {name: value for name, value in pragmas.items() if name not in ('journal_mode', 'mmap_size')}
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
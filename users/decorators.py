@@ -0,0 +1,66 @@
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.contrib.auth.views import redirect_to_login
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from users.rendering import apage_etag
+from users.routers import replica_reads
+
+
+def alogin_required(login_url=None):
+    '''
+    login_required() for async views: resolves the user with request.auser().
+    '''
+    def decorator(view_func):
+        @wraps(view_func)
+        async def _wrapper_view(request, *args, **kwargs):
+            user = await request.auser()
+            if user.is_authenticated:
+                return await view_func(request, *args, **kwargs)
+            return redirect_to_login(request.get_full_path(), login_url)
+        return _wrapper_view
+    return decorator
+
+
+def use_replicas(view_func):
+    '''
+    Serve the reads of a read-only view from a replica (see users.routers).
+    '''
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def _wrapper_view(request, *args, **kwargs):
+            with replica_reads():
+                return await view_func(request, *args, **kwargs)
+    else:
+        @wraps(view_func)
+        def _wrapper_view(request, *args, **kwargs):
+            with replica_reads():
+                return view_func(request, *args, **kwargs)
+    return _wrapper_view
+
+
+def conditional_page(view_func):
+    '''
+    Answer a GET or HEAD of a logged in user's page with 304 when their
+    If-None-Match still matches users.rendering.apage_etag(), without
+    calling the view.
+
+    The page is only for the user: private, and revalidated every time.
+    '''
+    @wraps(view_func)
+    async def _wrapper_view(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await view_func(request, *args, **kwargs)
+        etag = await apage_etag(request, await request.auser())
+        if etag is None:
+            return await view_func(request, *args, **kwargs)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = await view_func(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    return _wrapper_view
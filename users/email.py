@@ -1,21 +1,30 @@
-from .models import CustomUser
-from django.contrib.sites.shortcuts import get_current_site
 from django.template.loader import render_to_string
-from django.core.mail import EmailMessage
 from django.conf import settings
 
-def send_forgot_email(request,username, email, link):
-    # Sending email to user for password reset
-    subject = "Reset Password"
-    message = render_to_string('users/reset_forgot_password.html', {
+from . import mail_queue
+from .perf import track
+
+def _render_forgot_email(request, username, link):
+    return render_to_string('users/reset_forgot_password.html', {
         'request': request,
         'link':link,
         'user': username,
+        'username': username,
     })
-    email = EmailMessage(
-        subject, message,settings.EMAIL_HOST_USER,to=[email]
-    )
-    email.content_subtype = 'html'
-    email.send()
-    print(email)
-    return True
\ No newline at end of file
+
+def send_forgot_email(request,username, email, link):
+    # Queue the password reset email, delivery happens in the mail queue worker
+    with track('mail'):
+        message = _render_forgot_email(request, username, link)
+        mail_queue.enqueue(
+            "Reset Password", message, [email], from_email=settings.EMAIL_HOST_USER, content_subtype='html'
+        )
+    return True
+
+async def asend_forgot_email(request, username, email, link):
+    with track('mail'):
+        message = _render_forgot_email(request, username, link)
+        await mail_queue.aenqueue(
+            "Reset Password", message, [email], from_email=settings.EMAIL_HOST_USER, content_subtype='html'
+        )
+    return True
@@ -1,10 +1,12 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm,SetPasswordForm
+from .. import sharding
 from ..models import CustomUser
 from django.contrib.auth.forms import PasswordChangeForm
 from django.db.models import Q
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
+from django.db import IntegrityError
 
 class CustomUserCreationForm(UserCreationForm):
     email = forms.EmailField(
@@ -24,6 +26,34 @@ class CustomUserCreationForm(UserCreationForm):
         model = CustomUser
         fields = ('email', 'username', 'password1', 'password2')
 
+    def clean_username(self):
+        ## UserCreationForm's case-insensitive check happens in validate_unique(), with the email one
+        return self.cleaned_data.get('username')
+
+    def validate_unique(self):
+        '''
+        Check email and username in one query instead of one per unique field.
+        '''
+        taken = CustomUser.objects.taken_identifiers(self.cleaned_data.get('email'), self.cleaned_data.get('username'))
+        self._add_taken_errors(taken)
+
+    def _add_taken_errors(self, taken):
+        for field in taken:
+            self.add_error(field, self.instance.unique_error_message(CustomUser, [field]))
+
+    async def asave(self):
+        '''
+        Create the user, or return None with the form errors set when a
+        concurrent signup took the email or username after validation.
+        '''
+        email, username = self.cleaned_data['email'], self.cleaned_data['username']
+        try:
+            return await CustomUser.objects.acreate_user(email, username, self.cleaned_data['password1'])
+        except IntegrityError:
+            taken = await CustomUser.objects.ataken_identifiers(email, username)
+            self._add_taken_errors(taken or ['username'])
+            return None
+
 class LoginForm(forms.Form):
     email_or_username = forms.CharField(
         widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Enter email or Username'})
@@ -46,14 +76,54 @@ class ChangePasswordForm(PasswordChangeForm):
         widget=forms.PasswordInput(attrs={'class': 'form-control', 'autocomplete': 'new-password'}),
     )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.old_password_correct = None
+
+    async def acheck_old_password(self):
+        '''
+        Verify the old password on the hashing pool so is_valid() does not hash.
+        '''
+        old_password = self.fields['old_password'].to_python(self.data.get('old_password'))
+        self.old_password_correct = await self.user.acheck_password(old_password)
+
+    def clean_old_password(self):
+        if self.old_password_correct is None:
+            return super().clean_old_password()
+        if not self.old_password_correct:
+            raise ValidationError(self.error_messages['password_incorrect'], code='password_incorrect')
+        return self.cleaned_data['old_password']
+
+    async def asave(self):
+        await self.user.aset_password(self.cleaned_data['new_password1'])
+        ## The session user may come from a read replica, only the password and its stamp are ours to write
+        await self.user.asave(update_fields=['password', 'password_stamp'])
+        return self.user
+
 class ForgotPasswordForm(forms.Form):
     email = forms.EmailField(
         widget=forms.EmailInput(attrs={'class': 'form-control','placeholder': 'Enter email'})
     )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = None
+        self._user_looked_up = False
+
+    async def alookup_user(self):
+        '''
+        Fetch the account with the async ORM so is_valid() does not query.
+        '''
+        email = self.fields['email'].to_python(self.data.get('email'))
+        users = CustomUser.objects.db_manager(await sharding.adb_for_identifier(email))
+        self.user = await users.filter(email=email).afirst()
+        self._user_looked_up = True
+
     def clean_email(self):
         email = self.cleaned_data['email']
-        if not CustomUser.objects.filter(email=email).exists():
+        if not self._user_looked_up:
+            self.user = CustomUser.objects.db_manager(sharding.db_for_identifier(email)).filter(email=email).first()
+        if self.user is None:
             raise forms.ValidationError("Account with this email does not exist.")
         return email
 
@@ -90,5 +160,10 @@ class ResetPasswordForm(forms.Form):
         password = self.cleaned_data["new_password"]
         self.user.set_password(password)
         if commit:
-            self.user.save()
-        return self.user
\ No newline at end of file
+            self.user.save(update_fields=["password", "password_stamp"])
+        return self.user
+
+    async def asave(self):
+        await self.user.aset_password(self.cleaned_data["new_password"])
+        await self.user.asave(update_fields=["password", "password_stamp"])
+        return self.user
@@ -0,0 +1,81 @@
+'''
+Password hashers whose cost comes from the settings, see PASSWORD_HASHING_TIER.
+
+They keep the algorithm names of Django's hashers, so stored hashes verify
+either way, and their must_update() compares a stored hash with the
+configured cost: raising PBKDF2_ITERATIONS (or the SCRYPT_*/ARGON2_*
+values) upgrades every user at their next login, see
+users.hashing.schedule_rehash(). ``manage.py calibrate_hashers`` measures
+costs for a target time per hash on the current hardware.
+'''
+import base64
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    @property
+    def iterations(self):
+        return settings.PBKDF2_ITERATIONS
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    @property
+    def work_factor(self):
+        return settings.SCRYPT_WORK_FACTOR
+
+    @property
+    def block_size(self):
+        return settings.SCRYPT_BLOCK_SIZE
+
+    @property
+    def parallelism(self):
+        return settings.SCRYPT_PARALLELISM
+
+    def encode(self, password, salt, n=None, r=None, p=None):
+        '''
+        Django's encode() with maxmem sized from the n, r and p being hashed with.
+
+        verify() passes the cost stored in the hash, which can be above the
+        settings after SCRYPT_WORK_FACTOR was lowered: those hashes still have
+        to verify so that they get rehashed.
+        '''
+        self._check_encode_args(password, salt)
+        n = n or self.work_factor
+        r = r or self.block_size
+        p = p or self.parallelism
+        hash_ = hashlib.scrypt(
+            password.encode(),
+            salt=salt.encode(),
+            n=n,
+            r=r,
+            p=p,
+            ## hashlib refuses anything above 32 MiB unless told, scrypt needs 128 * n * r * p bytes
+            maxmem=2 * scrypt_memory(n, r, p),
+            dklen=64,
+        )
+        hash_ = base64.b64encode(hash_).decode('ascii').strip()
+        return '%s$%d$%s$%d$%d$%s' % (self.algorithm, n, salt, r, p, hash_)
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    '''
+    Needs argon2-cffi (pip install argon2-cffi).
+    '''
+    @property
+    def time_cost(self):
+        return settings.ARGON2_TIME_COST
+
+    @property
+    def memory_cost(self):
+        return settings.ARGON2_MEMORY_COST
+
+    @property
+    def parallelism(self):
+        return settings.ARGON2_PARALLELISM
+
+
+def scrypt_memory(work_factor, block_size, parallelism):
+    return 128 * work_factor * block_size * parallelism
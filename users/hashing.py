@@ -0,0 +1,285 @@
+'''
+Password hashing off the request thread.
+
+PBKDF2 (hashlib.pbkdf2_hmac) releases the GIL, so a thread pool sized to
+the number of cores runs hashes truly in parallel; a process pool is
+available for hashers that hold the GIL. ``CustomUser.set_password`` and
+``check_password`` go through this module, which covers login, signup and
+every password change/reset form.
+
+Admission control: once ``PASSWORD_HASHING_MAX_PENDING`` hashes are queued
+or running, new work is refused with ``PasswordHashingBusy`` and
+``users.middleware.HashingBusyMiddleware`` answers 503 instead of letting
+requests pile up behind the pool.
+
+Rehash on login: a successful login whose hash was made with another
+hasher or cost than the current ones (see users.hashers) queues an
+upgrade on a single background thread, PASSWORD_REHASH = "background",
+instead of paying a second hash in the login request. The session auth
+hash does not depend on the password hash (CustomUser.password_stamp), so
+the upgrade does not log anybody out.
+'''
+import asyncio
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model, hashers
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+
+from users.perf import track
+
+logger = logging.getLogger(__name__)
+
+## Users waiting for a background rehash, beyond that logins skip it and the next one tries again
+REHASH_MAX_PENDING = 1000
+
+
+class PasswordHashingBusy(Exception):
+    '''
+    Raised when the hashing queue is full.
+    '''
+
+
+def init_process_worker():
+    ## Spawned (non-forked) workers need Django configured to load hashers
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'whatbytes_assignment.settings')
+    django.setup(set_prefix=False)
+
+
+class HashingPool:
+    def __init__(self, kind='thread', workers=None, max_pending=None):
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 8
+        if kind == 'process':
+            ## Imported here: its multiprocessing imports would slow down the start of every thread-hashing worker
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(self.workers, initializer=init_process_worker)
+        else:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hasher')
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise PasswordHashingBusy(f'{self._pending} password hashes already pending')
+            self._pending += 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''
+    Return the shared pool, or None when hashing runs inline on the caller.
+    '''
+    global _pool
+    kind = getattr(settings, 'PASSWORD_HASHING_EXECUTOR', 'thread')
+    if kind in (None, '', 'inline'):
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HashingPool(
+                    kind,
+                    workers=getattr(settings, 'PASSWORD_HASHING_WORKERS', None),
+                    max_pending=getattr(settings, 'PASSWORD_HASHING_MAX_PENDING', None),
+                )
+    return _pool
+
+
+@receiver(setting_changed)
+def reset_pool(*, setting, **kwargs):
+    global _pool
+    if setting.startswith('PASSWORD_HASHING_') and _pool is not None:
+        with _pool_lock:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+def _call(fn, *args):
+    pool = get_pool()
+    with track('hash'):
+        if pool is None:
+            return fn(*args)
+        return pool.run(fn, *args)
+
+
+async def _acall(fn, *args):
+    pool = get_pool()
+    ## Includes the wait for a free worker, which is what the request pays
+    with track('hash'):
+        if pool is None:
+            return fn(*args)
+        return await pool.arun(fn, *args)
+
+
+def make_password(password):
+    return _call(hashers.make_password, password)
+
+
+async def amake_password(password):
+    return await _acall(hashers.make_password, password)
+
+
+def check_password(password, encoded, setter=None):
+    '''
+    Same contract as django.contrib.auth.hashers.check_password().
+    '''
+    is_correct, must_update = _call(hashers.verify_password, password, encoded)
+    if setter and is_correct and must_update:
+        setter(password)
+    return is_correct
+
+
+async def acheck_password(password, encoded, setter=None):
+    is_correct, must_update = await _acall(hashers.verify_password, password, encoded)
+    if setter and is_correct and must_update:
+        await setter(password)
+    return is_correct
+
+
+def rehash(user_id, encoded, raw_password, make=hashers.make_password):
+    '''
+    Store a new hash of ``raw_password`` unless the password changed since ``encoded`` was read.
+
+    Returns the hash now stored. Leaves password_stamp alone: an upgrade is not a password change.
+    '''
+    from users import sharding
+    from users.caching import invalidate_user
+
+    new = make(raw_password)
+
+    def update(using, user_ids):
+        return get_user_model()._default_manager.db_manager(using).filter(pk__in=user_ids, password=encoded).update(password=new)
+
+    if not sum(sharding.write([user_id], update)):
+        return encoded
+    invalidate_user(user_id)
+    return new
+
+
+class Rehasher:
+    '''
+    One thread upgrading hashes after logins, so they take at most one core; a user is queued once.
+    '''
+    def __init__(self, max_pending=REHASH_MAX_PENDING):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='password-rehash')
+        self._queued = set()
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, encoded, raw_password):
+        with self._lock:
+            if user_id in self._queued or len(self._queued) >= self.max_pending:
+                return None
+            self._queued.add(user_id)
+        return self.executor.submit(self._run, user_id, encoded, raw_password)
+
+    def _run(self, user_id, encoded, raw_password):
+        try:
+            return rehash(user_id, encoded, raw_password)
+        except Exception:
+            logger.exception('Could not rehash the password of user %s, retrying at their next login', user_id)
+        finally:
+            with self._lock:
+                self._queued.discard(user_id)
+            connections.close_all()
+
+    def flush(self):
+        '''
+        Wait for the rehashes queued so far.
+        '''
+        self.executor.submit(lambda: None).result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_rehasher = None
+
+
+def get_rehasher():
+    global _rehasher
+    if _rehasher is None:
+        with _pool_lock:
+            if _rehasher is None:
+                _rehasher = Rehasher()
+                ## Finish the upgrades already paid for by a login
+                atexit.register(_rehasher.shutdown)
+    return _rehasher
+
+
+def schedule_rehash(user, raw_password):
+    '''
+    Upgrade the hash of ``user``, who just logged in with ``raw_password``, as PASSWORD_REHASH says.
+    '''
+    mode = settings.PASSWORD_REHASH
+    if mode == 'background':
+        get_rehasher().submit(user.pk, user.password, raw_password)
+    elif mode == 'inline':
+        try:
+            user.password = rehash(user.pk, user.password, raw_password, make=make_password)
+        except PasswordHashingBusy:
+            ## The login succeeded, the upgrade can wait for the next one
+            pass
+
+
+async def aschedule_rehash(user, raw_password):
+    if settings.PASSWORD_REHASH == 'inline':
+        await sync_to_async(schedule_rehash)(user, raw_password)
+    else:
+        schedule_rehash(user, raw_password)
+
+
+def bulk_executor(workers=None):
+    '''
+    Process pool for bulk jobs (imports) that should hash on every core.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(workers or os.cpu_count() or 1, initializer=init_process_worker)
+
+
+def make_passwords(passwords, executor=None, chunksize=16):
+    '''
+    Hash a batch of raw passwords, spread over ``executor`` when given.
+    '''
+    if executor is None:
+        return [hashers.make_password(password) for password in passwords]
+    return list(executor.map(hashers.make_password, passwords, chunksize=chunksize))
@@ -0,0 +1,251 @@
+'''
+Database backed outbound mail queue.
+
+Views only call ``enqueue()``; messages are delivered later by ``drain()``,
+either from the ``send_queued_mail`` management command or from the
+in-process ``MailQueueWorker`` thread (``MAIL_QUEUE_IN_PROCESS = True``).
+A worker keeps one backend connection open across batches so SMTP
+handshakes are paid once per burst instead of once per message.
+'''
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enqueue(subject, body, to, from_email=None, content_subtype='plain'):
+    '''
+    Store a message for later delivery and return the queued row.
+    '''
+    if isinstance(to, str):
+        to = [to]
+    message = OutboundEmail.objects.create(
+        subject=subject,
+        body=body,
+        to=','.join(to),
+        from_email=from_email or settings.EMAIL_HOST_USER or '',
+        content_subtype=content_subtype,
+    )
+    if _setting('MAIL_QUEUE_IN_PROCESS', False):
+        worker = ensure_worker()
+        transaction.on_commit(worker.wake)
+    return message
+
+
+async def aenqueue(subject, body, to, from_email=None, content_subtype='plain'):
+    '''
+    Async counterpart of enqueue() for async views.
+    '''
+    if isinstance(to, str):
+        to = [to]
+    message = await OutboundEmail.objects.acreate(
+        subject=subject,
+        body=body,
+        to=','.join(to),
+        from_email=from_email or settings.EMAIL_HOST_USER or '',
+        content_subtype=content_subtype,
+    )
+    if _setting('MAIL_QUEUE_IN_PROCESS', False):
+        ## acreate() runs in autocommit, the row is already visible to the worker
+        ensure_worker().wake()
+    return message
+
+
+def retry_delay(attempts):
+    '''
+    Exponential backoff for a message that has failed ``attempts`` times.
+    '''
+    base = _setting('MAIL_QUEUE_RETRY_BACKOFF', 30)
+    ceiling = _setting('MAIL_QUEUE_MAX_BACKOFF', 3600)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), ceiling))
+
+
+def claim_batch(batch_size=None):
+    '''
+    Lease up to ``batch_size`` due messages so concurrent workers skip them.
+
+    The lease is pushed forward by ``MAIL_QUEUE_LEASE`` seconds; a worker that
+    dies mid batch therefore only delays those messages, it never loses them.
+    '''
+    batch_size = batch_size or _setting('MAIL_QUEUE_BATCH_SIZE', 50)
+    now = timezone.now()
+    with transaction.atomic():
+        due = (
+            OutboundEmail.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=OutboundEmail.STATUS_QUEUED, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'pk')[:batch_size]
+        )
+        batch = list(due)
+        if batch:
+            lease = now + timedelta(seconds=_setting('MAIL_QUEUE_LEASE', 300))
+            OutboundEmail.objects.filter(pk__in=[m.pk for m in batch]).update(next_attempt_at=lease)
+    return batch
+
+
+def _build_message(queued, connection):
+    message = EmailMessage(
+        queued.subject,
+        queued.body,
+        queued.from_email or None,
+        to=queued.recipients,
+        connection=connection,
+    )
+    message.content_subtype = queued.content_subtype
+    return message
+
+
+def _mark_failed(queued, error):
+    queued.attempts += 1
+    queued.last_error = str(error)[:2000]
+    if queued.attempts >= _setting('MAIL_QUEUE_MAX_ATTEMPTS', 5):
+        queued.status = OutboundEmail.STATUS_DEAD
+        logger.error('Dead-lettering mail %s after %s attempts: %s', queued.pk, queued.attempts, error)
+    else:
+        queued.next_attempt_at = timezone.now() + retry_delay(queued.attempts)
+        logger.warning('Mail %s failed (attempt %s), retrying: %s', queued.pk, queued.attempts, error)
+    queued.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+
+
+def drain(batch_size=None, connection=None):
+    '''
+    Send one batch of due messages and return how many were delivered.
+
+    ``connection`` is left open when passed in, so callers that drain in a
+    loop reuse a single backend connection for every batch.
+    '''
+    batch = claim_batch(batch_size)
+    if not batch:
+        return 0
+
+    owns_connection = connection is None
+    connection = connection or get_connection(fail_silently=False)
+    sent = []
+    try:
+        connection.open()
+    except Exception as error:
+        for queued in batch:
+            _mark_failed(queued, error)
+        return 0
+    try:
+        for index, queued in enumerate(batch):
+            try:
+                connection.send_messages([_build_message(queued, connection)])
+            except Exception as error:
+                _mark_failed(queued, error)
+                ## The server may have dropped us, reconnect for the rest of the batch
+                connection.close()
+                try:
+                    connection.open()
+                except Exception as error:
+                    for pending in batch[index + 1:]:
+                        _mark_failed(pending, error)
+                    break
+            else:
+                sent.append(queued.pk)
+    finally:
+        if owns_connection:
+            connection.close()
+
+    if sent:
+        OutboundEmail.objects.filter(pk__in=sent).update(
+            status=OutboundEmail.STATUS_SENT,
+            sent_at=timezone.now(),
+            last_error='',
+        )
+    return len(sent)
+
+
+def drain_all(batch_size=None, connection=None):
+    '''
+    Drain batches until nothing is due, returning the number delivered.
+    '''
+    total = 0
+    while True:
+        delivered = drain(batch_size, connection)
+        total += delivered
+        if not delivered and not _has_due():
+            return total
+
+
+def _has_due():
+    return OutboundEmail.objects.filter(
+        status=OutboundEmail.STATUS_QUEUED, next_attempt_at__lte=timezone.now()
+    ).exists()
+
+
+class MailQueueWorker(threading.Thread):
+    '''
+    Background thread that drains the queue over one pooled connection.
+
+    The connection is closed after the queue has been idle for a poll
+    interval and transparently reopened on the next batch.
+    '''
+    def __init__(self, interval=None, batch_size=None):
+        super().__init__(name='mail-queue-worker', daemon=True)
+        self.interval = interval or _setting('MAIL_QUEUE_POLL_INTERVAL', 5)
+        self.batch_size = batch_size
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self.connection = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            delivered = 0
+            try:
+                if self.connection is None:
+                    self.connection = get_connection(fail_silently=False)
+                delivered = drain(self.batch_size, self.connection)
+            except Exception:
+                logger.exception('Mail queue worker failed to drain a batch')
+            finally:
+                close_old_connections()
+            if delivered:
+                continue
+            self._close_connection()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+        self._close_connection()
+
+    def _close_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                logger.exception('Error closing mail connection')
+
+
+def ensure_worker():
+    '''
+    Start the in-process worker thread on first use and return it.
+    '''
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = MailQueueWorker()
+            _worker.start()
+        return _worker
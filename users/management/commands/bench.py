@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from benchmarks import suite
+from benchmarks._setup import seed_users
+from users import perf
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark signup, login, dashboard, change/forgot/reset password end to end against a scratch '
+        'database seeded with --users users, through the test client and local WSGI/ASGI servers. '
+        'Reports req/s, latency percentiles, queries per request and peak RSS; --save writes a JSON '
+        'baseline and --compare fails on regressions against one.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Users to seed (default 1000).')
+        parser.add_argument('--requests', type=int, default=50, help='Requests per flow and transport (default 50).')
+        parser.add_argument('--concurrency', type=int, default=1, help='Sessions running each flow in parallel.')
+        parser.add_argument(
+            '--transport', action='append', choices=suite.TRANSPORTS,
+            help='client, wsgi and/or asgi (repeatable, default client and wsgi, plus asgi with uvicorn installed).',
+        )
+        parser.add_argument('--flow', action='append', choices=list(suite.FLOWS), help='Flows to run (repeatable, default all).')
+        parser.add_argument(
+            '--fast-hashers', action='store_true',
+            help='Hash with MD5 to measure everything but password hashing, which otherwise dominates logins.',
+        )
+        parser.add_argument('--save', metavar='PATH', help='Write the results as a JSON baseline.')
+        parser.add_argument('--compare', metavar='PATH', help='Baseline to compare with, exits non-zero on regressions.')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown for latency, req/s and RSS (default 0.2).')
+
+    def handle(self, *args, **options):
+        transports = options['transport'] or self.default_transports()
+        if 'asgi' in transports:
+            try:
+                import uvicorn  # noqa: F401
+            except ImportError:
+                raise CommandError('The asgi transport needs uvicorn (pip install uvicorn).')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as handle:
+                baseline = json.load(handle)
+
+        directory = tempfile.mkdtemp(prefix='wbytes-bench-')
+        overrides = {
+            ## users.perf reports the queries of every request in Server-Timing
+            'PERF_ENABLED': True, 'PERF_SERVER_TIMING': True, 'PERF_DIR': directory,
+            'DEBUG': False, 'ALLOWED_HOSTS': ['testserver', '127.0.0.1'], 'RATELIMIT_ENABLED': False,
+            'DATABASE_ROUTERS': [], 'DATABASE_REPLICAS': [], 'DATABASE_SHARDS': [],
+        }
+        if options['fast_hashers']:
+            overrides['PASSWORD_HASHERS'] = FAST_HASHERS
+        default = connections['default'].settings_dict
+        test_settings = default['TEST']
+        if default['ENGINE'] == 'django.db.backends.sqlite3':
+            ## Its own file, deleted with the perf dumps, rather than the test runner's test-db.sqlite3
+            default['TEST'] = {**test_settings, 'NAME': os.path.join(directory, 'bench.sqlite3')}
+
+        try:
+            with override_settings(**overrides):
+                old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'}, serialized_aliases=set())
+                try:
+                    seed_users(options['users'], suite.PASSWORD)
+                    hasher = settings.PASSWORD_HASHERS[0].rsplit('.', 1)[-1]
+                    self.stdout.write(
+                        f"{options['users']} users, {options['requests']} requests per flow, "
+                        f"concurrency {options['concurrency']}, {hasher}"
+                    )
+                    self.stdout.write(f"{'':<24}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'queries':>9}{'peak RSS':>10}{'errors':>8}")
+                    results = suite.run_suite(
+                        transports, options['flow'] or list(suite.FLOWS), options['requests'],
+                        options['concurrency'], options['users'], progress=self.report,
+                    )
+                    results['meta']['hasher'] = hasher
+                finally:
+                    teardown_databases(old_config, verbosity=0)
+                    ## Nothing left for the exit time flush to write into the deleted directory
+                    if perf._recorder is not None:
+                        perf._recorder.views.clear()
+                        perf._recorder = None
+                    for name in os.listdir(directory):
+                        os.unlink(os.path.join(directory, name))
+                    os.rmdir(directory)
+        finally:
+            default['TEST'] = test_settings
+
+        if options['save']:
+            with open(options['save'], 'w') as handle:
+                json.dump(results, handle, indent=2)
+            self.stdout.write(f"Saved {options['save']}")
+        if baseline is not None:
+            regressions = suite.compare(baseline, results, options['tolerance'])
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError(f"{len(regressions)} regression(s) against {options['compare']}")
+            self.stdout.write(f"No regressions against {options['compare']}")
+
+    def default_transports(self):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            return ['client', 'wsgi']
+        return list(suite.TRANSPORTS)
+
+    def report(self, transport, flow, result):
+        queries = '-' if result['queries'] is None else result['queries']
+        self.stdout.write(
+            f"{transport + ' ' + flow:<24}{result['rps']:>8}{result['p50_ms']:>7.1f}ms{result['p95_ms']:>7.1f}ms"
+            f"{result['p99_ms']:>7.1f}ms{queries:>9}{result['peak_rss_mib']:>7.0f}MiB{result['errors']:>8}"
+        )
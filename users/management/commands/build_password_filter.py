@@ -0,0 +1,67 @@
+import itertools
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from users.password_filter import build_filter, common_passwords, load_numpy, open_source, read_digests
+
+
+class Command(BaseCommand):
+    help = (
+        'Build the breached password Bloom filter read by users.password_filter.BreachedPasswordValidator '
+        'from a local list of passwords or SHA-1 hashes (HIBP "HASH:count" lines work as is). '
+        "The source is streamed; Django's common password list is always included."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', nargs='?', help="Password/hash list (.gz is fine), '-' for stdin, none for the common list only.")
+        parser.add_argument('--output', default=None, help='Filter file to write (default: PASSWORD_FILTER_PATH).')
+        parser.add_argument(
+            '--capacity', type=int, default=None,
+            help='Number of entries to size the filter for. Counted with an extra pass over the file when omitted.',
+        )
+        parser.add_argument('--error-rate', type=float, default=0.001, help='False positive rate (default 0.001).')
+        parser.add_argument('--format', choices=['auto', 'plain', 'sha1'], default='auto', help='How to read source lines.')
+
+    def handle(self, *args, **options):
+        source, output = options['source'], options['output'] or str(settings.PASSWORD_FILTER_PATH)
+        if not 0 < options['error_rate'] < 1:
+            raise CommandError('--error-rate must be between 0 and 1.')
+
+        common = sum(1 for _ in common_passwords())
+        capacity = options['capacity']
+        if capacity is None:
+            if source == '-':
+                raise CommandError('--capacity is required when reading stdin.')
+            capacity = common
+            if source:
+                with open_source(source) as handle:
+                    capacity += sum(1 for line in handle if line.strip())
+
+        started = time.monotonic()
+
+        def progress(count):
+            ## Called every 100 000 entries
+            if count % 10_000_000 == 0:
+                self.stdout.write(f'  {count} entries, {time.monotonic() - started:.0f}s')
+
+        handle = None
+        if source == '-':
+            handle = sys.stdin
+        elif source:
+            handle = open_source(source)
+        try:
+            digests = itertools.chain(read_digests(common_passwords(), 'plain'), read_digests(handle or [], options['format']))
+            count = build_filter(output, digests, capacity, options['error_rate'], progress=progress)
+        except ValueError as error:
+            raise CommandError(str(error))
+        finally:
+            if handle is not None and handle is not sys.stdin:
+                handle.close()
+
+        if count > capacity:
+            self.stderr.write(f'{count} entries for a capacity of {capacity}: the false positive rate is above target.')
+        engine = 'numpy' if load_numpy() is not None else 'pure Python, pip install numpy to speed this up'
+        self.stdout.write(f'Wrote {output}: {count} entries in {time.monotonic() - started:.1f}s ({engine})')
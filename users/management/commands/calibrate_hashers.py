@@ -0,0 +1,102 @@
+import math
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from users import hashers
+
+ALGORITHMS = ('pbkdf2', 'scrypt', 'argon2')
+## PBKDF2 iteration counts are rounded to this
+ITERATIONS_STEP = 10000
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the password hashers on this machine and suggest the cost settings '
+        '(PBKDF2_ITERATIONS, SCRYPT_WORK_FACTOR, ARGON2_TIME_COST) that hash in about --target-ms.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-ms', type=float, default=250, help='Milliseconds per hash to aim for (default 250).')
+        parser.add_argument(
+            '--algorithm', action='append', choices=ALGORITHMS,
+            help='Hashers to calibrate (repeatable, default all, argon2 only with argon2-cffi installed).',
+        )
+        parser.add_argument('--samples', type=int, default=5, help='Hashes timed per measurement, the median counts (default 5).')
+
+    def handle(self, *args, **options):
+        target = options['target_ms']
+        if target <= 0:
+            raise CommandError('--target-ms must be positive.')
+        self.samples = max(options['samples'], 1)
+        algorithms = options['algorithm'] or [name for name in ALGORITHMS if name != 'argon2' or argon2_installed()]
+        if 'argon2' in algorithms and not argon2_installed():
+            raise CommandError('Calibrating argon2 needs argon2-cffi (pip install argon2-cffi).')
+
+        self.stdout.write(f'Target: {target:g} ms per hash, median of {self.samples} hashes')
+        suggested = {}
+        for algorithm in algorithms:
+            suggested.update(getattr(self, f'calibrate_{algorithm}')(target))
+        self.stdout.write('\nFor settings.ini:')
+        for name, value in suggested.items():
+            self.stdout.write(f'{name} = {value}')
+
+    def measure(self, hasher, **costs):
+        '''
+        Median milliseconds per hash of ``hasher`` with the cost settings ``costs``.
+        '''
+        with override_settings(**costs):
+            times = []
+            for _ in range(self.samples):
+                salt = hasher.salt()
+                started = time.perf_counter()
+                hasher.encode('calibration-password', salt)
+                times.append((time.perf_counter() - started) * 1000)
+        return statistics.median(times)
+
+    def report(self, algorithm, costs, ms):
+        described = ', '.join(f'{name}={value}' for name, value in costs.items())
+        self.stdout.write(f'{algorithm:<8}{described:<48}{ms:>9.1f} ms')
+
+    def calibrate_pbkdf2(self, target):
+        hasher = hashers.PBKDF2PasswordHasher()
+        iterations = settings.PBKDF2_ITERATIONS
+        ms = self.measure(hasher, PBKDF2_ITERATIONS=iterations)
+        self.report('pbkdf2', {'PBKDF2_ITERATIONS': iterations}, ms)
+        ## Time is linear in the iterations
+        iterations = max(ITERATIONS_STEP, round(iterations * target / ms / ITERATIONS_STEP) * ITERATIONS_STEP)
+        self.report('pbkdf2', {'PBKDF2_ITERATIONS': iterations}, self.measure(hasher, PBKDF2_ITERATIONS=iterations))
+        return {'PBKDF2_ITERATIONS': iterations}
+
+    def calibrate_scrypt(self, target):
+        hasher = hashers.ScryptPasswordHasher()
+        work_factor = settings.SCRYPT_WORK_FACTOR
+        ms = self.measure(hasher, SCRYPT_WORK_FACTOR=work_factor)
+        self.report('scrypt', {'SCRYPT_WORK_FACTOR': work_factor}, ms)
+        ## Time and memory are linear in the work factor, which has to be a power of two
+        work_factor = 2 ** max(1, round(math.log2(work_factor * target / ms)))
+        ms = self.measure(hasher, SCRYPT_WORK_FACTOR=work_factor)
+        memory = hashers.scrypt_memory(work_factor, settings.SCRYPT_BLOCK_SIZE, settings.SCRYPT_PARALLELISM)
+        self.report('scrypt', {'SCRYPT_WORK_FACTOR': work_factor, 'memory': f'{memory / 2**20:g} MiB'}, ms)
+        return {'SCRYPT_WORK_FACTOR': work_factor}
+
+    def calibrate_argon2(self, target):
+        hasher = hashers.Argon2PasswordHasher()
+        time_cost = settings.ARGON2_TIME_COST
+        ms = self.measure(hasher, ARGON2_TIME_COST=time_cost)
+        self.report('argon2', {'ARGON2_TIME_COST': time_cost}, ms)
+        ## Memory stays at ARGON2_MEMORY_COST, passes over it are what scales
+        time_cost = max(1, round(time_cost * target / ms))
+        self.report('argon2', {'ARGON2_TIME_COST': time_cost}, self.measure(hasher, ARGON2_TIME_COST=time_cost))
+        return {'ARGON2_TIME_COST': time_cost}
+
+
+def argon2_installed():
+    try:
+        import argon2  # noqa: F401
+    except ImportError:
+        return False
+    return True
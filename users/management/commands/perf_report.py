@@ -0,0 +1,52 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.perf import METRICS, load_histograms
+
+PERCENTILES = (50, 95, 99)
+
+
+class Command(BaseCommand):
+    help = (
+        'Print p50/p95/p99 of request time, queries, DB, template, hashing and mail time '
+        'per URL name, merged from the histograms every process wrote to PERF_DIR.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='Histogram directory (default: PERF_DIR).')
+        parser.add_argument('--view', action='append', help='Only report these URL names (repeatable).')
+        parser.add_argument('--json', action='store_true', help='Machine readable output.')
+        parser.add_argument('--reset', action='store_true', help='Delete the collected histograms afterwards.')
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or settings.PERF_DIR
+        views = load_histograms(directory)
+        names = sorted(name for name in views if not options['view'] or name in options['view'])
+
+        report = {
+            name: {
+                metric: {f'p{pct}': round(views[name][metric].percentile(pct), 3) for pct in PERCENTILES}
+                for metric in METRICS
+            }
+            for name in names
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        elif not names:
+            self.stdout.write(f'No requests recorded in {directory} (is PERF_ENABLED on?)')
+        else:
+            for name in names:
+                self.stdout.write(f"{name} ({views[name]['total'].count} requests)")
+                self.stdout.write(f"  {'metric':<10}" + ''.join(f'{f"p{pct}":>12}' for pct in PERCENTILES))
+                for metric in METRICS:
+                    unit = '' if metric == 'queries' else ' ms'
+                    values = ''.join(f'{report[name][metric][f"p{pct}"]:>9.2f}{unit:<3}' for pct in PERCENTILES)
+                    self.stdout.write(f'  {metric:<10}{values}')
+
+        if options['reset'] and os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if filename.startswith('perf-') and filename.endswith('.json'):
+                    os.unlink(os.path.join(directory, filename))
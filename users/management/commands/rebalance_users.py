@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users import sharding
+
+
+class Command(BaseCommand):
+    help = (
+        'Move users to the database they belong on (USER_SHARDS, see users/sharding.py) in batches, while the '
+        'site keeps running. Adds the users of the default database to the user directory first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Users read and moved at a time.')
+        parser.add_argument('--pause', type=float, default=0.05, help='Seconds between batches that moved users.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the users that would move.')
+
+    def handle(self, *args, **options):
+        if not sharding.shards():
+            raise CommandError('USER_SHARDS is empty: there are no shards to move users to.')
+        started = time.perf_counter()
+        moved = sharding.rebalance(options['batch_size'], options['pause'], options['dry_run'])
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        for (source, target), count in sorted(moved.items()):
+            if target == 'leftover':
+                self.stdout.write(f'{count} leftover copies on {source}')
+            else:
+                self.stdout.write(f'{verb} {count} users from {source} to {target}')
+        total = sum(count for (_, target), count in moved.items() if target != 'leftover')
+        self.stdout.write(f'{verb} {total} users in {time.perf_counter() - started:.2f}s')
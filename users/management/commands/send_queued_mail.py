@@ -0,0 +1,34 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from users import mail_queue
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued outbound email in batches over a single backend connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Messages claimed per batch.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling the queue instead of exiting once it is empty.')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to sleep between polls in --loop mode.')
+
+    def handle(self, *args, **options):
+        connection = get_connection(fail_silently=False)
+        try:
+            while True:
+                started = time.monotonic()
+                delivered = mail_queue.drain_all(options['batch_size'], connection)
+                if delivered:
+                    elapsed = time.monotonic() - started
+                    self.stdout.write(f'Delivered {delivered} message(s) in {elapsed:.2f}s')
+                if not options['loop']:
+                    break
+                ## Do not hold an idle SMTP session open between polls
+                connection.close()
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
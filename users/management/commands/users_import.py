@@ -0,0 +1,200 @@
+import csv
+import io
+import json
+import sys
+import time
+from itertools import islice
+
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX, identify_hasher, make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils.dateparse import parse_datetime
+
+from users import hashing, sharding
+from users.caching import missing_identifiers
+from users.models import CustomUser
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+
+
+def read_rows(stream, fmt):
+    '''
+    Yield one dict per input record without loading the file in memory.
+    '''
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def as_bool(value, default):
+    if value in (None, ''):
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def as_datetime(value):
+    '''
+    None for an empty value, raises ValueError for one that is not an ISO 8601 date and time.
+    '''
+    if value in (None, ''):
+        return None
+    parsed = parse_datetime(str(value).strip())
+    if parsed is None:
+        raise ValueError(f'{value!r} is not a date and time')
+    return parsed
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk import users from CSV or JSONL (columns: email, username and either password '
+        'or password_hash, optional is_active/is_staff/is_superuser/date_joined/last_login, '
+        'as users_export writes them). Input is streamed, passwords are hashed on every core and '
+        'rows are inserted with bulk_create, one transaction per batch. Duplicate emails/usernames '
+        'are reported and skipped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Input file, or '-' for stdin.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=None, help='Hashing processes (default: CPU count, 1 hashes inline).')
+        parser.add_argument('--prehashed', action='store_true', help='Treat the password column as an already encoded hash.')
+
+    def handle(self, *args, **options):
+        if sharding.shards():
+            ## bulk_create() takes ids from the default database, which the user directory hands out to shard users too
+            raise CommandError('users_import does not support sharded users (USER_SHARDS), create them with create_user().')
+        fmt = options['format'] or ('jsonl' if options['path'].endswith(('.jsonl', '.json')) else 'csv')
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if options['path'] == '-' else open(options['path'], newline='', encoding='utf-8')
+        self.prehashed = options['prehashed']
+        self.stats = {'created': 0, 'duplicates': 0, 'invalid': 0}
+
+        executor = None
+        if options['workers'] != 1:
+            executor = hashing.bulk_executor(options['workers'])
+        started = time.monotonic()
+        try:
+            rows = enumerate(read_rows(stream, fmt), start=1)
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                self.import_batch(batch, executor)
+        except (ValueError, csv.Error) as error:
+            raise CommandError(f'Could not parse input: {error}')
+        finally:
+            stream.close()
+            if executor is not None:
+                executor.shutdown()
+        ## Identifiers imported here may be remembered as unknown by the login backend
+        missing_identifiers.clear()
+
+        elapsed = time.monotonic() - started
+        processed = sum(self.stats.values())
+        rate = processed / elapsed if elapsed else 0
+        self.stdout.write(
+            f"Imported {self.stats['created']} user(s), skipped {self.stats['duplicates']} duplicate(s) "
+            f"and {self.stats['invalid']} invalid row(s) in {elapsed:.2f}s ({rate:.0f} rows/s)"
+        )
+
+    def skip(self, line, kind, reason):
+        self.stats[kind] += 1
+        self.stderr.write(f'line {line}: {reason}')
+
+    def import_batch(self, batch, executor):
+        candidates = []
+        seen_emails, seen_usernames = set(), set()
+        for line, row in batch:
+            email = CustomUser.objects.normalize_email((row.get('email') or '').strip())
+            username = (row.get('username') or '').strip()
+            if not email or not username:
+                self.skip(line, 'invalid', 'email and username are required')
+                continue
+            ## Usernames that differ only in case are taken, as at signup
+            if email.lower() in seen_emails or username.lower() in seen_usernames:
+                self.skip(line, 'duplicates', f'duplicate of an earlier row ({email} / {username})')
+                continue
+            seen_emails.add(email.lower())
+            seen_usernames.add(username.lower())
+            candidates.append((line, row, email, username))
+
+        ## One query per batch tells us which identifiers are already taken
+        taken_emails, taken_usernames = set(), set()
+        query = Q(email_lower__in=[c[2].lower() for c in candidates]) | Q(username_lower__in=[c[3].lower() for c in candidates])
+        existing = CustomUser.objects.alias(email_lower=Lower('email'), username_lower=Lower('username')).filter(query)
+        for email, username in existing.values_list('email', 'username'):
+            taken_emails.add(email.lower())
+            taken_usernames.add(username.lower())
+
+        users, lines, raw_passwords, joined = [], [], [], []
+        for line, row, email, username in candidates:
+            if email.lower() in taken_emails or username.lower() in taken_usernames:
+                self.skip(line, 'duplicates', f'already exists ({email} / {username})')
+                continue
+            try:
+                date_joined, last_login = as_datetime(row.get('date_joined')), as_datetime(row.get('last_login'))
+            except ValueError as error:
+                self.skip(line, 'invalid', str(error))
+                continue
+            password = row.get('password_hash') or (row.get('password') if self.prehashed else None)
+            if password:
+                ## Unusable passwords (make_password(None)) come back as they were exported
+                if not password.startswith(UNUSABLE_PASSWORD_PREFIX):
+                    try:
+                        identify_hasher(password)
+                    except ValueError:
+                        self.skip(line, 'invalid', 'password hash uses an unknown format')
+                        continue
+            else:
+                raw_passwords.append((len(users), row.get('password') or None))
+            lines.append(line)
+            joined.append(date_joined)
+            users.append(CustomUser(
+                email=email,
+                username=username,
+                password=password or '',
+                is_active=as_bool(row.get('is_active'), True),
+                is_staff=as_bool(row.get('is_staff'), False),
+                is_superuser=as_bool(row.get('is_superuser'), False),
+                last_login=last_login,
+            ))
+
+        to_hash = [raw for _, raw in raw_passwords if raw is not None]
+        hashed = iter(hashing.make_passwords(to_hash, executor))
+        for index, raw in raw_passwords:
+            ## Rows without any password get an unusable one, like set_unusable_password()
+            users[index].password = next(hashed) if raw is not None else make_password(None)
+
+        try:
+            with transaction.atomic():
+                CustomUser.objects.bulk_create(users)
+                self.keep_join_dates(users, joined)
+            self.stats['created'] += len(users)
+        except IntegrityError:
+            ## Lost a race with another writer: fall back to row by row for this batch
+            for line, user, date_joined in zip(lines, users, joined):
+                try:
+                    with transaction.atomic():
+                        user.save(force_insert=True)
+                        self.keep_join_dates([user], [date_joined])
+                    self.stats['created'] += 1
+                except IntegrityError:
+                    self.skip(line, 'duplicates', f'already exists ({user.email} / {user.username})')
+
+    def keep_join_dates(self, users, joined):
+        ## Inserts stamp auto_now_add fields with the current time, the imported dates go in afterwards
+        dated = []
+        for user, date_joined in zip(users, joined):
+            if date_joined is not None:
+                user.date_joined = date_joined
+                dated.append(user)
+        if dated:
+            CustomUser.objects.bulk_update(dated, ['date_joined'])
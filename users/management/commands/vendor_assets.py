@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users import assets
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild users/static/users/vendor from the XStatic packages, purged to the CSS classes '
+        'the templates use and with the icon font subset to the icons left. Needs '
+        'XStatic-Bootstrap==4.1.3.1 and XStatic-Font-Awesome==6.2.1.2, plus fonttools and '
+        'brotli for the font subset. Run it after adding classes or icons to the templates.'
+    )
+
+    def handle(self, *args, **options):
+        try:
+            assets.vendor_all(self.stdout)
+        except ImportError as error:
+            raise CommandError(f'{error}. Install the XStatic packages listed in --help first.')
@@ -0,0 +1,253 @@
+import json
+import mimetypes
+import os
+import secrets
+from collections import namedtuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence, compress_string
+
+from .hashing import PasswordHashingBusy
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class HashingBusyMiddleware(MiddlewareMixin):
+    '''
+    Turn a full password hashing queue into a cheap 503 instead of a 500.
+    '''
+    def process_exception(self, request, exception):
+        if isinstance(exception, PasswordHashingBusy):
+            response = HttpResponse('Server busy, please retry shortly.', status=503, content_type='text/plain')
+            response['Retry-After'] = '1'
+            return response
+        return None
+
+
+StaticFile = namedtuple('StaticFile', ['content_type', 'cache_control', 'variants'])
+## One per encoding: path on disk, ETag
+StaticVariant = namedtuple('StaticVariant', ['path', 'etag'])
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+## Preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class StaticFilesMiddleware:
+    '''
+    Serve the collected static files (STATIC_ROOT) from the app server, WSGI or ASGI.
+
+    STATIC_ROOT is indexed once at startup. Content-hashed names from the
+    manifest are cached for a year as immutable, other files for
+    STATIC_MAX_AGE seconds. ETag/If-None-Match answers 304, and the .br/.gz
+    variants written by the storage are picked from Accept-Encoding.
+    Small files are kept in memory after their first request.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        root = settings.STATIC_ROOT
+        if not getattr(settings, 'STATIC_SERVE', True) or not root or not os.path.isdir(root):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.prefix = settings.STATIC_URL
+        self.files = self.index(root)
+        self.memory = {}
+        self.memory_limit = getattr(settings, 'STATIC_MEMORY_LIMIT', 512 * 1024)
+
+    def index(self, root):
+        hashed = set()
+        manifest = os.path.join(root, 'staticfiles.json')
+        if os.path.exists(manifest):
+            with open(manifest) as handle:
+                hashed = set(json.load(handle).get('paths', {}).values())
+        max_age = f"public, max-age={getattr(settings, 'STATIC_MAX_AGE', 60)}"
+
+        files = {}
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith(('.br', '.gz')) or filename == 'staticfiles.json':
+                    continue
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                variants = {'identity': StaticVariant(path, self.etag(path, ''))}
+                for encoding, suffix in ENCODINGS:
+                    if os.path.exists(path + suffix):
+                        variants[encoding] = StaticVariant(path + suffix, self.etag(path + suffix, suffix))
+                content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                if content_type.startswith('text/') or content_type in ('application/javascript', 'image/svg+xml'):
+                    content_type += '; charset=utf-8'
+                files[name] = StaticFile(content_type, IMMUTABLE if name in hashed else max_age, variants)
+        return files
+
+    def etag(self, path, suffix):
+        stat = os.stat(path)
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{suffix}"'
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.serve(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        return self.serve(request) or await self.get_response(request)
+
+    def serve(self, request):
+        if request.method not in ('GET', 'HEAD') or not request.path.startswith(self.prefix):
+            return None
+        static_file = self.files.get(request.path[len(self.prefix):])
+        if static_file is None:
+            return None
+
+        accepted = {token.split(';')[0].strip() for token in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')}
+        encoding = next((encoding for encoding, _ in ENCODINGS if encoding in accepted and encoding in static_file.variants), 'identity')
+        variant = static_file.variants[encoding]
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if variant.etag in {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')} or if_none_match.strip() == '*':
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(self.read(variant.path), content_type=static_file.content_type)
+            if encoding != 'identity':
+                response['Content-Encoding'] = encoding
+        response['ETag'] = variant.etag
+        response['Cache-Control'] = static_file.cache_control
+        if len(static_file.variants) > 1:
+            patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+    def read(self, path):
+        content = self.memory.get(path)
+        if content is None:
+            with open(path, 'rb') as handle:
+                content = handle.read()
+            if len(content) <= self.memory_limit:
+                self.memory[path] = content
+        return content
+
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+## Random bytes of padding at most, as django.middleware.gzip.GZipMiddleware
+MAX_RANDOM_BYTES = 100
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for token in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = token.partition(';')
+        if params.strip().replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def brotli_sequence(sequence, quality):
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in sequence:
+        ## Flushed chunk by chunk, so whatever streams the response still streams
+        yield compressor.process(chunk) + compressor.flush()
+    yield compressor.finish()
+
+
+async def abrotli_sequence(sequence, quality):
+    compressor = brotli.Compressor(quality=quality)
+    async for chunk in sequence:
+        yield compressor.process(chunk) + compressor.flush()
+    yield compressor.finish()
+
+
+async def agzip_sequence(sequence):
+    async for chunk in sequence:
+        yield compress_string(chunk, max_random_bytes=MAX_RANDOM_BYTES)
+
+
+class CompressionMiddleware:
+    '''
+    Compress responses with brotli (pip install brotli) or gzip, whichever
+    the client accepts, brotli first.
+
+    Leaves alone responses under COMPRESSION_MIN_SIZE bytes, ones with a
+    Content-Encoding already (the precompressed static files) and types that
+    do not compress. Streaming responses are compressed chunk by chunk.
+
+    BREACH: every gzip response gets a random length filename ("Heal The
+    Breach", as Django's GZipMiddleware). A brotli page that carries a CSRF
+    token gets an HTML comment of random length; anything else carrying one
+    goes out as gzip. The CSRF tokens themselves are masked per response.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'COMPRESSION_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.min_size = getattr(settings, 'COMPRESSION_MIN_SIZE', 512)
+        self.quality = getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 4)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
+
+    def compress(self, request, response):
+        if response.has_header('Content-Encoding') or not response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+            return response
+        if not response.streaming and len(response.content) < self.min_size:
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        accepted = accepted_encodings(request)
+        ## Set by get_token() (then reset by CsrfViewMiddleware): the response carries a CSRF token
+        carries_csrf = 'CSRF_COOKIE_NEEDS_UPDATE' in request.META
+        html = response['Content-Type'].startswith('text/html')
+        if brotli is not None and 'br' in accepted and not (carries_csrf and (response.streaming or not html)):
+            encoding = 'br'
+        elif 'gzip' in accepted:
+            encoding = 'gzip'
+        else:
+            return response
+
+        if response.streaming:
+            content = response.streaming_content
+            if encoding == 'br':
+                compressed = abrotli_sequence(content, self.quality) if response.is_async else brotli_sequence(content, self.quality)
+            else:
+                compressed = agzip_sequence(content) if response.is_async else compress_sequence(content, max_random_bytes=MAX_RANDOM_BYTES)
+            response.streaming_content = compressed
+            ## Unknown until it has all streamed
+            del response['Content-Length']
+        else:
+            if encoding == 'br':
+                padding = f'<!-- {secrets.token_urlsafe(secrets.randbelow(MAX_RANDOM_BYTES))} -->'.encode() if carries_csrf else b''
+                body = brotli.compress(response.content + padding, quality=self.quality)
+            else:
+                body = compress_string(response.content, max_random_bytes=MAX_RANDOM_BYTES)
+            if len(body) >= len(response.content):
+                return response
+            response.content = body
+            response['Content-Length'] = str(len(body))
+
+        ## Compressed bytes differ from the identity ones, the ETag can only be weak
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:42
+
+from django.db import migrations, models
+import users.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_customuser_changelist_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='password_stamp',
+            field=models.CharField(default=users.models.new_password_stamp, editable=False, max_length=32),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_customuser_password_stamp'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='outboundemail',
+            index=models.Index(fields=['status', 'created_at'], name='outboundemail_cleanup_idx'),
+        ),
+    ]
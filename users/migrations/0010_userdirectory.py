@@ -0,0 +1,34 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:20
+
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_refreshtoken'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='refreshtoken',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='UserDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.CharField(db_index=True, max_length=254)),
+                ('username', models.CharField(max_length=30, unique=True)),
+                ('shard', models.CharField(max_length=64)),
+            ],
+            options={
+                'verbose_name_plural': 'user directory',
+                'indexes': [models.Index(django.db.models.functions.text.Lower('username'), name='userdirectory_username_idx')],
+            },
+        ),
+    ]
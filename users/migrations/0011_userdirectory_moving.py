@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_userdirectory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userdirectory',
+            name='moving',
+            field=models.BooleanField(default=False),
+        ),
+    ]
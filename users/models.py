@@ -1,24 +1,114 @@
+import secrets
+
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, router, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Lower
+from django.db.models.lookups import Exact
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from . import hashing
+
+def new_password_stamp():
+    return secrets.token_hex(16)
+
 
 class CustomUserManager(BaseUserManager):
-    def create_user(self, email, username, password=None):
+    def _build_user(self, email, username):
         if not email:
             raise ValueError('Users must have an email address')
         if not username:
             raise ValueError('Users must have a username')
 
         email = self.normalize_email(email)
-        user = self.model(email=email, username=username)
+        return self.model(email=email, username=username)
+
+    def _sharded(self):
+        from . import sharding
+
+        ## An explicit db_manager(shard) keeps to that database; the default one (createsuperuser) still
+        ## takes its ids from the directory
+        return bool(sharding.shards()) and self._db in (None, DEFAULT_DB_ALIAS)
+
+    def _save_new(self, user):
+        if self._sharded():
+            self._insert(user)
+        else:
+            user.save(using=self._db)
+
+    def create_user(self, email, username, password=None):
+        user = self._build_user(email, username)
         user.set_password(password)
-        user.save(using=self._db)
+        self._save_new(user)
         return user
 
+    async def acreate_user(self, email, username, password=None):
+        user = self._build_user(email, username)
+        await user.aset_password(password)
+        await sync_to_async(self._insert)(user)
+        return user
+
+    def _insert(self, user):
+        if self._sharded():
+            from . import sharding
+
+            ## Directory and user rows get transactions of their own, on their own databases
+            sharding.create(user)
+            return
+        using = self._db or router.db_for_write(self.model)
+        if not transaction.get_connection(using).in_atomic_block:
+            ## Autocommit: the lone INSERT is atomic already
+            user.save(using=using)
+            return
+        ## Own savepoint, so a unique violation doesn't break the surrounding transaction
+        with transaction.atomic(using=using):
+            user.save(using=using)
+
+    def _taken_queryset(self, email, username):
+        queryset, email_key = self, Lower('email')
+        if self._sharded():
+            from . import sharding
+
+            ## Users of every shard are in the directory, which stores emails lowercased
+            queryset, email_key = sharding.directory(), F('email')
+        ## Both sides go through the Lower() indexes
+        conditions = Q()
+        if email:
+            conditions |= Q(Exact(email_key, email.lower()))
+        if username:
+            conditions |= Q(Exact(Lower('username'), username.lower()))
+        return queryset.filter(conditions).values_list('email', 'username') if conditions else queryset.none()
+
+    def _taken_fields(self, email, username, rows):
+        taken = set()
+        for row_email, row_username in rows:
+            if email and row_email.lower() == email.lower():
+                taken.add('email')
+            if username and row_username.lower() == username.lower():
+                taken.add('username')
+        return [field for field in ('email', 'username') if field in taken]
+
+    def taken_identifiers(self, email, username):
+        '''
+        Which of ``email`` and ``username`` already belong to someone, ignoring
+        case, found with a single query.
+        '''
+        return self._taken_fields(email, username, list(self._taken_queryset(email, username)))
+
+    async def ataken_identifiers(self, email, username):
+        rows = [row async for row in self._taken_queryset(email, username)]
+        return self._taken_fields(email, username, rows)
+
     def create_superuser(self, email, username, password):
-        user = self.create_user(email, username, password)
+        user = self._build_user(email, username)
+        user.set_password(password)
+        ## Set before the insert: with users.sharding they decide where the user goes
         user.is_staff = True
         user.is_superuser = True
-        user.save(using=self._db)
+        self._save_new(user)
         return user
 
 class CustomUser(AbstractBaseUser, PermissionsMixin):
@@ -28,11 +118,187 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     is_staff = models.BooleanField(default=False)
     date_joined = models.DateTimeField(auto_now_add=True)
     last_login = models.DateTimeField(null=True, blank=True)
+    ## Changes with every password change and signs the sessions, see get_session_auth_hash()
+    password_stamp = models.CharField(max_length=32, default=new_password_stamp, editable=False)
 
     objects = CustomUserManager()
 
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = ['email']
 
+    class Meta:
+        indexes = [
+            ## Case-insensitive email lookups at login
+            models.Index(Lower('email'), name='customuser_email_lower_idx'),
+            ## Case-insensitive username check at signup
+            models.Index(Lower('username'), name='customuser_username_lower_idx'),
+            ## Admin changelist: keyset pages on (date_joined, id), alone or under a flag filter
+            models.Index(fields=['date_joined', 'id'], name='customuser_joined_idx'),
+            models.Index(fields=['is_active', 'date_joined', 'id'], name='customuser_active_joined_idx'),
+            models.Index(fields=['is_staff', 'date_joined', 'id'], name='customuser_staff_joined_idx'),
+        ]
+
     def __str__(self):
         return self.email
+
+    def save(self, *args, **kwargs):
+        from . import sharding
+
+        if kwargs.get('using') is not None or self.pk is None or self._state.adding or not sharding.shards():
+            super().save(*args, **kwargs)
+            return
+        if self.is_staff or self.is_superuser:
+            ## Staff live on the default database, with the admin log that refers to them
+            sharding.move_to_default([self.pk])
+        ## On the user's shard, written again there if the user moves while this waits (users.sharding.write())
+        sharding.write([self.pk], lambda using, user_ids: super(CustomUser, self).save(*args, **{**kwargs, 'using': using}))
+
+    ## Hashing runs on the users.hashing pool instead of the request thread
+    def set_password(self, raw_password):
+        self.password = hashing.make_password(raw_password)
+        self.password_stamp = new_password_stamp()
+        self._password = raw_password
+
+    async def aset_password(self, raw_password):
+        self.password = await hashing.amake_password(raw_password)
+        self.password_stamp = new_password_stamp()
+        self._password = raw_password
+
+    ## Outdated hashes are upgraded after the login, see users.hashing.schedule_rehash()
+    def check_password(self, raw_password):
+        def setter(raw_password):
+            hashing.schedule_rehash(self, raw_password)
+
+        return hashing.check_password(raw_password, self.password, setter)
+
+    async def acheck_password(self, raw_password):
+        async def setter(raw_password):
+            await hashing.aschedule_rehash(self, raw_password)
+
+        return await hashing.acheck_password(raw_password, self.password, setter)
+
+    def get_session_auth_hash(self):
+        '''
+        An HMAC of the password stamp rather than of the password hash, so
+        upgrading a hash leaves the user logged in.
+        '''
+        return self._get_stamp_auth_hash()
+
+    def get_session_auth_fallback_hash(self):
+        for fallback_secret in settings.SECRET_KEY_FALLBACKS:
+            yield self._get_stamp_auth_hash(secret=fallback_secret)
+        ## Sessions from before password stamps, django.contrib.auth.get_user() moves them over
+        for secret in [settings.SECRET_KEY, *settings.SECRET_KEY_FALLBACKS]:
+            yield self._get_session_auth_hash(secret=secret)
+
+    def _get_stamp_auth_hash(self, secret=None):
+        key_salt = 'users.models.CustomUser.get_session_auth_hash'
+        return salted_hmac(key_salt, f'{self.pk}:{self.password_stamp}', secret=secret, algorithm='sha256').hexdigest()
+
+
+class OutboundEmail(models.Model):
+    '''
+    Durable outbound mail queue, drained by users.mail_queue in batches.
+    '''
+    STATUS_QUEUED = 'queued'
+    STATUS_SENT = 'sent'
+    STATUS_DEAD = 'dead'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_DEAD, 'Dead'),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    content_subtype = models.CharField(max_length=20, default='plain')
+    from_email = models.CharField(max_length=254, blank=True)
+    to = models.TextField(help_text='Comma separated list of recipients.')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outboundemail_due_idx'),
+            ## users.cleanup: delivered mail, oldest first
+            models.Index(fields=['status', 'created_at'], name='outboundemail_cleanup_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} -> {self.to} ({self.status})'
+
+    @property
+    def recipients(self):
+        return [address for address in self.to.split(',') if address]
+
+
+class LoginAudit(models.Model):
+    '''
+    Append-only log of login attempts, written in batches by users.activity.
+    '''
+    OUTCOME_SUCCESS = 'success'
+    OUTCOME_FAILURE = 'failure'
+    OUTCOME_CHOICES = [
+        (OUTCOME_SUCCESS, 'Success'),
+        (OUTCOME_FAILURE, 'Failure'),
+    ]
+
+    ## No database constraint: rows are inserted after the fact and outlive deleted users
+    user = models.ForeignKey(
+        CustomUser, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+',
+    )
+    identifier = models.CharField(max_length=254, blank=True)
+    ip = models.GenericIPAddressField(null=True, blank=True)
+    outcome = models.CharField(max_length=10, choices=OUTCOME_CHOICES)
+    created_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.identifier} {self.outcome} at {self.created_at}'
+
+
+class RefreshToken(models.Model):
+    '''
+    API refresh token (users.api_tokens), stored as a SHA-256 of the token.
+
+    Each refresh replaces the token with a new one of the same family; a
+    token presented twice means it leaked, and ends the whole family.
+    '''
+    ## No database constraint: with users.sharding the user may live on another database
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, db_constraint=False, related_name='+')
+    family = models.CharField(max_length=32, db_index=True)
+    digest = models.CharField(max_length=64, unique=True)
+    ## The user's password stamp at issue time: a password change revokes the token
+    password_stamp = models.CharField(max_length=32)
+    expires_at = models.DateTimeField(db_index=True)
+    used_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Refresh token {self.family} of user {self.user_id}'
+
+
+class UserDirectory(models.Model):
+    '''
+    Where each user lives when users are sharded (users.sharding). Kept on
+    the default database; its id is the user's id on every shard, and its
+    username column keeps usernames unique across them.
+    '''
+    ## Lowercased, as placement hashes it
+    email = models.CharField(max_length=254, db_index=True)
+    username = models.CharField(max_length=30, unique=True)
+    shard = models.CharField(max_length=64)
+    ## Set while users.sharding.move() copies the user to another shard
+    moving = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            ## Case-insensitive username check at signup
+            models.Index(Lower('username'), name='userdirectory_username_idx'),
+        ]
+        verbose_name_plural = 'user directory'
+
+    def __str__(self):
+        return f'{self.username} on {self.shard}'
@@ -0,0 +1,260 @@
+'''
+Breached password check against an on-disk Bloom filter.
+
+The filter file is memory-mapped read only, so every worker process on a
+host reads the same page cache pages: a filter over hundreds of millions
+of breached passwords costs each worker only the pages its lookups touch,
+and those pages are shared, not copied.
+
+File layout (little endian):
+
+    magic    8 bytes   b'WBBLOOM1'
+    bits     uint64    size of the bit array (m)
+    hashes   uint32    probes per key (k)
+    reserved uint32
+    count    uint64    keys added
+    bit array of m bits, bit p is byte p // 8, bit p % 8
+
+Keys are SHA-1 digests of the passwords, the format of the Have I Been
+Pwned corpus, so its hash lists load without the plaintexts. Probe i of a
+digest is (h1 + i * h2) mod 2**64 mod m, h1 and h2 being its first two
+64-bit words (double hashing; SHA-1 output is already uniform).
+
+``manage.py build_password_filter`` writes the file; numpy, when
+installed, makes building a large one much faster.
+'''
+import gzip
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+from django.contrib.auth.password_validation import CommonPasswordValidator
+from django.core.exceptions import ValidationError
+from django.utils.translation import gettext as _
+
+MAGIC = b'WBBLOOM1'
+HEADER = struct.Struct('<8sQIIQ')
+MASK64 = (1 << 64) - 1
+
+
+def bloom_parameters(capacity, error_rate):
+    '''
+    (bits, hashes) of a filter holding ``capacity`` keys with the given false positive rate.
+    '''
+    capacity = max(capacity, 1)
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+def load_numpy():
+    '''
+    numpy, or None when it is not installed.
+
+    Imported on first use: only building a filter needs it, and the
+    validator loads this module in every worker.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def password_digest(password):
+    return hashlib.sha1(password.encode()).digest()
+
+
+def probes(digest, bits, hashes):
+    h1 = int.from_bytes(digest[0:8], 'little')
+    h2 = int.from_bytes(digest[8:16], 'little') | 1
+    return [((h1 + i * h2) & MASK64) % bits for i in range(hashes)]
+
+
+class BloomFilter:
+    '''
+    Read-only, memory-mapped view of a filter file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            self.stat = os.fstat(handle.fileno())
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.bits, self.hashes, _reserved, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or len(self._map) < HEADER.size + (self.bits + 7) // 8:
+            self._map.close()
+            raise ValueError(f'{path} is not a password filter')
+
+    def __contains__(self, digest):
+        data = self._map
+        for position in probes(digest, self.bits, self.hashes):
+            if not data[HEADER.size + (position >> 3)] >> (position & 7) & 1:
+                return False
+        return True
+
+    def is_current(self):
+        ## A rebuild replaces the file, leaving this mapping on the old inode
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) == (self.stat.st_ino, self.stat.st_mtime_ns)
+
+    def close(self):
+        self._map.close()
+
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+
+def get_filter(path):
+    '''
+    The process-wide mapping of ``path``, reopened after a rebuild; None if there is no filter file.
+    '''
+    bloom = _filters.get(path)
+    if bloom is not None and bloom.is_current():
+        return bloom
+    with _filters_lock:
+        bloom = _filters.get(path)
+        if bloom is None or not bloom.is_current():
+            ## The old mapping may still be in use by another thread, let it be garbage collected
+            bloom = BloomFilter(path) if os.path.exists(path) else None
+            _filters[path] = bloom
+    return bloom
+
+
+class BreachedPasswordValidator:
+    '''
+    Reject passwords found in the breached password filter (PASSWORD_FILTER_PATH).
+
+    Until a filter has been built, falls back to Django's CommonPasswordValidator.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self._fallback = None
+
+    def validate(self, password, user=None):
+        ## Django keeps validator instances for the life of the process, so the setting is read here
+        bloom = get_filter(str(self.path or settings.PASSWORD_FILTER_PATH))
+        if bloom is None:
+            if self._fallback is None:
+                self._fallback = CommonPasswordValidator()
+            return self._fallback.validate(password, user)
+        ## Breach corpora are case sensitive; the lowercase probe covers lists kept in lowercase
+        candidates = {password, password.lower()}
+        if any(password_digest(candidate) in bloom for candidate in candidates):
+            raise ValidationError(
+                _('This password has appeared in a data breach.'),
+                code='password_breached',
+            )
+
+    def warm_up(self):
+        ## Map the filter, or load the fallback list, before the first password needs it (users.warmup)
+        if get_filter(str(self.path or settings.PASSWORD_FILTER_PATH)) is None and self._fallback is None:
+            self._fallback = CommonPasswordValidator()
+
+    def get_help_text(self):
+        return _('Your password can’t be a commonly used password.')
+
+
+def read_digests(lines, source_format='auto'):
+    '''
+    SHA-1 digests from lines of plaintext passwords or (HIBP style) "HEX[:count]" hashes.
+
+    ``auto`` treats any line that starts with 40 hex digits as a hash.
+    '''
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        digest = _hex_digest(line) if source_format != 'plain' else None
+        if digest is not None:
+            yield digest
+            continue
+        if source_format == 'sha1':
+            raise ValueError(f'Not a SHA-1 hash: {line!r}')
+        yield password_digest(line)
+
+
+def _hex_digest(line):
+    if len(line) < 40 or line[40:41] not in ('', ':'):
+        return None
+    try:
+        return bytes.fromhex(line[:40])
+    except ValueError:
+        return None
+
+
+def open_source(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
+
+
+def common_passwords():
+    '''
+    The list behind Django's CommonPasswordValidator, one password per line.
+    '''
+    ## A cached_property on Django 5.0, only readable from an instance
+    path = CommonPasswordValidator.__new__(CommonPasswordValidator).DEFAULT_PASSWORD_LIST_PATH
+    with gzip.open(path, 'rt', encoding='utf-8') as handle:
+        yield from handle
+
+
+def build_filter(path, digests, capacity, error_rate=0.001, batch_size=100_000, progress=None):
+    '''
+    Stream ``digests`` into a new filter file at ``path`` and return how many were added.
+
+    The bit array is written through a shared mapping of the file, so
+    building takes no more memory than the filter itself in page cache.
+    The file is swapped in atomically once complete.
+    '''
+    bits, hashes = bloom_parameters(capacity, error_rate)
+    size = HEADER.size + (bits + 7) // 8
+    tmp = f'{path}.tmp'
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    count = 0
+    with open(tmp, 'w+b') as handle:
+        handle.truncate(size)
+        with mmap.mmap(handle.fileno(), size) as data:
+            add = _add_batch_numpy if load_numpy() is not None else _add_batch
+            batch = []
+            for digest in digests:
+                batch.append(digest)
+                if len(batch) >= batch_size:
+                    add(data, batch, bits, hashes)
+                    count += len(batch)
+                    batch = []
+                    if progress:
+                        progress(count)
+            if batch:
+                add(data, batch, bits, hashes)
+                count += len(batch)
+            HEADER.pack_into(data, 0, MAGIC, bits, hashes, 0, count)
+            data.flush()
+    os.replace(tmp, path)
+    return count
+
+
+def _add_batch(data, digests, bits, hashes):
+    for digest in digests:
+        for position in probes(digest, bits, hashes):
+            data[HEADER.size + (position >> 3)] |= 1 << (position & 7)
+
+
+def _add_batch_numpy(data, digests, bits, hashes):
+    numpy = load_numpy()
+    words = numpy.frombuffer(b''.join(digest[:16] for digest in digests), dtype='<u8').reshape(-1, 2)
+    h1, h2 = words[:, 0], words[:, 1] | numpy.uint64(1)
+    array = numpy.frombuffer(data, dtype=numpy.uint8, offset=HEADER.size)
+    ## uint64 arithmetic wraps like the & MASK64 in probes()
+    with numpy.errstate(over='ignore'):
+        for i in range(hashes):
+            positions = (h1 + numpy.uint64(i) * h2) % numpy.uint64(bits)
+            numpy.bitwise_or.at(array, positions >> numpy.uint64(3), (numpy.uint8(1) << (positions & numpy.uint64(7)).astype(numpy.uint8)))
+    del array
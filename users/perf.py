@@ -0,0 +1,312 @@
+'''
+Per-request performance instrumentation, switched on with PERF_ENABLED.
+
+PerfMiddleware opens a RequestTimings for each request and the expensive
+parts of a request report into it through ``track(category)``: database
+queries (a connection execute wrapper), template rendering
+(TimedDjangoTemplates), password hashing and mail. The totals go out as a
+Server-Timing header and into per URL name histograms, which every process
+dumps to PERF_DIR/perf-<pid>.json for ``manage.py perf_report`` to merge.
+
+Categories may overlap (a template that triggers a query counts in both).
+
+Disabled, the middleware removes itself from the stack, no wrapper or
+template backend is installed and ``track()`` is a single ContextVar read.
+'''
+import atexit
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+CATEGORIES = ('db', 'template', 'hash', 'mail')
+## Histograms kept per URL name, "queries" is a count, the others milliseconds
+METRICS = ('total',) + CATEGORIES + ('queries',)
+
+logger = logging.getLogger(__name__)
+
+_timings = ContextVar('perf_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = dict.fromkeys(CATEGORIES, 0.0)
+        self.queries = 0
+
+
+@contextmanager
+def track(category):
+    '''
+    Add the time spent in the block to ``category`` of the current request.
+    '''
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.seconds[category] += time.perf_counter() - started
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.seconds['db'] += time.perf_counter() - started
+        timings.queries += 1
+
+
+def _install_db_wrapper(sender=None, connection=None, **kwargs):
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_wrapper)
+
+
+def instrument_database():
+    for connection in connections.all(initialized_only=True):
+        _install_db_wrapper(connection=connection)
+    connection_created.connect(_install_db_wrapper, dispatch_uid='users.perf.db_wrapper')
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        with track('template'):
+            return super().render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    '''
+    DjangoTemplates whose templates report their render time to track().
+    '''
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class Histogram:
+    '''
+    Log-bucketed histogram, about 5% resolution, mergeable across processes.
+
+    Counts (``exact=True``) are stored as they are.
+    '''
+    GROWTH = 1.05
+    ## Milliseconds below this all land in the first bucket
+    FLOOR = 0.001
+
+    def __init__(self, exact=False, buckets=None):
+        self.exact = exact
+        self.buckets = buckets if buckets is not None else {}
+
+    def add(self, value):
+        if self.exact:
+            key = int(value)
+        else:
+            key = math.ceil(math.log(max(value, self.FLOOR) / self.FLOOR, self.GROWTH))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+
+    def value(self, key):
+        return key if self.exact else self.FLOOR * self.GROWTH ** key
+
+    def percentile(self, pct):
+        total = self.count
+        if not total:
+            return 0.0
+        rank = pct / 100 * total
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                return self.value(key)
+        return self.value(max(self.buckets))
+
+    def to_json(self):
+        return {'exact': self.exact, 'buckets': {str(key): count for key, count in self.buckets.items()}}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['exact'], {int(key): count for key, count in data['buckets'].items()})
+
+
+def new_histograms():
+    return {metric: Histogram(exact=(metric == 'queries')) for metric in METRICS}
+
+
+class Recorder:
+    '''
+    Histograms of this process, written to ``directory`` at most every ``flush_interval`` seconds.
+    '''
+    def __init__(self, directory, flush_interval=10):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.views = defaultdict(new_histograms)
+        self._lock = threading.Lock()
+        ## One writer at a time, without holding up record()
+        self._flush_lock = threading.Lock()
+        self._flushed = time.monotonic()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f'perf-{os.getpid()}.json')
+
+    def record(self, name, timings, total):
+        with self._lock:
+            histograms = self.views[name]
+            histograms['total'].add(total * 1000)
+            for category, seconds in timings.seconds.items():
+                histograms[category].add(seconds * 1000)
+            histograms['queries'].add(timings.queries)
+            now = time.monotonic()
+            due = now - self._flushed >= self.flush_interval
+            if due:
+                ## Claimed here, so only one of the threads that get here together writes
+                self._flushed = now
+        if due:
+            try:
+                self.flush()
+            except Exception:
+                ## The request was served, losing a dump is not worth a 500
+                logger.exception('Could not write the performance histograms to %s', self.path)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._flushed = time.monotonic()
+                data = {
+                    name: {metric: histogram.to_json() for metric, histogram in histograms.items()}
+                    for name, histograms in self.views.items()
+                }
+            if not data:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            ## Each process owns its file; replace it whole so readers never see half of it
+            handle, tmp = tempfile.mkstemp(dir=self.directory, prefix=f'perf-{os.getpid()}-', suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'w') as stream:
+                    json.dump({'pid': os.getpid(), 'views': data}, stream)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+
+def load_histograms(directory):
+    '''
+    Merge the dumps of every process in ``directory``: {url name: {metric: Histogram}}.
+    '''
+    views = defaultdict(new_histograms)
+    if not os.path.isdir(directory):
+        return views
+    for filename in sorted(os.listdir(directory)):
+        if not (filename.startswith('perf-') and filename.endswith('.json')):
+            continue
+        with open(os.path.join(directory, filename)) as handle:
+            dump = json.load(handle)
+        for name, metrics in dump['views'].items():
+            for metric, data in metrics.items():
+                views[name][metric].merge(Histogram.from_json(data))
+    return views
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = Recorder(settings.PERF_DIR, settings.PERF_FLUSH_INTERVAL)
+                atexit.register(_recorder.flush)
+    return _recorder
+
+
+def server_timing(timings, total):
+    parts = [
+        f'db;dur={timings.seconds["db"] * 1000:.2f};desc="{timings.queries} queries"',
+        f'template;dur={timings.seconds["template"] * 1000:.2f}',
+        f'hash;dur={timings.seconds["hash"] * 1000:.2f}',
+        f'mail;dur={timings.seconds["mail"] * 1000:.2f}',
+        f'total;dur={total * 1000:.2f}',
+    ]
+    return ', '.join(parts)
+
+
+class PerfMiddleware:
+    '''
+    Time every request, add a Server-Timing header and record it per URL name.
+
+    Goes first in MIDDLEWARE so the total covers the whole stack.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PERF_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        instrument_database()
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _timings.reset(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        total = time.perf_counter() - timings.started
+        if settings.PERF_SERVER_TIMING:
+            response['Server-Timing'] = server_timing(timings, total)
+        match = getattr(request, 'resolver_match', None)
+        get_recorder().record(match.url_name if match and match.url_name else 'unresolved', timings, total)
+        return response
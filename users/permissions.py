@@ -0,0 +1,97 @@
+'''
+Cross-request cache of user permissions, for EmailOrUsernameModelBackend.
+
+ModelBackend loads the permissions of a user (their own and their groups')
+on every request that checks one, and keeps them on the user instance
+only. Here the set lives in the default cache as a bitset of Permission
+ids: one int of a few dozen bytes however many groups the user is in.
+It is turned back into "app_label.codename" names through a per-process
+table of all permissions, which is reloaded when the permission
+generation changes.
+
+Invalidation (users.signals):
+
+    user saved, user.groups or user.user_permissions changed    that user
+    group permissions changed, group or permission edited        everybody
+
+AUTH_PERMISSION_CACHE_TTL = 0 turns the cache off.
+'''
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+
+from users.caching import permission_cache_key
+
+
+def permission_bits(user):
+    '''
+    Bitset of the ids of the permissions of ``user``, in one query.
+    '''
+    if user.is_superuser:
+        ids = Permission.objects.values_list('pk', flat=True)
+    else:
+        ## Permission.Meta.ordering is not allowed inside a UNION
+        own = Permission.objects.filter(user=user).order_by().values_list('pk', flat=True)
+        ids = own.union(Permission.objects.filter(group__user=user).order_by().values_list('pk', flat=True))
+    bits = 0
+    for pk in ids:
+        bits |= 1 << pk
+    return bits
+
+
+class PermissionTable:
+    '''
+    Permission id -> "app_label.codename", for one permission generation.
+    '''
+    def __init__(self):
+        self.generation = None
+        self.names = {}
+        self._lock = threading.Lock()
+
+    def load(self, generation):
+        names = {
+            pk: f'{app_label}.{codename}'
+            for pk, app_label, codename in Permission.objects.values_list('pk', 'content_type__app_label', 'codename')
+        }
+        with self._lock:
+            self.names, self.generation = names, generation
+
+    def decode(self, bits, generation):
+        if generation != self.generation:
+            self.load(generation)
+        names, missing = self._names(bits)
+        if missing:
+            ## Created without a signal (migrate bulk creates them), or deleted since
+            self.load(generation)
+            names, _ = self._names(bits)
+        return names
+
+    def _names(self, bits):
+        names, missing = set(), False
+        lookup = self.names
+        while bits:
+            lowest = bits & -bits
+            name = lookup.get(lowest.bit_length() - 1)
+            if name is None:
+                missing = True
+            else:
+                names.add(name)
+            bits ^= lowest
+        return names, missing
+
+
+table = PermissionTable()
+
+
+def get_permissions(user):
+    '''
+    The "app_label.codename" permissions of ``user``, from the cache when possible.
+    '''
+    key, generation = permission_cache_key(user.pk)
+    bits = cache.get(key)
+    if bits is None:
+        bits = permission_bits(user)
+        cache.set(key, bits, settings.AUTH_PERMISSION_CACHE_TTL)
+    return table.decode(bits, generation)
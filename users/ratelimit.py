@@ -0,0 +1,422 @@
+'''
+Sliding-window rate limiting with progressive lockout for the login and
+forgot-password views.
+
+Each limiter has rules keyed by client IP, by the submitted identifier and
+by both together. ``check()`` costs a single ``get_many`` on the store and
+runs before the view touches the database or the password hasher, so
+rejected requests are cheap. Every time a rule trips, the offending key is
+locked out for ``RATELIMIT_LOCKOUT_BASE * 2 ** (strikes - 1)`` seconds,
+capped at ``RATELIMIT_LOCKOUT_MAX``.
+
+The client IP is REMOTE_ADDR. Behind reverse proxies, list them in
+``RATELIMIT_TRUSTED_PROXIES`` (addresses or networks): requests they
+forward are keyed by the right-most X-Forwarded-For hop that is not a
+trusted proxy, the one a client cannot forge.
+
+Stores (``RATELIMIT_STORE``): ``locmem`` (bounded in-process LRU, one
+budget per worker), ``cache`` (Django's cache framework) and ``redis``
+(any Redis-compatible server at ``RATELIMIT_REDIS_URL``, needs redis-py).
+Async views use ``acheck()``, ``ahit()`` and ``areset()``: the cache store
+goes through the async cache API, the Redis client runs in a thread.
+'''
+import hashlib
+import ipaddress
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+Rule = namedtuple('Rule', ['scope', 'limit', 'window'])
+
+## Wall clock for windows and lockouts (windows must line up across workers)
+clock = time.time
+
+## scope is one of "ip", "identifier" or "ip_identifier"; window is in seconds
+LOGIN_RULES = [
+    Rule('ip', 30, 60),
+    Rule('identifier', 10, 900),
+    Rule('ip_identifier', 5, 300),
+]
+FORGOT_PASSWORD_RULES = [
+    Rule('ip', 5, 900),
+    Rule('identifier', 3, 3600),
+]
+
+
+class Store:
+    '''
+    Async methods of a store that only has sync ones, run in a thread.
+    '''
+    async def aget_many(self, keys):
+        return await sync_to_async(self.get_many)(keys)
+
+    async def aincr(self, key, ttl):
+        return await sync_to_async(self.incr)(key, ttl)
+
+    async def aset(self, key, value, ttl):
+        await sync_to_async(self.set)(key, value, ttl)
+
+    async def adelete_many(self, keys):
+        await sync_to_async(self.delete_many)(keys)
+
+
+class LocMemStore(Store):
+    '''
+    Thread-safe, size-bounded in-process store.
+    '''
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= now:
+            del self._data[key]
+            return None
+        return item[0]
+
+    def _set(self, key, value, ttl, now):
+        self._data[key] = (value, now + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            values = {key: self._get(key, now) for key in keys}
+        return {key: value for key, value in values.items() if value is not None}
+
+    def incr(self, key, ttl):
+        now = time.monotonic()
+        with self._lock:
+            value = (self._get(key, now) or 0) + 1
+            expires = self._data[key][1] if value > 1 else now + ttl
+            self._set(key, value, expires - now, now)
+        return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._set(key, value, ttl, time.monotonic())
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    ## Memory only, the event loop can wait for the lock
+    async def aget_many(self, keys):
+        return self.get_many(keys)
+
+    async def aincr(self, key, ttl):
+        return self.incr(key, ttl)
+
+    async def aset(self, key, value, ttl):
+        self.set(key, value, ttl)
+
+    async def adelete_many(self, keys):
+        self.delete_many(keys)
+
+
+class CacheStore(Store):
+    '''
+    Store on top of a Django cache alias, shared by every worker using it.
+    '''
+    def __init__(self, alias='default'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def incr(self, key, ttl):
+        self.cache.add(key, 0, ttl)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            ## Expired between add() and incr()
+            self.cache.set(key, 1, ttl)
+            return 1
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+    async def aget_many(self, keys):
+        return await self.cache.aget_many(keys)
+
+    async def aincr(self, key, ttl):
+        await self.cache.aadd(key, 0, ttl)
+        try:
+            return await self.cache.aincr(key)
+        except ValueError:
+            await self.cache.aset(key, 1, ttl)
+            return 1
+
+    async def aset(self, key, value, ttl):
+        await self.cache.aset(key, value, ttl)
+
+    async def adelete_many(self, keys):
+        await self.cache.adelete_many(keys)
+
+
+class RedisStore(Store):
+    '''
+    Store on a Redis-compatible server; counters use SET NX EX + INCR.
+    '''
+    def __init__(self, url):
+        if redis is None:
+            raise ImproperlyConfigured('RATELIMIT_STORE = "redis" requires the redis package.')
+        self.client = redis.Redis.from_url(url)
+
+    def get_many(self, keys):
+        values = self.client.mget(keys)
+        return {key: float(value) for key, value in zip(keys, values) if value is not None}
+
+    def incr(self, key, ttl):
+        pipe = self.client.pipeline()
+        pipe.set(key, 0, ex=int(ttl) + 1, nx=True)
+        pipe.incr(key)
+        return pipe.execute()[1]
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=max(1, int(ttl)))
+
+    def delete_many(self, keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter('rl:*'))
+        self.delete_many(keys)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                kind = getattr(settings, 'RATELIMIT_STORE', 'locmem')
+                if kind == 'cache':
+                    _store = CacheStore(getattr(settings, 'RATELIMIT_CACHE_ALIAS', 'default'))
+                elif kind == 'redis':
+                    _store = RedisStore(settings.RATELIMIT_REDIS_URL)
+                elif kind == 'locmem':
+                    _store = LocMemStore()
+                else:
+                    raise ImproperlyConfigured(f'Unknown RATELIMIT_STORE {kind!r}')
+    return _store
+
+
+_trusted_proxies = None
+
+
+@receiver(setting_changed)
+def reset_store(*, setting, **kwargs):
+    global _store, _trusted_proxies
+    if setting.startswith('RATELIMIT_'):
+        _store = None
+        _trusted_proxies = None
+
+
+def trusted_proxies():
+    global _trusted_proxies
+    if _trusted_proxies is None:
+        try:
+            _trusted_proxies = [ipaddress.ip_network(proxy.strip(), strict=False) for proxy in settings.RATELIMIT_TRUSTED_PROXIES]
+        except ValueError as error:
+            raise ImproperlyConfigured(f'Invalid RATELIMIT_TRUSTED_PROXIES: {error}')
+    return _trusted_proxies
+
+
+def _trusted(address, proxies):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in proxies)
+
+
+def client_ip(request):
+    '''
+    REMOTE_ADDR, or behind trusted proxies the right-most X-Forwarded-For hop that is not one of them.
+    '''
+    address = request.META.get('REMOTE_ADDR', '')
+    proxies = trusted_proxies()
+    if not proxies or not _trusted(address, proxies):
+        return address
+    ## Each proxy appends the address it got the request from, so the hops left of the last untrusted one are forgeable
+    for hop in reversed(request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        hop = hop.strip()
+        if not hop:
+            continue
+        address = hop
+        if not _trusted(hop, proxies):
+            break
+    return address
+
+
+def _digest(value):
+    ## Keeps keys short and safe for memcached whatever the user typed
+    return hashlib.blake2b(value.encode(), digest_size=8).hexdigest()
+
+
+class RateLimiter:
+    def __init__(self, name, rules, store=None):
+        self.name = name
+        self.rules = rules
+        self._store = store
+
+    @property
+    def store(self):
+        return self._store or get_store()
+
+    def _scope_key(self, rule, ip, identifier):
+        value = {'ip': ip, 'identifier': identifier, 'ip_identifier': f'{ip}|{identifier}'}[rule.scope]
+        return f'rl:{self.name}:{rule.scope}:{_digest(value)}'
+
+    def _keys(self, ip, identifier, now):
+        for rule in self.rules:
+            if rule.scope != 'ip' and not identifier:
+                continue
+            base = self._scope_key(rule, ip, identifier)
+            window = int(now // rule.window)
+            yield rule, base, f'{base}:{window}', f'{base}:{window - 1}', (now % rule.window) / rule.window
+
+    def _wanted(self, keys):
+        wanted = []
+        for _, base, current, previous, _ in keys:
+            wanted += [f'{base}:lock', current, previous]
+        return wanted
+
+    def _verdict(self, keys, values, now):
+        '''
+        (seconds left of a lockout, None), or (None, base key of the first rule that trips).
+        '''
+        for rule, base, current, previous, elapsed in keys:
+            locked_until = values.get(f'{base}:lock')
+            if locked_until and float(locked_until) > now:
+                return int(float(locked_until) - now) + 1, None
+            ## Sliding window estimate: what is left of the previous window plus this one
+            estimate = values.get(previous, 0) * (1 - elapsed) + values.get(current, 0)
+            if estimate >= rule.limit:
+                return None, base
+        return None, None
+
+    def check(self, ip, identifier=''):
+        '''
+        Return the seconds to wait if the client is limited, else None.
+        '''
+        now = clock()
+        keys = list(self._keys(ip, identifier, now))
+        retry_after, tripped = self._verdict(keys, self.store.get_many(self._wanted(keys)), now)
+        if tripped is not None:
+            lockout_max = getattr(settings, 'RATELIMIT_LOCKOUT_MAX', 3600)
+            duration = self._lockout(self.store.incr(f'{tripped}:strikes', lockout_max * 4))
+            self.store.set(f'{tripped}:lock', now + duration, duration)
+            return duration
+        return retry_after
+
+    async def acheck(self, ip, identifier=''):
+        now = clock()
+        keys = list(self._keys(ip, identifier, now))
+        retry_after, tripped = self._verdict(keys, await self.store.aget_many(self._wanted(keys)), now)
+        if tripped is not None:
+            lockout_max = getattr(settings, 'RATELIMIT_LOCKOUT_MAX', 3600)
+            duration = self._lockout(await self.store.aincr(f'{tripped}:strikes', lockout_max * 4))
+            await self.store.aset(f'{tripped}:lock', now + duration, duration)
+            return duration
+        return retry_after
+
+    def _lockout(self, strikes):
+        lockout_max = getattr(settings, 'RATELIMIT_LOCKOUT_MAX', 3600)
+        return int(min(getattr(settings, 'RATELIMIT_LOCKOUT_BASE', 30) * 2 ** (strikes - 1), lockout_max))
+
+    def hit(self, ip, identifier=''):
+        '''
+        Count one attempt against every rule.
+        '''
+        now = clock()
+        for rule, _, current, _, _ in self._keys(ip, identifier, now):
+            self.store.incr(current, rule.window * 2)
+
+    async def ahit(self, ip, identifier=''):
+        now = clock()
+        for rule, _, current, _, _ in self._keys(ip, identifier, now):
+            await self.store.aincr(current, rule.window * 2)
+
+    def _reset_keys(self, ip, identifier):
+        keys = []
+        now = clock()
+        for rule, base, current, previous, _ in self._keys(ip, identifier, now):
+            if rule.scope != 'ip':
+                keys += [current, previous, f'{base}:strikes', f'{base}:lock']
+        return keys
+
+    def reset(self, ip, identifier=''):
+        '''
+        Forget counters and strikes for this identifier, e.g. after a successful login.
+        '''
+        self.store.delete_many(self._reset_keys(ip, identifier))
+
+    async def areset(self, ip, identifier=''):
+        await self.store.adelete_many(self._reset_keys(ip, identifier))
+
+
+login_limiter = RateLimiter('login', LOGIN_RULES)
+forgot_password_limiter = RateLimiter('forgot', FORGOT_PASSWORD_RULES)
+
+
+def too_many_requests(retry_after):
+    response = HttpResponse('Too many attempts, please try again later.', status=429, content_type='text/plain')
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def ratelimit(limiter, field, normalize=str):
+    '''
+    Reject rate limited POSTs before the view runs (no session, DB or hashing work).
+
+    ``field`` is the POST field holding the identifier. The view is
+    responsible for calling ``limiter.ahit()``/``areset()`` with the outcome.
+    '''
+    def decorator(view_func):
+        @wraps(view_func)
+        async def _wrapper_view(request, *args, **kwargs):
+            if request.method == 'POST' and getattr(settings, 'RATELIMIT_ENABLED', True):
+                identifier = normalize(request.POST.get(field, ''))
+                retry_after = await limiter.acheck(client_ip(request), identifier)
+                if retry_after is not None:
+                    return too_many_requests(retry_after)
+            return await view_func(request, *args, **kwargs)
+        return _wrapper_view
+    return decorator
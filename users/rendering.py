@@ -0,0 +1,143 @@
+'''
+Precompiled pages for anonymous visitors.
+
+login, signup and forgot password render the same HTML for every anonymous
+GET except for the CSRF token and the flash messages. ``render_shell()``
+renders such a page once per process with placeholders in those two spots
+and then only splices the per-request values in.
+
+Shells are rebuilt when the runserver autoreloader sees a template change,
+and TEMPLATE_SHELLS = False turns the whole thing off.
+
+Pages of a logged in user get a validator instead: ``page_etag()``, or
+``apage_etag()`` in async views, changes whenever the page could, so a
+revisit is answered 304 without rendering (users.decorators.conditional_page).
+'''
+import hashlib
+import os
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages import get_messages
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.autoreload import file_changed
+
+from users.caching import auser_cache_key, user_cache_key
+from users.perf import track
+
+## Plain word characters, so autoescaping leaves them alone
+CSRF_PLACEHOLDER = '__wbytes_shell_csrf_token__'
+MESSAGES_PLACEHOLDER = '__wbytes_shell_messages__'
+
+_shells = {}
+_shells_lock = threading.Lock()
+_template_version = None
+
+
+def build_shell(template_name, context):
+    return render_to_string(template_name, {
+        **context,
+        'user': AnonymousUser(),
+        'csrf_token': CSRF_PLACEHOLDER,
+        'messages_placeholder': MESSAGES_PLACEHOLDER,
+    })
+
+
+def get_shell(template_name, context_factory):
+    shell = _shells.get(template_name)
+    if shell is None:
+        shell = build_shell(template_name, context_factory())
+        with _shells_lock:
+            _shells[template_name] = shell
+    return shell
+
+
+def render_shell(request, template_name, context_factory):
+    '''
+    Anonymous GET of a page whose context never changes (``context_factory()``).
+
+    Falls back to a normal render when shells are disabled.
+    '''
+    if not getattr(settings, 'TEMPLATE_SHELLS', True):
+        return render(request, template_name, context_factory())
+
+    shell = get_shell(template_name, context_factory)
+    with track('template'):
+        messages = get_messages(request)
+        messages_html = render_to_string('users/messages.html', {'messages': messages}) if messages else ''
+        ## get_token() also makes sure the CSRF cookie goes out, like {% csrf_token %}
+        content = shell.replace(CSRF_PLACEHOLDER, get_token(request)).replace(MESSAGES_PLACEHOLDER, messages_html)
+    return HttpResponse(content)
+
+
+def template_version():
+    '''
+    Digest of the templates and the static manifest, read once per process like the templates.
+    '''
+    global _template_version
+    if _template_version is None:
+        digest = hashlib.sha256()
+        root = os.path.join(os.path.dirname(__file__), 'templates')
+        manifest = os.path.join(settings.STATIC_ROOT or '', 'staticfiles.json')
+        paths = sorted(os.path.join(path, name) for path, _, names in os.walk(root) for name in names)
+        for path in [*paths, manifest]:
+            if os.path.isfile(path):
+                with open(path, 'rb') as handle:
+                    digest.update(handle.read())
+        _template_version = digest.hexdigest()
+    return _template_version
+
+
+def page_etag(request, user):
+    '''
+    Weak ETag of a page that only depends on ``user``, or None when it cannot have one.
+
+    Changes with the user's cache version (any save of the user), the CSRF
+    secret (rotated at login) and the templates. None while messages are
+    waiting: showing them consumes them.
+    '''
+    secret = request.META.get('CSRF_COOKIE')
+    if not secret or len(get_messages(request)):
+        return None
+    return _etag(user_cache_key(user.pk), secret)
+
+
+async def apage_etag(request, user):
+    '''
+    page_etag() for async views, after ``await request.auser()``: the
+    session the messages are read from is loaded by then.
+    '''
+    secret = request.META.get('CSRF_COOKIE')
+    if not secret or len(get_messages(request)):
+        return None
+    return _etag(await auser_cache_key(user.pk), secret)
+
+
+def _etag(user_key, secret):
+    key = f'{user_key}|{secret}|{template_version()}'
+    return f'W/"{hashlib.sha256(key.encode()).hexdigest()[:32]}"'
+
+
+def clear_shells():
+    global _template_version
+    with _shells_lock:
+        _shells.clear()
+        _template_version = None
+
+
+@receiver(file_changed, dispatch_uid='users.rendering.template_changed')
+def template_changed(sender, file_path, **kwargs):
+    if file_path.suffix == '.html':
+        clear_shells()
+
+
+@receiver(setting_changed)
+def reset_shells(*, setting, **kwargs):
+    if setting in ('TEMPLATES', 'TEMPLATE_SHELLS', 'STATIC_ROOT'):
+        clear_shells()
@@ -0,0 +1,205 @@
+'''
+Read replica routing, configured with DB_REPLICAS in the settings.
+
+Reads go to a replica only inside ``replica_reads()``: the read-only views
+(users.decorators.use_replicas) and session user loads
+(EmailOrUsernameModelBackend.get_user). Everything else, writes and the
+reads done in order to write, stays on the primary and never sees
+replication lag. One replica is picked per replica_reads() block, so a
+request does not mix the states of two replicas.
+
+A request that writes pins its client to the primary for
+REPLICA_STICKY_SECONDS with a cookie (StickyPrimaryMiddleware): whoever
+just signed up or changed their password reads their own write even while
+the replicas catch up.
+
+REPLICA_SELECTION is "round_robin" or "least_latency": the replica with
+the lowest moving average of query time, every PROBE_EVERY-th pick going
+round robin so a replica that was slow gets measured again.
+'''
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+STICKY_COOKIE = 'pin_primary'
+PROBE_EVERY = 20
+## Weight of the newest query time in a replica's moving average
+LATENCY_WEIGHT = 0.2
+
+## Tests move time forward by replacing this
+clock = time.time
+
+## Alias the current replica_reads() block reads from
+_replica = ContextVar('replica_alias', default=None)
+## RoutingState of the current request, set by StickyPrimaryMiddleware
+_request = ContextVar('replica_request', default=None)
+
+
+class RoutingState:
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        ## Set from any thread or task the request runs in, hence an attribute and not a ContextVar
+        self.wrote = False
+
+
+class ReplicaSelector:
+    def __init__(self):
+        self._picks = itertools.count()
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def choose(self, replicas):
+        pick = next(self._picks)
+        if settings.REPLICA_SELECTION == 'least_latency':
+            if pick % PROBE_EVERY:
+                ## Never measured counts as fastest, so every replica gets a first sample
+                return min(replicas, key=lambda alias: self._latencies.get(alias, 0.0))
+            ## Probes take turns over the replicas
+            pick //= PROBE_EVERY
+        return replicas[pick % len(replicas)]
+
+    def record(self, alias, seconds):
+        with self._lock:
+            previous = self._latencies.get(alias)
+            self._latencies[alias] = seconds if previous is None else previous + LATENCY_WEIGHT * (seconds - previous)
+
+    def latencies(self):
+        return dict(self._latencies)
+
+
+selector = ReplicaSelector()
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+@contextmanager
+def replica_reads():
+    '''
+    Route the reads of the block to a replica, unless the request is pinned to the primary.
+    '''
+    if _replica.get() is not None:
+        yield
+        return
+    state = _request.get()
+    aliases = replicas()
+    alias = selector.choose(aliases) if aliases and not (state and state.pinned) else DEFAULT_DB_ALIAS
+    token = _replica.set(alias)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+class ReplicaRouter:
+    '''
+    Replicas for reads inside replica_reads(), the primary for everything else.
+
+    Both answers are explicit: without a router answer Django would follow
+    the database an instance was loaded from, sending writes of replica
+    loaded users to the replica.
+    '''
+    def db_for_read(self, model, **hints):
+        return _replica.get() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _request.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        ## Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        ## Replicas get their schema through replication
+        return False if db in replicas() else None
+
+
+class StickyPrimaryMiddleware:
+    '''
+    Pin clients that just wrote to the primary for REPLICA_STICKY_SECONDS.
+
+    Goes before SessionMiddleware so session writes count too.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not replicas():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = RoutingState(self.pinned(request))
+        token = _request.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.reset(token)
+        return self.finish(state, response)
+
+    async def __acall__(self, request):
+        state = RoutingState(self.pinned(request))
+        token = _request.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request.reset(token)
+        return self.finish(state, response)
+
+    def pinned(self, request):
+        try:
+            until = float(request.COOKIES.get(STICKY_COOKIE, ''))
+        except ValueError:
+            return False
+        now = clock()
+        ## A cookie from the future was not set by us, it must not pin a client for good
+        return now < until <= now + settings.REPLICA_STICKY_SECONDS
+
+    def finish(self, state, response):
+        window = settings.REPLICA_STICKY_SECONDS
+        if state.wrote and window > 0:
+            response.set_cookie(
+                STICKY_COOKIE, str(int(clock() + window)), max_age=window,
+                secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+            )
+        return response
+
+
+def _time_replica_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        selector.record(context['connection'].alias, time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def measure_replica(sender, connection, **kwargs):
+    if connection.alias in replicas() and _time_replica_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_replica_query)
+
+
+@receiver(setting_changed)
+def reset_selector(*, setting, **kwargs):
+    global selector
+    if setting in ('DATABASE_REPLICAS', 'REPLICA_SELECTION'):
+        selector = ReplicaSelector()
@@ -0,0 +1,455 @@
+'''
+Horizontal sharding of users, configured with USER_SHARDS in the settings.
+
+Each user row lives on one shard (shard1, shard2...), picked by
+rendezvous hashing of the lowercased email: adding a shard only moves the
+users that now hash to it. Staff users, and users with groups or
+permissions, stay on the default database with the groups, permissions,
+sessions, admin log, mail queue, login audit and refresh tokens, which are
+not sharded.
+
+The UserDirectory table on the default database maps every user id to its
+shard:
+
+- create() inserts the directory row first. That gives the user its id
+  on every database and checks the username against all shards. Then it
+  inserts the user on its shard.
+- Logins look the email or username up in the directory, then read the
+  user from its shard: two indexed queries.
+- Session user loads and other by-id reads go through db_for_user().
+  Writes go through write(): CustomUser.save(), the batched last_login
+  updates and rehashes. It waits while the users are being moved, writes
+  on their shard and reads the directory again before committing; a
+  user that moved in between is written again on its new shard. An
+  instance loaded before a move still writes to the user's new shard.
+- Users with no directory row are on the default database.
+- A shard user made staff or superuser, or given a group or permission,
+  is moved to the default database first, see move_to_default(): by
+  CustomUser.save(), by ShardRouter for ``user.groups`` and
+  ``user.user_permissions`` and by a signal for ``group.user_set`` and
+  ``permission.user_set``.
+
+Every new user goes through create(): CustomUser.objects.create_user()
+and create_superuser(), signup and the admin's add user form. users_import
+refuses to run while sharding is on.
+
+Turning sharding on: migrate every shard, then run ``manage.py
+rebalance_users``. It adds the users already on the default database to
+the directory and moves them out in batches. New users cannot be created
+on shards until that is done. Run it again after adding a shard. Only one
+run at a time.
+
+Not sharded: the admin changelist and users_export only see the default
+database.
+'''
+import hashlib
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.color import no_style
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, OperationalError, connections, transaction
+from django.db.models import F, Max
+from django.dispatch import receiver
+
+from users.caching import invalidate_users
+from users.models import CustomUser, UserDirectory
+
+## Set once the directory is known to be ahead of the ids on the default database
+_directory_checked = False
+
+## Seconds between two looks at the directory while a user is being moved
+MOVE_POLL = 0.05
+
+
+class _Moved(Exception):
+    '''
+    Rolls back a write() whose users moved while it was writing.
+    '''
+
+
+def shards():
+    return getattr(settings, 'DATABASE_SHARDS', [])
+
+
+def shard_for_email(email, aliases=None):
+    '''
+    The shard with the highest hash of (shard, email): stable, and spreads users evenly.
+    '''
+    email = email.strip().lower()
+    return max(aliases or shards(), key=lambda alias: hashlib.blake2b(f'{alias}:{email}'.encode(), digest_size=8).digest())
+
+
+def placement(user, has_permissions=False):
+    '''
+    The database ``user`` belongs on.
+    '''
+    if user.is_staff or user.is_superuser or has_permissions:
+        return DEFAULT_DB_ALIAS
+    return shard_for_email(user.email)
+
+
+def directory():
+    ## Always the primary: a lagging replica would send a new user to the default database
+    return UserDirectory.objects.using(DEFAULT_DB_ALIAS)
+
+
+def _alias(shard):
+    ## None leaves users of the default database to the other routers, replicas included
+    return None if shard in (None, DEFAULT_DB_ALIAS) else shard
+
+
+def _identifier_filter(identifier):
+    if '@' in identifier:
+        return {'email': identifier.strip().lower()}
+    return {'username': identifier}
+
+
+def db_for_user(user_id):
+    '''
+    The shard of ``user_id``, or None for the default database (and when sharding is off).
+    '''
+    if not shards():
+        return None
+    return _alias(directory().filter(pk=user_id).values_list('shard', flat=True).first())
+
+
+async def adb_for_user(user_id):
+    if not shards():
+        return None
+    return _alias(await directory().filter(pk=user_id).values_list('shard', flat=True).afirst())
+
+
+def _wait_for_moves(user_ids):
+    '''
+    {user id: shard} of ``user_ids`` once none of them is being moved.
+
+    Raises OperationalError after SHARD_MOVE_WAIT seconds.
+    '''
+    deadline = time.monotonic() + getattr(settings, 'SHARD_MOVE_WAIT', 10)
+    while True:
+        rows = directory().filter(pk__in=user_ids).values_list('pk', 'shard', 'moving')
+        homes, moving = {}, False
+        for pk, shard, is_moving in rows:
+            homes[pk] = shard
+            moving = moving or is_moving
+        if not moving:
+            return homes
+        if time.monotonic() >= deadline:
+            raise OperationalError('Users are being moved to another shard, try again later.')
+        time.sleep(MOVE_POLL)
+
+
+def db_for_user_write(user_id):
+    '''
+    db_for_user() for a write: waits while the user is being moved, so the
+    write lands on the shard the move leaves the user on.
+    '''
+    if not shards():
+        return None
+    return _alias(_wait_for_moves([user_id]).get(user_id))
+
+
+def db_for_identifier(identifier):
+    '''
+    The shard of the user with this email or username, or None as for db_for_user().
+    '''
+    if not shards():
+        return None
+    return _alias(directory().filter(**_identifier_filter(identifier)).values_list('shard', flat=True).first())
+
+
+async def adb_for_identifier(identifier):
+    if not shards():
+        return None
+    return _alias(await directory().filter(**_identifier_filter(identifier)).values_list('shard', flat=True).afirst())
+
+
+def _moved(user_ids, homes):
+    ## Whether any of ``user_ids`` is being moved, or left the shard it had in ``homes``
+    rows = directory().filter(pk__in=user_ids).values_list('pk', 'shard', 'moving')
+    return any(is_moving or _alias(shard) != _alias(homes.get(pk)) for pk, shard, is_moving in rows)
+
+
+def write(user_ids, apply):
+    '''
+    Call ``apply(using, user_ids)`` once per database ``user_ids`` live on,
+    in a transaction on it, and return the results.
+
+    The directory is read again before the transaction commits: if some of
+    the users are being moved, or were moved while ``apply`` waited for the
+    lock move() holds, the transaction is rolled back and their write is
+    done again on their new shard. A write that committed first is in the
+    copy move() makes. With sharding off, ``apply`` gets None as ``using``
+    and runs once, without a transaction of its own.
+    '''
+    user_ids = list(user_ids)
+    if not shards():
+        return [apply(None, user_ids)]
+    results = []
+    while user_ids:
+        homes = _wait_for_moves(user_ids)
+        groups = defaultdict(list)
+        for user_id in user_ids:
+            groups[_alias(homes.get(user_id)) or DEFAULT_DB_ALIAS].append(user_id)
+        user_ids = []
+        for using, group in groups.items():
+            try:
+                with transaction.atomic(using=using):
+                    result = apply(using, group)
+                    if _moved(group, homes):
+                        raise _Moved
+            except _Moved:
+                user_ids.extend(group)
+                continue
+            except DatabaseError:
+                ## A save(update_fields=...) of a user move() just deleted here finds no row
+                if not _moved(group, homes):
+                    raise
+                user_ids.extend(group)
+                continue
+            results.append(result)
+    return results
+
+
+async def aget_user(user_id):
+    return await CustomUser._default_manager.db_manager(await adb_for_user(user_id)).filter(pk=user_id).afirst()
+
+
+def _check_directory():
+    global _directory_checked
+    if _directory_checked:
+        return
+    highest = CustomUser._default_manager.using(DEFAULT_DB_ALIAS).aggregate(highest=Max('pk'))['highest']
+    if highest and not directory().filter(pk__gte=highest).exists():
+        ## The directory would hand out ids those users already have
+        raise ImproperlyConfigured(
+            'Users on the default database are missing from the user directory, '
+            'run "manage.py rebalance_users" before creating users on shards.'
+        )
+    _directory_checked = True
+
+
+def create(user, has_permissions=False):
+    '''
+    Insert the new ``user``: its directory row, then the user on its shard.
+
+    Raises IntegrityError, like a single database would, when the username
+    or email is taken.
+    '''
+    _check_directory()
+    shard = placement(user, has_permissions)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        entry = directory().create(email=user.email.strip().lower(), username=user.username, shard=shard)
+    user.pk = entry.pk
+    try:
+        with transaction.atomic(using=shard):
+            user.save(using=shard, force_insert=True)
+    except Exception:
+        entry.delete(using=DEFAULT_DB_ALIAS)
+        user.pk = None
+        raise
+    return user
+
+
+def move_to_default(user_ids):
+    '''
+    Move those of ``user_ids`` that live on a shard to the default database,
+    where staff and users with groups or permissions belong.
+
+    The move commits on its own: a transaction around it that rolls back
+    does not bring the users back.
+    '''
+    if not shards():
+        return
+    sources = defaultdict(list)
+    for user_id, shard in _wait_for_moves(list(user_ids)).items():
+        if _alias(shard):
+            sources[shard].append(user_id)
+    for source, ids in sources.items():
+        move([CustomUser(pk=user_id) for user_id in ids], source, DEFAULT_DB_ALIAS)
+
+
+## Rows that refer to groups and permissions, which are only on the default database
+_PERMISSION_THROUGH = (CustomUser.groups.through, CustomUser.user_permissions.through)
+
+
+class ShardRouter:
+    '''
+    Sends user instances to their shard. Everything else falls through to the next router.
+
+    Goes first in DATABASE_ROUTERS.
+    '''
+    def db_for_read(self, model, **hints):
+        ## Related lookups from a user (its groups...) stay on the database it came from
+        instance = hints.get('instance')
+        if isinstance(instance, CustomUser) and instance._state.db:
+            return instance._state.db
+        return None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if model in _PERMISSION_THROUGH:
+            ## user.groups.add() and the like: the user goes where the groups are
+            if isinstance(instance, CustomUser) and instance.pk is not None:
+                move_to_default([instance.pk])
+                instance._state.db = DEFAULT_DB_ALIAS
+            return DEFAULT_DB_ALIAS
+        ## The directory, not the database it came from: the user may have moved since
+        if isinstance(instance, CustomUser) and instance.pk is not None:
+            return db_for_user_write(instance.pk)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        ## Rows on the default database refer to users wherever they live
+        if isinstance(obj1, CustomUser) or isinstance(obj2, CustomUser):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'users' and model_name == 'userdirectory':
+            return db == DEFAULT_DB_ALIAS
+        return None
+
+
+def _with_permissions(using, user_ids):
+    '''
+    Which of ``user_ids`` have groups or permissions on ``using``.
+    '''
+    found = set()
+    for through in (CustomUser.groups.through, CustomUser.user_permissions.through):
+        found.update(through.objects.using(using).filter(customuser_id__in=user_ids).values_list('customuser_id', flat=True))
+    return found
+
+
+def adopt(users):
+    '''
+    Add users of the default database that are not in the directory yet.
+    '''
+    directory().bulk_create([
+        UserDirectory(pk=user.pk, email=user.email.strip().lower(), username=user.username, shard=DEFAULT_DB_ALIAS)
+        for user in users
+    ], ignore_conflicts=True)
+
+
+def _reset_directory_sequence():
+    ## New directory ids must come after the adopted ones (SQLite does this by itself)
+    connection = connections[DEFAULT_DB_ALIAS]
+    statements = connection.ops.sequence_reset_sql(no_style(), [UserDirectory])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+def _lock_users(using, user_ids):
+    '''
+    The users ``user_ids`` on ``using``, locked against writes until the surrounding transaction ends.
+    '''
+    users = CustomUser._default_manager.using(using).filter(pk__in=user_ids)
+    if connections[using].features.has_select_for_update:
+        return list(users.select_for_update())
+    ## SQLite drops FOR UPDATE. A write takes its database write lock, held to the commit like BEGIN IMMEDIATE
+    users.update(password=F('password'))
+    return list(users)
+
+
+def move(users, source, target):
+    '''
+    Move ``users`` (found on ``source``, only their pk is used) to ``target``.
+
+    Their directory rows are marked as moving first: write() then waits
+    until the move is over and writes to ``target``. The users are read
+    again under a write lock, which waits for the writes still in their
+    transaction, copied, their directory rows updated and they are
+    deleted from ``source``, all before the lock is released. Writes that
+    read the directory before the mark and reach ``source`` after the
+    lock find the users moved when write() checks the directory again,
+    and are done again on ``target``. A move that fails clears the mark
+    and leaves the users on ``source``.
+    '''
+    user_ids = [user.pk for user in users]
+    fields = [field.attname for field in CustomUser._meta.concrete_fields]
+    directory().filter(pk__in=user_ids).update(moving=True)
+    try:
+        with transaction.atomic(using=source):
+            rows = _lock_users(source, user_ids)
+            snapshot = {user.pk: {name: getattr(user, name) for name in fields} for user in rows}
+            copies = [CustomUser(**values) for values in snapshot.values()]
+            with transaction.atomic(using=target):
+                ## Left by a move that stopped before updating the directory
+                CustomUser._default_manager.using(target).filter(pk__in=user_ids)._raw_delete(target)
+                CustomUser._default_manager.using(target).bulk_create(copies)
+                ## bulk_create() stamps auto_now_add fields with the current time
+                for copy in copies:
+                    copy.date_joined = snapshot[copy.pk]['date_joined']
+                CustomUser._default_manager.using(target).bulk_update(copies, ['date_joined'])
+            directory().filter(pk__in=user_ids).update(shard=target, moving=False)
+            ## No cascade: refresh tokens and audits on the default database still refer to these users
+            CustomUser._default_manager.using(source).filter(pk__in=user_ids)._raw_delete(source)
+    finally:
+        directory().filter(pk__in=user_ids, moving=True).update(moving=False)
+    invalidate_users(user_ids)
+
+
+def rebalance(batch_size=500, pause=0.0, dry_run=False):
+    '''
+    Move every user that is not on the database placement() picks, ``batch_size`` at a time.
+
+    Returns a Counter of (source, target) -> users moved, plus (source,
+    'leftover') for copies a stopped move left behind, which are deleted.
+    '''
+    moved = Counter()
+    if not dry_run:
+        ## Marks of a run that was killed mid-move, which would keep writes waiting
+        directory().filter(moving=True).update(moving=False)
+    for source in [DEFAULT_DB_ALIAS, *shards()]:
+        last = 0
+        while True:
+            batch = list(CustomUser._default_manager.using(source).filter(pk__gt=last).order_by('pk')[:batch_size])
+            if not batch:
+                break
+            last = batch[-1].pk
+            user_ids = [user.pk for user in batch]
+            if source == DEFAULT_DB_ALIAS and not dry_run:
+                adopt(batch)
+            homes = dict(directory().filter(pk__in=user_ids).values_list('pk', 'shard'))
+            with_permissions = _with_permissions(source, user_ids)
+            targets = defaultdict(list)
+            leftovers = []
+            for user in batch:
+                home = homes.get(user.pk)
+                if home is None and dry_run and source == DEFAULT_DB_ALIAS:
+                    ## Would have been adopted
+                    home = DEFAULT_DB_ALIAS
+                if home is None:
+                    ## Not in the directory, so nothing can find it elsewhere: left where it is
+                    continue
+                if home != source:
+                    leftovers.append(user.pk)
+                    continue
+                target = placement(user, user.pk in with_permissions)
+                if target != source:
+                    targets[target].append(user)
+            if leftovers:
+                if not dry_run:
+                    CustomUser._default_manager.using(source).filter(pk__in=leftovers)._raw_delete(source)
+                moved[source, 'leftover'] += len(leftovers)
+            for target, users in targets.items():
+                if not dry_run:
+                    move(users, source, target)
+                moved[source, target] += len(users)
+            if pause and targets:
+                time.sleep(pause)
+        if source == DEFAULT_DB_ALIAS and not dry_run:
+            _reset_directory_sequence()
+    return moved
+
+
+@receiver(setting_changed)
+def reset_directory_check(*, setting, **kwargs):
+    global _directory_checked
+    if setting == 'DATABASE_SHARDS':
+        _directory_checked = False
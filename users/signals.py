@@ -0,0 +1,88 @@
+from django.contrib.auth.models import Group, Permission
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import sharding
+from .caching import invalidate_all_permissions, invalidate_user, invalidate_users, missing_identifiers, normalize_identifier
+from .models import CustomUser
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def drop_cached_user(sender, instance, **kwargs):
+    ## Covers password changes/resets (set_password + save) and profile edits
+    invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=CustomUser)
+def forget_missing_identifiers(sender, instance, **kwargs):
+    ## A new user, or a new email or username, may be remembered as unknown by the login backend
+    missing_identifiers.discard(normalize_identifier(instance.email), normalize_identifier(instance.username))
+
+
+## The user directory (users.sharding) follows email and username changes and deletions
+
+@receiver(post_save, sender=CustomUser)
+def update_directory(sender, instance, created, update_fields, **kwargs):
+    if created or not sharding.shards():
+        return
+    if update_fields is not None and not {'email', 'username'} & set(update_fields):
+        return
+    email = instance.email.strip().lower()
+    sharding.directory().filter(pk=instance.pk).exclude(email=email, username=instance.username).update(
+        email=email, username=instance.username,
+    )
+
+
+@receiver(post_delete, sender=CustomUser)
+def drop_directory_entry(sender, instance, using, **kwargs):
+    if sharding.shards():
+        ## Only where the directory says it lives: not a copy left behind by a move
+        sharding.directory().filter(pk=instance.pk, shard=using).delete()
+
+
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+@receiver(m2m_changed, sender=CustomUser.user_permissions.through)
+def move_users_given_permissions(sender, action, reverse, pk_set, **kwargs):
+    ## group.user_set.add(): the rows go to the default database, the users have to be there first.
+    ## user.groups.add() is handled by ShardRouter, before the add starts its transaction.
+    if action == 'pre_add' and reverse and pk_set and sharding.shards():
+        sharding.move_to_default(pk_set)
+
+
+@receiver(user_logged_out)
+def drop_cached_user_on_logout(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_user(user.pk)
+
+
+## Cached permission sets (users.permissions)
+
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+@receiver(m2m_changed, sender=CustomUser.user_permissions.through)
+def drop_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_user(instance.pk)
+    elif pk_set:
+        ## group.user_set / permission.user_set: pk_set holds the users
+        invalidate_users(pk_set)
+    else:
+        ## Cleared from the group or permission side, which users were in it is gone
+        invalidate_all_permissions()
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def drop_group_permissions(sender, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_all_permissions()
+
+
+## Deleting a group removes its m2m rows without m2m_changed
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def drop_all_permissions(sender, **kwargs):
+    invalidate_all_permissions()
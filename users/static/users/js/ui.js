@@ -0,0 +1,23 @@
+/*
+ * The two Bootstrap behaviours the templates use, without jQuery:
+ * data-toggle="collapse" (navbar toggler) and data-dismiss="alert".
+ */
+document.addEventListener('click', function (event) {
+    var toggler = event.target.closest('[data-toggle="collapse"]');
+    if (toggler) {
+        var target = document.querySelector(toggler.getAttribute('data-target'));
+        if (target) {
+            var open = target.classList.toggle('show');
+            toggler.classList.toggle('collapsed', !open);
+            toggler.setAttribute('aria-expanded', open ? 'true' : 'false');
+        }
+        return;
+    }
+    var dismiss = event.target.closest('[data-dismiss="alert"]');
+    if (dismiss) {
+        var alert = dismiss.closest('.alert');
+        if (alert) {
+            alert.remove();
+        }
+    }
+});
@@ -0,0 +1,45 @@
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    '''
+    Content-hashed static files plus .gz and .br (when brotli is installed)
+    variants of the text ones, written by collectstatic for
+    users.middleware.StaticFilesMiddleware to serve.
+    '''
+    COMPRESSIBLE = ('.css', '.js', '.svg', '.txt', '.json', '.map', '.html', '.xml')
+    ## Keep a variant only if it saves at least this fraction of the bytes
+    MIN_SAVING = 0.05
+
+    def stored_name(self, name):
+        ## Before collectstatic has run (development, tests) refer to files by their source name
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in set(self.hashed_files.values()):
+            if name.endswith(self.COMPRESSIBLE):
+                self.compress(name)
+
+    def compress(self, name):
+        with self.open(name) as handle:
+            content = handle.read()
+        variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(content, quality=11)))
+        for suffix, compressed in variants:
+            path = self.path(name + suffix)
+            if len(compressed) <= len(content) * (1 - self.MIN_SAVING):
+                with open(path, 'wb') as handle:
+                    handle.write(compressed)
@@ -1,8 +1,54 @@
-from django.test import TestCase
-from django.contrib.auth import get_user_model
+import gzip
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+from urllib.parse import urljoin
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.contrib.auth import HASH_SESSION_KEY, get_user_model
+from django.contrib.admin.sites import site as admin_site
+from django.contrib.auth.models import Group, Permission
+from django.contrib.sessions.models import Session
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.password_validation import get_default_password_validators
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
+from django.core import mail
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, OperationalError, connection, connections, transaction
+from django.db.models import QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.mail.backends.locmem import EmailBackend as LocMemEmailBackend
+from django.test.utils import CaptureQueriesContext
+from django.template import engines
+from django.urls import reverse
+from django.utils import timezone
+
+from benchmarks import suite
+from benchmarks._setup import seed_users
+from users import activity, api_tokens, cleanup, hashers, hashing, mail_queue, middleware, password_filter, perf, ratelimit, rendering, routers, sharding, tokens, views, warmup
+from users.admin import CustomUserAdmin
+from users.caching import get_cached_user, invalidate_user, missing_identifiers, user_cache_key
+from users.custom_auth import EmailOrUsernameModelBackend
+from users.models import LoginAudit, OutboundEmail, RefreshToken
 
 CustomUser = get_user_model()
 
+
+def tearDownModule():
+    ## Nothing buffered by the tests may reach the real database at exit
+    activity.get_writer().discard()
+
 class CustomUserManagerTestCase(TestCase):
     
     def test_create_user(self):
@@ -44,3 +90,1993 @@ class CustomUserManagerTestCase(TestCase):
             CustomUser.objects.create_superuser(email=email, username='', password=password)
         with self.assertRaises(ValueError):
             CustomUser.objects.create_superuser(email='', username=username, password=password)
+
+
+class CountingEmailBackend(LocMemEmailBackend):
+    ## Mimics the SMTP backend: open() only connects when not already connected
+    connects = 0
+    is_open = False
+
+    def open(self):
+        if self.is_open:
+            return False
+        type(self).connects += 1
+        self.is_open = True
+        return True
+
+    def close(self):
+        self.is_open = False
+
+
+class FailingEmailBackend(LocMemEmailBackend):
+    def send_messages(self, messages):
+        raise ConnectionError('SMTP server unavailable')
+
+
+class MailQueueTestCase(TestCase):
+
+    def setUp(self):
+        ratelimit.get_store().clear()
+
+    def test_enqueue_does_not_send(self):
+        mail_queue.enqueue('Subject', 'Body', ['a@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.STATUS_QUEUED).count(), 1)
+
+    @override_settings(EMAIL_BACKEND='users.tests.CountingEmailBackend', MAIL_QUEUE_BATCH_SIZE=10)
+    def test_drain_batches_over_one_connection(self):
+        for i in range(25):
+            mail_queue.enqueue(f'Subject {i}', '<b>Body</b>', [f'user{i}@example.com'], content_subtype='html')
+        CountingEmailBackend.connects = 0
+        connection = mail.get_connection()
+        delivered = mail_queue.drain_all(connection=connection)
+
+        self.assertEqual(delivered, 25)
+        self.assertEqual(len(mail.outbox), 25)
+        self.assertEqual(mail.outbox[0].content_subtype, 'html')
+        self.assertEqual(CountingEmailBackend.connects, 1)
+        self.assertFalse(OutboundEmail.objects.exclude(status=OutboundEmail.STATUS_SENT).exists())
+
+    @override_settings(EMAIL_BACKEND='users.tests.FailingEmailBackend', MAIL_QUEUE_MAX_ATTEMPTS=3)
+    def test_failures_back_off_then_dead_letter(self):
+        queued = mail_queue.enqueue('Subject', 'Body', ['a@example.com'])
+        with self.assertLogs('users.mail_queue', 'WARNING'):
+            self.assertEqual(mail_queue.drain(), 0)
+        queued.refresh_from_db()
+        self.assertEqual(queued.attempts, 1)
+        self.assertEqual(queued.status, OutboundEmail.STATUS_QUEUED)
+        self.assertGreater(queued.next_attempt_at, timezone.now())
+        self.assertIn('SMTP server unavailable', queued.last_error)
+
+        ## Not due yet, so nothing is retried
+        self.assertEqual(mail_queue.claim_batch(), [])
+
+        for _ in range(2):
+            OutboundEmail.objects.filter(pk=queued.pk).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+            with self.assertLogs('users.mail_queue', 'WARNING'):
+                mail_queue.drain()
+        queued.refresh_from_db()
+        self.assertEqual(queued.attempts, 3)
+        self.assertEqual(queued.status, OutboundEmail.STATUS_DEAD)
+
+    def test_retry_delay_is_exponential_and_capped(self):
+        with self.settings(MAIL_QUEUE_RETRY_BACKOFF=10, MAIL_QUEUE_MAX_BACKOFF=60):
+            self.assertEqual(mail_queue.retry_delay(1), timedelta(seconds=10))
+            self.assertEqual(mail_queue.retry_delay(3), timedelta(seconds=40))
+            self.assertEqual(mail_queue.retry_delay(10), timedelta(seconds=60))
+
+    def test_forgot_password_only_enqueues(self):
+        CustomUser.objects.create_user(email='forgot@example.com', username='forgot', password='testpass123')
+        response = self.client.post(reverse('forgot_password'), {'email': 'forgot@example.com'})
+
+        self.assertRedirects(response, reverse('login'))
+        self.assertEqual(len(mail.outbox), 0)
+        queued = OutboundEmail.objects.get()
+        self.assertEqual(queued.recipients, ['forgot@example.com'])
+        self.assertIn('reset-password', queued.body)
+
+        mail_queue.drain()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['forgot@example.com'])
+
+
+class EmailOrUsernameModelBackendTestCase(TestCase):
+
+    def setUp(self):
+        missing_identifiers.clear()
+        ratelimit.get_store().clear()
+        activity.get_writer().discard()
+        self.backend = EmailOrUsernameModelBackend()
+        self.user = CustomUser.objects.create_user(email='Login@Example.com', username='loginuser', password='testpass123')
+
+    def test_authenticate_by_email_or_username(self):
+        self.assertEqual(self.backend.authenticate(None, username='login@example.com', password='testpass123'), self.user)
+        self.assertEqual(self.backend.authenticate(None, username='LOGIN@example.COM', password='testpass123'), self.user)
+        self.assertEqual(self.backend.authenticate(None, username='loginuser', password='testpass123'), self.user)
+        self.assertIsNone(self.backend.authenticate(None, username='loginuser', password='wrong'))
+
+    def test_authenticate_is_one_projected_query(self):
+        with self.assertNumQueries(1) as context:
+            self.backend.authenticate(None, username='login@example.com', password='testpass123')
+        sql = context.captured_queries[0]['sql']
+        self.assertIn('LOWER', sql)
+        self.assertNotIn('date_joined', sql)
+
+    def test_unknown_identifier_is_cached(self):
+        self.assertIsNone(self.backend.authenticate(None, username='ghost@example.com', password='x'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.backend.authenticate(None, username='Ghost@example.com', password='x'))
+
+    def test_create_user_invalidates_negative_cache(self):
+        self.backend.authenticate(None, username='ghost', password='testpass123')
+        CustomUser.objects.create_user(email='ghost@example.com', username='ghost', password='testpass123')
+        self.assertIsNotNone(self.backend.authenticate(None, username='ghost', password='testpass123'))
+
+    def test_identifier_change_invalidates_negative_cache(self):
+        self.assertIsNone(self.backend.authenticate(None, username='renamed', password='testpass123'))
+        self.user.username = 'renamed'
+        self.user.save()
+        self.assertEqual(self.backend.authenticate(None, username='renamed', password='testpass123'), self.user)
+
+    def test_inactive_user_is_rejected(self):
+        CustomUser.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertIsNone(self.backend.authenticate(None, username='loginuser', password='testpass123'))
+
+    def test_login_view_uses_backend(self):
+        response = self.client.post(reverse('login'), {'email_or_username': 'LOGIN@example.com', 'password': 'testpass123'})
+        self.assertRedirects(response, reverse('dashboard'))
+
+
+class HashingPoolTestCase(TestCase):
+
+    def _saturated_pool(self):
+        pool = hashing.HashingPool('thread', workers=1, max_pending=1)
+        release = threading.Event()
+        pool.submit(release.wait)
+        self.addCleanup(pool.shutdown)
+        self.addCleanup(release.set)
+        return pool
+
+    def test_passwords_hash_on_the_pool(self):
+        with mock.patch.object(hashing.HashingPool, 'submit', autospec=True, side_effect=hashing.HashingPool.submit) as submit:
+            user = CustomUser.objects.create_user(email='pool@example.com', username='pool', password='testpass123')
+            self.assertTrue(user.check_password('testpass123'))
+            self.assertFalse(user.check_password('wrong'))
+        self.assertEqual(submit.call_count, 3)
+
+    async def test_async_check_password(self):
+        user = CustomUser(email='async@example.com', username='async')
+        await user.aset_password('testpass123')
+        self.assertTrue(await user.acheck_password('testpass123'))
+        self.assertFalse(await user.acheck_password('wrong'))
+
+    def test_queue_depth_limit(self):
+        pool = self._saturated_pool()
+        self.assertEqual(pool.pending, 1)
+        with self.assertRaises(hashing.PasswordHashingBusy):
+            pool.submit(hashing.hashers.make_password, 'testpass123')
+
+    @override_settings(PASSWORD_HASHING_EXECUTOR='inline')
+    def test_inline_mode(self):
+        self.assertIsNone(hashing.get_pool())
+        self.assertTrue(hashing.check_password('testpass123', hashing.make_password('testpass123')))
+
+    def test_login_returns_503_when_pool_is_full(self):
+        CustomUser.objects.create_user(email='busy@example.com', username='busy', password='testpass123')
+        with mock.patch('users.hashing.get_pool', return_value=self._saturated_pool()):
+            response = self.client.post(reverse('login'), {'email_or_username': 'busy', 'password': 'testpass123'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class AsyncViewsTestCase(TestCase):
+
+    def setUp(self):
+        missing_identifiers.clear()
+        ratelimit.get_store().clear()
+        self.user = CustomUser.objects.create_user(email='views@example.com', username='views', password='testpass123')
+
+    async def test_signup(self):
+        response = await self.async_client.post(reverse('signup'), {
+            'email': 'new@example.com', 'username': 'newuser',
+            'password1': 'Sup3r-secret-pw', 'password2': 'Sup3r-secret-pw',
+        })
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        user = await CustomUser.objects.aget(username='newuser')
+        self.assertTrue(await user.acheck_password('Sup3r-secret-pw'))
+
+    async def test_login_dashboard_profile_logout(self):
+        response = await self.async_client.get(reverse('dashboard'))
+        self.assertRedirects(response, '/?next=/dashboard/', fetch_redirect_response=False)
+
+        response = await self.async_client.post(reverse('login'), {'email_or_username': 'views@example.com', 'password': 'testpass123'})
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+
+        response = await self.async_client.get(reverse('dashboard'))
+        self.assertContains(response, 'hi,views')
+        response = await self.async_client.get(reverse('profile'))
+        self.assertContains(response, 'views@example.com')
+        response = await self.async_client.get(reverse('login'))
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+
+        response = await self.async_client.post(reverse('logout'))
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        response = await self.async_client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 302)
+
+    async def test_failed_login_rerenders(self):
+        response = await self.async_client.post(reverse('login'), {'email_or_username': 'views', 'password': 'wrong'})
+        self.assertContains(response, 'Invalid email/username or password')
+
+    async def test_change_password(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(reverse('change_password'), {
+            'old_password': 'wrong', 'new_password1': 'N3w-secret-pw', 'new_password2': 'N3w-secret-pw',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('old_password', response.context['form'].errors)
+
+        response = await self.async_client.post(reverse('change_password'), {
+            'old_password': 'testpass123', 'new_password1': 'N3w-secret-pw', 'new_password2': 'N3w-secret-pw',
+        })
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+        await self.user.arefresh_from_db()
+        self.assertTrue(await self.user.acheck_password('N3w-secret-pw'))
+        ## Still logged in thanks to update_session_auth_hash
+        response = await self.async_client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+
+    async def test_forgot_and_reset_password(self):
+        response = await self.async_client.post(reverse('forgot_password'), {'email': 'missing@example.com'})
+        self.assertContains(response, 'Account with this email does not exist.')
+
+        response = await self.async_client.post(reverse('forgot_password'), {'email': 'views@example.com'})
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        self.assertEqual(await OutboundEmail.objects.acount(), 1)
+
+        queued = await OutboundEmail.objects.aget()
+        token = re.search(r'reset-password\?token=([\w-]+)', queued.body).group(1)
+        url = f"{reverse('reset_password')}?token={token}"
+        response = await self.async_client.get(url)
+        self.assertTrue(response.context['validlink'])
+
+        response = await self.async_client.post(url, {'new_password': 'R3set-secret-pw', 'confirm_password': 'R3set-secret-pw'})
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        await self.user.arefresh_from_db()
+        self.assertTrue(await self.user.acheck_password('R3set-secret-pw'))
+
+        ## The token is single use
+        response = await self.async_client.get(url)
+        self.assertFalse(response.context['validlink'])
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'test_cache'}},
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db', AUTH_USER_CACHE_TTL=300, RATELIMIT_STORE='cache',
+)
+class DatabaseCacheViewsTestCase(AsyncViewsTestCase):
+    '''
+    The async views on a cache served by the ORM, where a sync cache call
+    from the event loop raises SynchronousOnlyOperation.
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        call_command('createcachetable', verbosity=0)
+
+    async def test_revisit_is_not_modified(self):
+        await self.async_client.aforce_login(self.user)
+        ## The first page sets the CSRF cookie the ETag is made of
+        await self.async_client.get(reverse('dashboard'))
+        first = await self.async_client.get(reverse('dashboard'))
+        response = await self.async_client.get(reverse('dashboard'), headers={'If-None-Match': first['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_api(self):
+        def post(name, data, **headers):
+            return self.async_client.post(reverse(name), data, content_type='application/json', headers=headers)
+
+        response = await post('api_login', {'email_or_username': 'views', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+        response = await post('api_login', {'email_or_username': 'views', 'password': 'testpass123'})
+        self.assertEqual(response.status_code, 200)
+        response = await post('api_change_password', {
+            'old_password': 'testpass123', 'new_password1': 'N3w-secret-pw', 'new_password2': 'N3w-secret-pw',
+        }, authorization=f"Bearer {response.json()['access_token']}")
+        self.assertEqual(response.status_code, 200)
+        response = await post('api_forgot_password', {'email': 'views@example.com'})
+        self.assertEqual(response.status_code, 202)
+
+
+class UsersImportExportTestCase(TestCase):
+
+    def write_file(self, suffix, content):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def import_users(self, path, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('users_import', path, '--workers', '1', '--batch-size', '2', *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_csv_reports_duplicates(self):
+        CustomUser.objects.create_user(email='taken@example.com', username='taken', password='testpass123')
+        path = self.write_file('.csv', (
+            'email,username,password,is_staff\n'
+            'one@example.com,one,pass-one-123,\n'
+            'TAKEN@example.com,fresh,pass-two-123,\n'
+            'two@example.com,two,pass-two-123,yes\n'
+            'one@example.com,again,pass-three-123,\n'
+            ',nouser,pass,\n'
+        ))
+        stdout, stderr = self.import_users(path)
+
+        self.assertIn('Imported 2 user(s), skipped 2 duplicate(s) and 1 invalid row(s)', stdout)
+        self.assertIn('line 2: already exists', stderr)
+        self.assertIn('line 4: already exists', stderr)
+        one = CustomUser.objects.get(username='one')
+        self.assertTrue(one.check_password('pass-one-123'))
+        self.assertTrue(CustomUser.objects.get(username='two').is_staff)
+
+    def test_import_usernames_ignore_case(self):
+        CustomUser.objects.create_user(email='alice@example.com', username='alice', password='testpass123')
+        path = self.write_file('.csv', (
+            'email,username,password\n'
+            'other@example.com,Alice,pass-one-123\n'
+            'bob@example.com,bob,pass-two-123\n'
+            'bob2@example.com,BOB,pass-two-123\n'
+        ))
+        stdout, stderr = self.import_users(path)
+
+        self.assertIn('Imported 1 user(s), skipped 2 duplicate(s)', stdout)
+        self.assertEqual(sorted(CustomUser.objects.values_list('username', flat=True)), ['alice', 'bob'])
+
+    def test_import_jsonl_prehashed(self):
+        encoded = make_password('prehashed-123')
+        path = self.write_file('.jsonl', '\n'.join([
+            json.dumps({'email': 'hash@example.com', 'username': 'hash', 'password_hash': encoded}),
+            json.dumps({'email': 'bad@example.com', 'username': 'bad', 'password_hash': 'not-a-hash'}),
+            json.dumps({'email': 'nopass@example.com', 'username': 'nopass'}),
+        ]))
+        self.import_users(path)
+
+        user = CustomUser.objects.get(username='hash')
+        self.assertEqual(user.password, encoded)
+        self.assertTrue(user.check_password('prehashed-123'))
+        self.assertFalse(CustomUser.objects.filter(username='bad').exists())
+        self.assertFalse(CustomUser.objects.get(username='nopass').has_usable_password())
+
+    def test_export_round_trip(self):
+        fields = ['email', 'username', 'password', 'is_active', 'is_staff', 'is_superuser', 'date_joined', 'last_login']
+        CustomUser.objects.create_user(email='export@example.com', username='export', password='testpass123')
+        CustomUser.objects.create_user(email='nopass@example.com', username='nopass')
+        admin = CustomUser.objects.create_superuser('admin@example.com', 'admin', 'testpass123')
+        CustomUser.objects.filter(pk=admin.pk).update(
+            date_joined=timezone.now() - timedelta(days=400), last_login=timezone.now() - timedelta(days=3), is_active=False,
+        )
+        exported = list(CustomUser.objects.order_by('email').values_list(*fields))
+
+        for fmt in ('jsonl', 'csv'):
+            with self.subTest(fmt):
+                stdout = StringIO()
+                call_command('users_export', '--format', fmt, '--include-password-hash', stdout=stdout, stderr=StringIO())
+                if fmt == 'jsonl':
+                    records = [json.loads(line) for line in stdout.getvalue().splitlines()]
+                    self.assertEqual([record['username'] for record in records], ['export', 'nopass', 'admin'])
+
+                CustomUser.objects.all().delete()
+                out, err = self.import_users(self.write_file(f'.{fmt}', stdout.getvalue()))
+                self.assertIn('Imported 3 user(s), skipped 0 duplicate(s) and 0 invalid row(s)', out)
+                self.assertEqual(list(CustomUser.objects.order_by('email').values_list(*fields)), exported)
+                self.assertTrue(CustomUser.objects.get(username='export').check_password('testpass123'))
+                self.assertFalse(CustomUser.objects.get(username='nopass').has_usable_password())
+
+    def test_export_csv_to_file(self):
+        CustomUser.objects.create_user(email='csv@example.com', username='csv', password='testpass123')
+        path = self.write_file('.csv', '')
+        call_command('users_export', path, stderr=StringIO())
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'email,username,is_active,is_staff,is_superuser,date_joined,last_login')
+        self.assertTrue(lines[1].startswith('csv@example.com,csv,True,False,False,'))
+
+
+## The caches are off by default on locmem, which the tests run on
+@override_settings(
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db', AUTH_USER_CACHE_TTL=300, AUTH_PERMISSION_CACHE_TTL=300,
+)
+class WarmPageQueriesTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        activity.get_writer().discard()
+        self.user = CustomUser.objects.create_user(email='warm@example.com', username='warm', password='testpass123')
+        self.client.force_login(self.user)
+
+    def assertWarmPageIsFree(self, url):
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_cached_db_sessions(self):
+        self.assertWarmPageIsFree(reverse('dashboard'))
+        self.assertWarmPageIsFree(reverse('profile'))
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookie_sessions(self):
+        self.client.force_login(self.user)
+        self.assertWarmPageIsFree(reverse('dashboard'))
+
+    def test_save_invalidates_cached_user(self):
+        self.assertWarmPageIsFree(reverse('profile'))
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('profile'))
+        self.assertContains(response, 'changed@example.com')
+
+    def test_password_change_keeps_session_and_refreshes_user(self):
+        self.assertWarmPageIsFree(reverse('dashboard'))
+        key = user_cache_key(self.user.pk)
+        response = self.client.post(reverse('change_password'), {
+            'old_password': 'testpass123', 'new_password1': 'N3w-secret-pw', 'new_password2': 'N3w-secret-pw',
+        })
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+        self.assertNotEqual(user_cache_key(self.user.pk), key)
+        self.assertWarmPageIsFree(reverse('dashboard'))
+
+    def test_logout_invalidates_cached_user(self):
+        self.assertWarmPageIsFree(reverse('dashboard'))
+        key = user_cache_key(self.user.pk)
+        self.client.post(reverse('logout'))
+        self.assertNotEqual(user_cache_key(self.user.pk), key)
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 302)
+
+    @override_settings(AUTH_USER_CACHE_TTL=0)
+    def test_user_cache_off_reads_database(self):
+        self.client.get(reverse('profile'))
+        ## A change no invalidation hears of, as another worker's stale cache would miss it
+        CustomUser.objects.filter(pk=self.user.pk).update(email='elsewhere@example.com')
+        self.assertContains(self.client.get(reverse('profile')), 'elsewhere@example.com')
+
+
+class RateLimitTestCase(TestCase):
+
+    def setUp(self):
+        missing_identifiers.clear()
+        ratelimit.get_store().clear()
+        ## Stay inside one window so counts do not slide away mid-test
+        patcher = mock.patch('users.ratelimit.clock', return_value=1_800_000_000.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = CustomUser.objects.create_user(email='limit@example.com', username='limit', password='testpass123')
+
+    def login(self, password='wrong', identifier='limit'):
+        return self.client.post(reverse('login'), {'email_or_username': identifier, 'password': password})
+
+    def test_login_lockout_is_cheap(self):
+        for _ in range(5):
+            self.assertEqual(self.login().status_code, 200)
+        with mock.patch('users.hashing.check_password') as check_password:
+            with self.assertNumQueries(0):
+                response = self.login(password='testpass123')
+        check_password.assert_not_called()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+
+    def test_lockout_grows_with_every_strike(self):
+        limiter = ratelimit.RateLimiter('test', [ratelimit.Rule('ip', 1, 60)], store=ratelimit.LocMemStore())
+        limiter.hit('10.0.0.1')
+        self.assertEqual(limiter.check('10.0.0.1'), 30)
+        limiter.store.delete_many([key for key in limiter.store._data if key.endswith(':lock')])
+        self.assertEqual(limiter.check('10.0.0.1'), 60)
+        self.assertIsNone(limiter.check('10.0.0.2'))
+
+    async def test_async_lockout_on_cache_store(self):
+        await cache.aclear()
+        limiter = ratelimit.RateLimiter('test', [ratelimit.Rule('identifier', 1, 60)], store=ratelimit.CacheStore())
+        await limiter.ahit('10.0.0.1', 'someone')
+        self.assertEqual(await limiter.acheck('10.0.0.1', 'someone'), 30)
+        ## The sync API sees the lock the async one set
+        self.assertEqual(limiter.check('10.0.0.1', 'someone'), 31)
+        await limiter.areset('10.0.0.1', 'someone')
+        self.assertIsNone(await limiter.acheck('10.0.0.1', 'someone'))
+
+    def test_successful_login_resets_identifier(self):
+        for _ in range(4):
+            self.login()
+        self.assertRedirects(self.login(password='testpass123'), reverse('dashboard'), fetch_redirect_response=False)
+        self.client.post(reverse('logout'))
+        for _ in range(4):
+            self.assertEqual(self.login().status_code, 200)
+
+    def test_forgot_password_limit_per_email(self):
+        for _ in range(3):
+            response = self.client.post(reverse('forgot_password'), {'email': 'limit@example.com'}, REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(response.status_code, 302)
+        response = self.client.post(reverse('forgot_password'), {'email': ' LIMIT@example.com'}, REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(OutboundEmail.objects.count(), 3)
+
+    def test_client_ip(self):
+        factory = RequestFactory()
+        request = factory.get('/', REMOTE_ADDR='10.0.0.5', HTTP_X_FORWARDED_FOR='203.0.113.9, 198.51.100.7')
+        ## No trusted proxies: whatever a client puts in X-Forwarded-For is ignored
+        self.assertEqual(ratelimit.client_ip(request), '10.0.0.5')
+        with self.settings(RATELIMIT_TRUSTED_PROXIES=['10.0.0.0/8', '192.168.1.1']):
+            self.assertEqual(ratelimit.client_ip(request), '198.51.100.7')
+            ## The hops a trusted proxy added are skipped, the ones left of the client are forgeable
+            request.META['HTTP_X_FORWARDED_FOR'] = 'forged, 198.51.100.7, 192.168.1.1'
+            self.assertEqual(ratelimit.client_ip(request), '198.51.100.7')
+            request.META['HTTP_X_FORWARDED_FOR'] = '192.168.1.1'
+            self.assertEqual(ratelimit.client_ip(request), '192.168.1.1')
+            del request.META['HTTP_X_FORWARDED_FOR']
+            self.assertEqual(ratelimit.client_ip(request), '10.0.0.5')
+            ## Not from a trusted proxy: its header is not believed
+            request = factory.get('/', REMOTE_ADDR='198.51.100.7', HTTP_X_FORWARDED_FOR='203.0.113.9')
+            self.assertEqual(ratelimit.client_ip(request), '198.51.100.7')
+
+    def forgot_password_from(self, n, client_ip):
+        return self.client.post(reverse('forgot_password'), {'email': f'user{n}@example.com'}, HTTP_X_FORWARDED_FOR=client_ip)
+
+    def test_clients_behind_a_proxy_share_its_budget_by_default(self):
+        for n in range(5):
+            self.assertEqual(self.forgot_password_from(n, '203.0.113.9').status_code, 200)
+        self.assertEqual(self.forgot_password_from(5, '203.0.113.10').status_code, 429)
+
+    @override_settings(RATELIMIT_TRUSTED_PROXIES=['127.0.0.1'])
+    def test_clients_behind_a_trusted_proxy_have_budgets_of_their_own(self):
+        for n in range(5):
+            self.assertEqual(self.forgot_password_from(n, '203.0.113.9').status_code, 200)
+        self.assertEqual(self.forgot_password_from(5, '203.0.113.9').status_code, 429)
+        self.assertEqual(self.forgot_password_from(5, '203.0.113.10').status_code, 200)
+
+    @override_settings(RATELIMIT_STORE='cache')
+    def test_cache_store(self):
+        cache.clear()
+        self.assertIsInstance(ratelimit.get_store(), ratelimit.CacheStore)
+        for _ in range(5):
+            self.login()
+        self.assertEqual(self.login().status_code, 429)
+
+    @override_settings(RATELIMIT_ENABLED=False)
+    def test_disabled(self):
+        for _ in range(6):
+            self.assertEqual(self.login().status_code, 200)
+
+
+class ResetTokenTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        activity.get_writer().discard()
+        ratelimit.get_store().clear()
+        self.user = CustomUser.objects.create_user(email='reset@example.com', username='reset', password='testpass123')
+
+    def reset_url(self, token):
+        return f"{reverse('reset_password')}?token={token}"
+
+    def test_forgot_password_queries(self):
+        ## One lookup for the form, one insert into the mail queue
+        with self.assertNumQueries(2):
+            response = self.client.post(reverse('forgot_password'), {'email': 'reset@example.com'})
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+
+    def test_reset_flow_reads_user_from_database(self):
+        url = self.reset_url(tokens.make_token(self.user))
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertTrue(response.context['validlink'])
+        ## The user again, never from the cache, then the password UPDATE
+        with self.assertNumQueries(2):
+            response = self.client.post(url, {'new_password': 'R3set-secret-pw', 'confirm_password': 'R3set-secret-pw'})
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('R3set-secret-pw'))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.client.get(url).context['validlink'])
+
+    def test_used_token_rejected_despite_cached_user(self):
+        token = tokens.make_token(self.user)
+        ## Another worker's cache still holds the user as it was before the reset
+        get_cached_user(self.user.pk)
+        CustomUser.objects.filter(pk=self.user.pk).update(password=make_password('R3set-secret-pw'))
+        self.assertFalse(self.client.get(self.reset_url(token)).context['validlink'])
+
+    def test_bad_tokens_skip_the_database(self):
+        token = tokens.make_token(self.user)
+        uid, issued, state, signature = token.split('-')
+        expired = tokens.make_token(self.user, issued=int(time.time()) - settings.PASSWORD_RESET_TIMEOUT - 1)
+        for bad in ['', 'garbage', token[:-1], f'{uid}-{issued}-{state[::-1]}-{signature}', f'2-{issued}-{state}-{signature}', expired, 'x' * 500]:
+            with self.subTest(token=bad), self.assertNumQueries(0):
+                self.assertFalse(self.client.get(self.reset_url(bad)).context['validlink'])
+
+    def test_token_dies_with_user_state(self):
+        token = tokens.make_token(self.user)
+        self.user.email = 'moved@example.com'
+        self.user.save()
+        self.assertFalse(self.client.get(self.reset_url(token)).context['validlink'])
+
+    def test_fallback_secret_keys(self):
+        token = tokens.make_token(self.user)
+        with self.settings(SECRET_KEY='rotated-secret-key', SECRET_KEY_FALLBACKS=[settings.SECRET_KEY]):
+            self.assertTrue(self.client.get(self.reset_url(token)).context['validlink'])
+
+
+class SQLitePragmasTestCase(TestCase):
+
+    def test_pragmas_applied_on_connect(self):
+        from django.db import connection
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = DatabaseWrapper({**connection.settings_dict, 'NAME': os.path.join(directory, 'pragmas.sqlite3')}, 'pragmas')
+            try:
+                with wrapper.cursor() as cursor:
+                    values = {name: cursor.execute(f'PRAGMA {name}').fetchone()[0] for name in ('journal_mode', 'synchronous', 'busy_timeout')}
+            finally:
+                wrapper.close()
+        self.assertEqual(values, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 20000})
+
+
+class PerfMiddlewareTestCase(TestCase):
+
+    def setUp(self):
+        missing_identifiers.clear()
+        ratelimit.get_store().clear()
+        self.perf_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(self.settings(
+            PERF_ENABLED=True, PERF_DIR=self.perf_dir,
+            TEMPLATES=[{**settings.TEMPLATES[0], 'BACKEND': 'users.perf.TimedDjangoTemplates'}],
+        ))
+        perf._recorder = None
+        self.addCleanup(setattr, perf, '_recorder', None)
+        self.user = CustomUser.objects.create_user(email='perf@example.com', username='perf', password='testpass123')
+
+    def timings(self, response):
+        return {
+            part.split(';')[0]: float(part.split('dur=')[1].split(';')[0])
+            for part in response['Server-Timing'].split(', ')
+        }
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('login'))
+        timings = self.timings(response)
+        self.assertGreater(timings['template'], 0)
+        self.assertEqual(timings['hash'], 0)
+
+        response = self.client.post(reverse('login'), {'email_or_username': 'perf', 'password': 'wrong'})
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+        self.assertGreater(self.timings(response)['hash'], 0)
+
+        response = self.client.post(reverse('forgot_password'), {'email': 'perf@example.com'})
+        self.assertGreater(self.timings(response)['mail'], 0)
+
+        histograms = perf.get_recorder().views
+        self.assertEqual(histograms['login']['total'].count, 2)
+        self.assertEqual(histograms['login']['queries'].percentile(99), 1)
+        self.assertEqual(histograms['forgot_password']['queries'].percentile(50), 2)
+
+    def test_perf_report(self):
+        for _ in range(3):
+            self.client.get(reverse('login'))
+        self.client.get(reverse('signup'))
+        perf.get_recorder().flush()
+
+        out = StringIO()
+        call_command('perf_report', stdout=out)
+        self.assertIn('login (3 requests)', out.getvalue())
+        self.assertIn('signup (1 requests)', out.getvalue())
+
+        out = StringIO()
+        call_command('perf_report', '--json', '--view', 'login', '--reset', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(list(report), ['login'])
+        self.assertGreater(report['login']['total']['p99'], 0)
+        self.assertEqual(os.listdir(self.perf_dir), [])
+
+    def test_concurrent_flushes(self):
+        recorder = perf.Recorder(self.perf_dir, flush_interval=0)
+        errors = []
+
+        def record():
+            try:
+                for _ in range(200):
+                    recorder.record('login', perf.RequestTimings(), 0.001)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        recorder.flush()
+        self.assertEqual(os.listdir(self.perf_dir), [os.path.basename(recorder.path)])
+        self.assertEqual(perf.load_histograms(self.perf_dir)['login']['total'].count, 1600)
+
+    def test_failed_flush_is_logged(self):
+        recorder = perf.Recorder(self.perf_dir, flush_interval=0)
+        with mock.patch('users.perf.os.replace', side_effect=OSError('disk full')), self.assertLogs('users.perf', 'ERROR'):
+            recorder.record('login', perf.RequestTimings(), 0.001)
+        self.assertEqual(os.listdir(self.perf_dir), [])
+
+    def test_histogram_percentiles(self):
+        histogram = perf.Histogram()
+        for value in range(1, 101):
+            histogram.add(value)
+        self.assertAlmostEqual(histogram.percentile(50), 50, delta=2.5)
+        self.assertAlmostEqual(histogram.percentile(99), 99, delta=5)
+
+    @override_settings(PERF_ENABLED=False)
+    def test_disabled(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('login')))
+
+
+class RenderingCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        rendering.clear_shells()
+        ratelimit.get_store().clear()
+
+    def csrf_token(self, response):
+        return re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', response.content.decode()).group(1)
+
+    def test_shell_is_built_once(self):
+        with mock.patch('users.rendering.build_shell', wraps=rendering.build_shell) as build_shell:
+            first = Client(enforce_csrf_checks=True).get(reverse('login'))
+            client = Client(enforce_csrf_checks=True)
+            second = client.get(reverse('login'))
+        self.assertEqual(build_shell.call_count, 1)
+        self.assertNotIn(rendering.CSRF_PLACEHOLDER, second.content.decode())
+        self.assertNotIn(rendering.MESSAGES_PLACEHOLDER, second.content.decode())
+        self.assertNotEqual(self.csrf_token(first), self.csrf_token(second))
+        ## The spliced token is accepted
+        response = client.post(reverse('login'), {
+            'email_or_username': 'nobody', 'password': 'wrong', 'csrfmiddlewaretoken': self.csrf_token(second),
+        })
+        self.assertEqual(response.status_code, 200)
+
+    def test_shell_matches_full_render(self):
+        with self.settings(TEMPLATE_SHELLS=False):
+            full = self.client.get(reverse('signup'))
+        shell = self.client.get(reverse('signup'))
+        strip = lambda response: response.content.decode().replace(self.csrf_token(response), '')
+        self.assertEqual(strip(shell), strip(full))
+
+    def test_shell_shows_messages(self):
+        self.client.post(reverse('signup'), {
+            'email': 'shell@example.com', 'username': 'shell', 'password1': 'N3w-secret-pw', 'password2': 'N3w-secret-pw',
+        })
+        self.assertContains(self.client.get(reverse('login')), 'Account created for shell')
+        self.assertNotContains(self.client.get(reverse('login')), 'Account created for shell')
+
+    def test_navbar_keeps_csrf_per_user(self):
+        for name in ('first', 'second'):
+            user = CustomUser.objects.create_user(email=f'{name}@example.com', username=name, password='testpass123')
+            client = Client(enforce_csrf_checks=True)
+            client.force_login(user)
+            response = client.get(reverse('dashboard'))
+            self.assertContains(response, 'Logout')
+            response = client.post(reverse('logout'), {'csrfmiddlewaretoken': self.csrf_token(response)})
+            self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+
+
+class StaticPipelineTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.static_root = cls.enterClassContext(tempfile.TemporaryDirectory())
+        cls.enterClassContext(override_settings(STATIC_ROOT=cls.static_root))
+        call_command('collectstatic', interactive=False, verbosity=0, ignore_patterns=['admin'])
+
+    def setUp(self):
+        rendering.clear_shells()
+        self.client = Client(HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+
+    def decoded(self, response):
+        if response.get('Content-Encoding') == 'gzip':
+            return gzip.decompress(response.content)
+        if response.get('Content-Encoding') == 'br':
+            import brotli
+            return brotli.decompress(response.content)
+        return response.content
+
+    def test_cold_login_page_bytes(self):
+        page = self.client.get(reverse('login'))
+        html = self.decoded(page).decode()
+        self.assertNotRegex(html, r'<(link|script)[^>]+(href|src)="(https?:)?//')
+
+        transferred = {reverse('login'): len(page.content)}
+        pending = re.findall(r'<(?:link|script)[^>]+(?:href|src)="([^"]+)"', html)
+        while pending:
+            url = pending.pop()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+            transferred[url] = len(response.content)
+            if url.endswith('.css'):
+                for reference in re.findall(r'url\(([^)]+)\)', self.decoded(response).decode()):
+                    reference = reference.strip('"\'')
+                    if not reference.startswith('data:'):
+                        pending.append(urljoin(url, reference))
+        ## HTML, two stylesheets, ui.js and the icon font (well over 100 KB from the CDNs before)
+        self.assertEqual(len(transferred), 5)
+        self.assertLess(sum(transferred.values()), 15_000, transferred)
+
+    def test_conditional_and_encoded_responses(self):
+        html = self.decoded(self.client.get(reverse('login'))).decode()
+        url = re.search(r'href="([^"]+bootstrap[^"]+)"', html).group(1)
+
+        plain = Client().get(url)
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertEqual(plain['Vary'], 'Accept-Encoding')
+        self.assertTrue(plain['Content-Type'].startswith('text/css'))
+
+        gzipped = Client(HTTP_ACCEPT_ENCODING='gzip').get(url)
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzipped.content), plain.content)
+        self.assertNotEqual(gzipped['ETag'], plain['ETag'])
+
+        response = Client(HTTP_ACCEPT_ENCODING='gzip').get(url, HTTP_IF_NONE_MATCH=gzipped['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], gzipped['ETag'])
+
+    def test_unhashed_names_revalidate(self):
+        response = self.client.get('/static/users/js/ui.js')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(self.client.get('/static/users/missing.js').status_code, 404)
+
+
+class SignupUniquenessTestCase(TransactionTestCase):
+    ## No surrounding test transaction, so the query log shows exactly what production runs
+
+    def setUp(self):
+        missing_identifiers.clear()
+        activity.get_writer().discard()
+        CustomUser.objects.create_user(email='Taken@example.com', username='Taken', password='testpass123')
+
+    def signup(self, client, email, username):
+        return client.post(reverse('signup'), {
+            'email': email, 'username': username,
+            'password1': 'Sup3r-secret-pw', 'password2': 'Sup3r-secret-pw',
+        })
+
+    def test_happy_path_is_one_select_and_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.signup(Client(), 'new@example.com', 'newuser')
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual(statements, ['SELECT', 'INSERT'], queries.captured_queries)
+
+    def test_collisions_ignore_case_and_name_the_field(self):
+        response = self.signup(Client(), 'taken@EXAMPLE.com', 'other')
+        self.assertEqual(list(response.context['form'].errors), ['email'])
+        response = self.signup(Client(), 'other@example.com', 'TAKEN')
+        self.assertEqual(list(response.context['form'].errors), ['username'])
+        response = self.signup(Client(), 'taken@example.com', 'taken')
+        self.assertEqual(list(response.context['form'].errors), ['email', 'username'])
+        self.assertEqual(CustomUser.objects.count(), 1)
+
+    def test_lost_race_is_a_form_error(self):
+        ## Validation passed, then another signup committed the same email before our INSERT
+        with mock.patch.object(type(CustomUser.objects), 'taken_identifiers', return_value=[]):
+            response = self.signup(Client(), 'Taken@example.com', 'racer')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('already exists', response.context['form'].errors['email'][0])
+        self.assertEqual(CustomUser.objects.count(), 1)
+
+    def test_concurrent_signups(self):
+        threads_count = 8
+        barrier = threading.Barrier(threads_count)
+        statuses = []
+
+        def worker(number):
+            client = Client()
+            barrier.wait()
+            ## Everyone fights over the same email; each username is distinct
+            response = self.signup(client, 'race@example.com', f'racer{number}')
+            statuses.append(response.status_code)
+            connection.close()
+
+        threads = [threading.Thread(target=worker, args=(number,)) for number in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(statuses), [200] * (threads_count - 1) + [302])
+        self.assertEqual(CustomUser.objects.filter(email='race@example.com').count(), 1)
+
+
+@override_settings(ACTIVITY_FLUSH_INTERVAL=60, ACTIVITY_BATCH_SIZE=10)
+class ActivityWriterTestCase(TestCase):
+
+    def setUp(self):
+        missing_identifiers.clear()
+        ratelimit.get_store().clear()
+        self.writer = activity.get_writer()
+        self.user = CustomUser.objects.create_user(email='active@example.com', username='active', password='testpass123')
+
+    def login(self, password='testpass123'):
+        return self.client.post(reverse('login'), {'email_or_username': 'active', 'password': password})
+
+    def test_login_defers_the_writes(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.login().status_code, 302)
+        self.assertFalse([query for query in queries.captured_queries if query['sql'].startswith('UPDATE "users_customuser"')])
+        self.login(password='wrong')
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.last_login)
+        self.assertFalse(LoginAudit.objects.exists())
+
+        self.assertEqual(self.writer.flush(), 3)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+        audits = list(LoginAudit.objects.order_by('created_at').values_list('user_id', 'identifier', 'ip', 'outcome'))
+        self.assertEqual(audits, [
+            (self.user.pk, 'active', '127.0.0.1', LoginAudit.OUTCOME_SUCCESS),
+            (None, 'active', '127.0.0.1', LoginAudit.OUTCOME_FAILURE),
+        ])
+
+    def test_flush_is_one_update_and_one_insert(self):
+        others = [
+            CustomUser.objects.create_user(email=f'other{n}@example.com', username=f'other{n}', password='x')
+            for n in range(2)
+        ]
+        for user in [self.user, *others, self.user]:
+            self.writer.record_login(user, '10.0.0.1')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.writer.flush(), 7)
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual([s for s in statements if s in ('UPDATE', 'INSERT')], ['UPDATE', 'INSERT'])
+        self.assertEqual(CustomUser.objects.filter(last_login__isnull=False).count(), 3)
+        self.assertEqual(LoginAudit.objects.count(), 4)
+
+    def test_flushes_after_requests_when_due(self):
+        with mock.patch('users.activity.clock', return_value=1000.0):
+            self.writer.record_failure('someone')
+            self.client.get(reverse('login'))
+            self.assertFalse(LoginAudit.objects.exists())
+        with mock.patch('users.activity.clock', return_value=1060.0):
+            self.client.get(reverse('login'))
+        self.assertEqual(LoginAudit.objects.count(), 1)
+
+        ## Batch size reached: no need to wait for the interval
+        for n in range(10):
+            self.writer.record_failure(f'someone{n}')
+        self.client.get(reverse('login'))
+        self.assertEqual(LoginAudit.objects.count(), 11)
+
+    def test_failed_flush_keeps_entries(self):
+        self.writer.record_login(self.user)
+        with mock.patch.object(LoginAudit.objects, 'bulk_create', side_effect=DatabaseError):
+            with self.assertLogs('users.activity', 'ERROR'):
+                self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(len(self.writer), 2)
+        self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(LoginAudit.objects.count(), 1)
+
+    def test_flush_invalidates_cached_user(self):
+        self.client.force_login(self.user)
+        key = user_cache_key(self.user.pk)
+        self.writer.flush()
+        self.assertNotEqual(user_cache_key(self.user.pk), key)
+
+
+class CustomUserAdminTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        activity.get_writer().discard()
+        self.admin_user = CustomUser.objects.create_superuser(email='admin@example.com', username='admin', password='testpass123')
+        self.users = [
+            CustomUser.objects.create_user(email=f'member{n}@example.com', username=f'Member{n}', password='x')
+            for n in range(5)
+        ]
+        self.client.force_login(self.admin_user)
+        self.url = reverse('admin:users_customuser_changelist')
+        patcher = mock.patch('users.admin.CustomUserAdmin.list_per_page', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def usernames(self, response):
+        return [user.username for user in response.context['cl'].result_list]
+
+    def test_keyset_pages_forward_and_back(self):
+        newest_first = ['Member4', 'Member3', 'Member2', 'Member1', 'Member0', 'admin']
+        pages, response = [], self.client.get(self.url)
+        while True:
+            pages.append(self.usernames(response))
+            next_url = response.context['cl'].next_url
+            if next_url is None:
+                break
+            self.assertIn('after=', next_url)
+            response = self.client.get(self.url + next_url)
+        self.assertEqual(pages, [newest_first[0:2], newest_first[2:4], newest_first[4:6]])
+
+        response = self.client.get(self.url + response.context['cl'].previous_url)
+        self.assertEqual(self.usernames(response), newest_first[2:4])
+
+        response = self.client.get(self.url, {'o': '3'})
+        self.assertEqual(self.usernames(response), ['admin', 'Member0'])
+
+    def test_pages_never_count_or_offset(self):
+        response = self.client.get(self.url)
+        next_url = response.context['cl'].next_url
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url + next_url)
+        sql = ' '.join(query['sql'] for query in queries.captured_queries if 'users_customuser' in query['sql'])
+        self.assertNotIn('COUNT(', sql)
+        self.assertNotIn('OFFSET', sql)
+        self.assertTrue(response.context['cl'].count_is_estimate)
+        self.assertContains(response, 'About 6 custom users')
+
+    def test_prefix_search_and_filters(self):
+        response = self.client.get(self.url, {'q': 'MEMBER1'})
+        self.assertEqual(self.usernames(response), ['Member1'])
+        self.assertFalse(response.context['cl'].count_is_estimate)
+        response = self.client.get(self.url, {'q': 'ember'})
+        self.assertEqual(self.usernames(response), [])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'is_staff__exact': '1'})
+        self.assertEqual(self.usernames(response), ['admin'])
+        self.assertEqual(response.context['cl'].result_count, 1)
+        ## Comparable to the is_staff index, unlike Django's bare WHERE "is_staff"
+        self.assertIn('"is_staff" IN (1)', queries.captured_queries[-1]['sql'])
+        response = self.client.get(self.url, {'is_active__exact': '0'})
+        self.assertEqual(self.usernames(response), [])
+
+    def test_bad_cursor_is_rejected(self):
+        response = self.client.get(self.url, {'after': 'garbage'})
+        self.assertRedirects(response, self.url + '?e=1', fetch_redirect_response=False)
+
+    def test_actions_are_one_update_and_drop_cached_users(self):
+        selected = [user.pk for user in self.users[:3]]
+        keys = [user_cache_key(pk) for pk in selected]
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, {'action': 'deactivate_users', '_selected_action': selected})
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE "users_customuser"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(CustomUser.objects.filter(is_active=False).count(), 3)
+        self.assertTrue(all(user_cache_key(pk) != key for pk, key in zip(selected, keys)))
+
+        key = user_cache_key(self.users[4].pk)
+        with mock.patch('users.admin.CustomUserAdmin.INVALIDATE_LIMIT', 2):
+            self.client.post(self.url, {'action': 'force_password_reset', 'select_across': '1', '_selected_action': selected})
+        self.assertFalse(CustomUser.objects.get(pk=self.users[4].pk).has_usable_password())
+        ## Too many users to list: every cached user goes at once
+        self.assertNotEqual(user_cache_key(self.users[4].pk), key)
+
+
+class PasswordFilterTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.path = os.path.join(self.directory, 'breached.bloom')
+        self.source = os.path.join(self.directory, 'breached.txt')
+        with open(self.source, 'w') as handle:
+            handle.write('Tr0ub4dor&3\n')
+            ## Have I Been Pwned style line: SHA-1 of the password and a count
+            handle.write(password_filter.password_digest('c0rrect-h0rse').hex().upper() + ':42\n')
+
+    def build(self, *args):
+        call_command('build_password_filter', *args, output=self.path, stdout=StringIO())
+
+    def assertRejected(self, validator, password, code):
+        with self.assertRaises(ValidationError) as context:
+            validator.validate(password)
+        self.assertEqual(context.exception.code, code)
+
+    def test_falls_back_to_common_passwords_without_a_filter(self):
+        validator = password_filter.BreachedPasswordValidator(self.path)
+        self.assertRejected(validator, 'password', 'password_too_common')
+        validator.validate('Tr0ub4dor&3')
+
+    def test_filter_from_plain_and_hashed_lines(self):
+        self.build(self.source)
+        bloom = password_filter.get_filter(self.path)
+        self.assertEqual(bloom.count, len(list(password_filter.common_passwords())) + 2)
+
+        validator = password_filter.BreachedPasswordValidator(self.path)
+        for password in ('Tr0ub4dor&3', 'c0rrect-h0rse', 'password', 'PassWord'):
+            with self.subTest(password=password):
+                self.assertRejected(validator, password, 'password_breached')
+        validator.validate('Sup3r-secret-pw')
+
+    def test_rebuild_is_picked_up(self):
+        self.build()
+        validator = password_filter.BreachedPasswordValidator(self.path)
+        validator.validate('Tr0ub4dor&3')
+        time.sleep(0.01)
+        self.build(self.source)
+        self.assertRejected(validator, 'Tr0ub4dor&3', 'password_breached')
+
+    def test_sha1_format_rejects_plain_lines(self):
+        with self.assertRaisesMessage(CommandError, 'Not a SHA-1 hash'):
+            self.build(self.source, '--format', 'sha1')
+
+    @skipUnless(password_filter.load_numpy(), 'numpy is not installed')
+    def test_numpy_and_python_builds_match(self):
+        digests = [password_filter.password_digest(f'pw{n}') for n in range(5000)]
+        password_filter.build_filter(self.path, iter(digests), 5000)
+        with mock.patch.object(password_filter, 'load_numpy', return_value=None):
+            password_filter.build_filter(self.path + '.py', iter(digests), 5000)
+        with open(self.path, 'rb') as vectorized, open(self.path + '.py', 'rb') as plain:
+            self.assertEqual(vectorized.read(), plain.read())
+
+    def test_signup_rejects_breached_password(self):
+        self.build(self.source)
+        with self.settings(PASSWORD_FILTER_PATH=self.path):
+            response = self.client.post(reverse('signup'), {
+                'email': 'new@example.com', 'username': 'newuser',
+                'password1': 'c0rrect-h0rse', 'password2': 'c0rrect-h0rse',
+            })
+        self.assertIn('This password has appeared in a data breach.', response.context['form'].errors['password2'])
+
+
+@override_settings(
+    DATABASE_REPLICAS=['replica'], DATABASE_ROUTERS=['users.routers.ReplicaRouter'],
+    REPLICA_SELECTION='round_robin', REPLICA_STICKY_SECONDS=10,
+)
+class ReplicaRoutingTestCase(TestCase):
+    ## A second SQLite file stands in for the replica, the test database is the primary.
+    ## Registered after the test case set up its databases, so its rows are managed here.
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        connections.settings['replica'] = {
+            **connections.settings['default'],
+            'NAME': os.path.join(cls.directory, 'replica.sqlite3'),
+            'TEST': {**connections.settings['default']['TEST'], 'MIRROR': None},
+        }
+        ## Stands in for replication, which the router leaves the schema to
+        with override_settings(DATABASE_ROUTERS=[]):
+            call_command('migrate', database='replica', verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        for name in os.listdir(cls.directory):
+            os.unlink(os.path.join(cls.directory, name))
+        os.rmdir(cls.directory)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        activity.get_writer().discard()
+        ## The same user as replicated so far and as on the primary
+        self.user = CustomUser.objects.create_user(email='replicated@example.com', username='primary', password='testpass123')
+        CustomUser.objects.using('replica').all().delete()
+        CustomUser.objects.using('replica').create(
+            pk=self.user.pk, email='replicated@example.com', username='lagging',
+            password=self.user.password, password_stamp=self.user.password_stamp,
+        )
+
+    def test_only_replica_reads_blocks_use_the_replica(self):
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).username, 'primary')
+        with routers.replica_reads():
+            replicated = CustomUser.objects.get(pk=self.user.pk)
+        self.assertEqual(replicated.username, 'lagging')
+
+        ## Saving a user loaded from the replica writes to the primary
+        replicated.is_staff = True
+        replicated.save(update_fields=['is_staff'])
+        self.assertTrue(CustomUser.objects.get(pk=self.user.pk).is_staff)
+        self.assertFalse(CustomUser.objects.using('replica').get(pk=self.user.pk).is_staff)
+        self.assertFalse(routers.ReplicaRouter().allow_migrate('replica', 'users'))
+
+    def test_read_only_views_read_the_replica(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, 'hi,lagging')
+        self.assertNotIn(routers.STICKY_COOKIE, response.cookies)
+
+    def test_writes_pin_the_client_to_the_primary(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('change_password'), {
+            'old_password': 'testpass123', 'new_password1': 'Sup3r-secret-pw', 'new_password2': 'Sup3r-secret-pw',
+        })
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+        self.assertIn(routers.STICKY_COOKIE, response.cookies)
+        cache.clear()
+        self.assertContains(self.client.get(reverse('dashboard')), 'hi,primary')
+        ## Only the password was written back from the replica's copy of the user
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).username, 'primary')
+
+        ## Back on the replica once the window is over, by when it has the new password
+        primary = CustomUser.objects.get(pk=self.user.pk)
+        CustomUser.objects.using('replica').filter(pk=self.user.pk).update(
+            password=primary.password, password_stamp=primary.password_stamp,
+        )
+        cache.clear()
+        with mock.patch.object(routers, 'clock', lambda: time.time() + 11):
+            self.assertContains(self.client.get(reverse('dashboard')), 'hi,lagging')
+
+    def test_cookie_beyond_the_window_is_ignored(self):
+        self.client.force_login(self.user)
+        self.client.cookies[routers.STICKY_COOKIE] = str(int(time.time()) + 3600)
+        self.assertContains(self.client.get(reverse('dashboard')), 'hi,lagging')
+
+
+class ReplicaSelectorTestCase(TestCase):
+
+    @override_settings(REPLICA_SELECTION='round_robin')
+    def test_round_robin(self):
+        selector = routers.ReplicaSelector()
+        self.assertEqual([selector.choose(['a', 'b']) for _ in range(4)], ['a', 'b', 'a', 'b'])
+
+    @override_settings(REPLICA_SELECTION='least_latency')
+    def test_least_latency_with_probes(self):
+        selector = routers.ReplicaSelector()
+        selector.record('a', 0.010)
+        selector.record('b', 0.002)
+        picks = [selector.choose(['a', 'b']) for _ in range(routers.PROBE_EVERY * 2)]
+        ## Every PROBE_EVERY-th pick goes round robin and may land on the slower replica
+        self.assertEqual(picks.count('a'), 1)
+        selector.record('b', 0.100)
+        self.assertEqual(selector.choose(['a', 'b']), 'a')
+
+
+class BenchSuiteTestCase(TestCase):
+
+    def setUp(self):
+        missing_identifiers.clear()
+        activity.get_writer().discard()
+        self.enterContext(self.settings(
+            PERF_ENABLED=True, PERF_DIR=self.enterContext(tempfile.TemporaryDirectory()), RATELIMIT_ENABLED=False,
+            PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+        ))
+        perf._recorder = None
+        self.addCleanup(setattr, perf, '_recorder', None)
+        seed_users(3, suite.PASSWORD)
+
+    def run_result(self, **changes):
+        result = {'requests': 10, 'errors': 0, 'rps': 100.0, 'p50_ms': 8.0, 'p95_ms': 10.0, 'p99_ms': 12.0, 'queries': 3, 'peak_rss_mib': 60.0}
+        return {
+            'meta': {'users': 3, 'requests': 10, 'concurrency': 1, 'hasher': 'MD5PasswordHasher'},
+            'results': {'client': {'login_email': {**result, **changes}}},
+        }
+
+    def test_every_flow_through_the_test_client(self):
+        for flow in suite.FLOWS:
+            with self.subTest(flow=flow):
+                result = suite.run_flow(suite.ClientSession, flow, 2, 1, users=3, run_id='test')
+                self.assertEqual((result['requests'], result['errors']), (2, 0))
+                self.assertIsNotNone(result['queries'])
+        self.assertTrue(CustomUser.objects.filter(username='newtestw0n1').exists())
+
+    def test_compare(self):
+        baseline = self.run_result()
+        self.assertEqual(suite.compare(baseline, self.run_result(p95_ms=11.5, rps=85.0, peak_rss_mib=70.0)), [])
+        self.assertEqual(suite.compare(baseline, self.run_result(queries=4, p95_ms=14.0, rps=70.0, errors=1)), [
+            'client/login_email: 1 of 10 requests failed',
+            'client/login_email: 4 queries per request, was 3',
+            'client/login_email: p95 14.0 ms, was 10.0 ms',
+            'client/login_email: 70.0 req/s, was 100.0',
+        ])
+        other = self.run_result()
+        other['meta']['concurrency'] = 4
+        self.assertEqual(suite.compare(baseline, other), ['baseline ran with concurrency 1, this run with 4'])
+
+
+@override_settings(
+    PASSWORD_HASHERS=['users.hashers.PBKDF2PasswordHasher', 'django.contrib.auth.hashers.MD5PasswordHasher'],
+    PBKDF2_ITERATIONS=1000, ACTIVITY_FLUSH_INTERVAL=60,
+)
+class RehashOnLoginTestCase(TransactionTestCase):
+    ## No surrounding test transaction: the rehash commits from its own thread
+
+    def setUp(self):
+        missing_identifiers.clear()
+        ratelimit.get_store().clear()
+        activity.get_writer().discard()
+        self.user = CustomUser.objects.create_user(email='rehash@example.com', username='rehash', password='testpass123')
+
+    def login(self, client):
+        return client.post(reverse('login'), {'email_or_username': 'rehash', 'password': 'testpass123'})
+
+    def test_hasher_cost_comes_from_settings(self):
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$1000$'))
+        hasher = hashers.PBKDF2PasswordHasher()
+        self.assertFalse(hasher.must_update(self.user.password))
+        with override_settings(PBKDF2_ITERATIONS=2000):
+            self.assertTrue(hasher.must_update(self.user.password))
+
+    def test_scrypt_verifies_hashes_above_a_lowered_work_factor(self):
+        hasher = hashers.ScryptPasswordHasher()
+        ## 32 MiB at r=8, the most hashlib allows without maxmem
+        with override_settings(SCRYPT_WORK_FACTOR=2**15, SCRYPT_BLOCK_SIZE=8, SCRYPT_PARALLELISM=1):
+            encoded = hasher.encode('testpass123', hasher.salt())
+        with override_settings(SCRYPT_WORK_FACTOR=2**14, SCRYPT_BLOCK_SIZE=8, SCRYPT_PARALLELISM=1):
+            self.assertTrue(hasher.verify('testpass123', encoded))
+            self.assertFalse(hasher.verify('wrongpass', encoded))
+            self.assertTrue(hasher.must_update(encoded))
+
+    def test_outdated_hash_is_upgraded_after_login_without_logging_out(self):
+        stamp = self.user.password_stamp
+        client = Client()
+        with override_settings(PBKDF2_ITERATIONS=2000):
+            self.assertRedirects(self.login(client), reverse('dashboard'), fetch_redirect_response=False)
+            hashing.get_rehasher().flush()
+            self.user.refresh_from_db()
+            self.assertTrue(self.user.password.startswith('pbkdf2_sha256$2000$'))
+            self.assertEqual(self.user.password_stamp, stamp)
+            self.assertTrue(self.user.check_password('testpass123'))
+            self.assertEqual(client.get(reverse('dashboard')).status_code, 200)
+
+    def test_rehash_loses_to_a_password_change(self):
+        outdated = self.user.password
+        self.user.set_password('newpass456')
+        self.user.save()
+        self.assertEqual(hashing.rehash(self.user.pk, outdated, 'testpass123'), outdated)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('newpass456'))
+
+    def test_inline_and_off(self):
+        with override_settings(PBKDF2_ITERATIONS=2000, PASSWORD_REHASH='off'):
+            self.assertTrue(self.user.check_password('testpass123'))
+            self.assertTrue(CustomUser.objects.get(pk=self.user.pk).password.startswith('pbkdf2_sha256$1000$'))
+        with override_settings(PBKDF2_ITERATIONS=2000, PASSWORD_REHASH='inline'):
+            self.assertTrue(self.user.check_password('testpass123'))
+            self.assertTrue(self.user.password.startswith('pbkdf2_sha256$2000$'))
+            self.assertEqual(CustomUser.objects.get(pk=self.user.pk).password, self.user.password)
+
+    def test_sessions_follow_the_password_stamp(self):
+        client = Client()
+        client.force_login(self.user)
+        ## A session signed the way Django signs them, from before stamps: moved over
+        session = client.session
+        session[HASH_SESSION_KEY] = self.user._get_session_auth_hash()
+        session.save()
+        self.assertEqual(client.get(reverse('dashboard')).status_code, 200)
+        self.assertEqual(client.session[HASH_SESSION_KEY], self.user.get_session_auth_hash())
+        ## A password change ends it
+        self.user.set_password('newpass456')
+        self.user.save()
+        invalidate_user(self.user.pk)
+        response = client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(reverse('login')))
+
+
+class CalibrateHashersTestCase(TestCase):
+
+    def test_tests_use_the_fast_tier(self):
+        self.assertEqual(settings.PASSWORD_HASHING_TIER, 'fast')
+        self.assertTrue(make_password('testpass123').startswith('md5$'))
+
+    @override_settings(PBKDF2_ITERATIONS=20000)
+    def test_suggests_settings(self):
+        out = StringIO()
+        call_command('calibrate_hashers', algorithm=['pbkdf2'], target_ms=1000, samples=1, stdout=out)
+        iterations = int(re.search(r'^PBKDF2_ITERATIONS = (\d+)$', out.getvalue(), re.M).group(1))
+        self.assertGreater(iterations, 20000)
+        self.assertEqual(iterations % 10000, 0)
+
+    def test_argon2_needs_argon2_cffi(self):
+        with mock.patch('users.management.commands.calibrate_hashers.argon2_installed', return_value=False):
+            with self.assertRaises(CommandError):
+                call_command('calibrate_hashers', algorithm=['argon2'], stdout=StringIO())
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db', LOGIN_AUDIT_RETENTION_DAYS=30, MAIL_RETENTION_DAYS=7)
+class CleanupTestCase(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        Session.objects.bulk_create(
+            [Session(session_key=f'expired{n}', session_data='', expire_date=now - timedelta(minutes=n + 1)) for n in range(5)]
+            + [Session(session_key='live', session_data='', expire_date=now + timedelta(days=1))]
+        )
+        LoginAudit.objects.bulk_create([
+            LoginAudit(identifier='old', outcome=LoginAudit.OUTCOME_SUCCESS, created_at=now - timedelta(days=31)),
+            LoginAudit(identifier='recent', outcome=LoginAudit.OUTCOME_SUCCESS, created_at=now - timedelta(days=29)),
+        ])
+        for status in (OutboundEmail.STATUS_SENT, OutboundEmail.STATUS_DEAD, OutboundEmail.STATUS_QUEUED):
+            OutboundEmail.objects.create(subject=status, body='', to='a@example.com', status=status)
+        OutboundEmail.objects.update(created_at=now - timedelta(days=8))
+        OutboundEmail.objects.create(subject='recent', body='', to='a@example.com', status=OutboundEmail.STATUS_SENT)
+
+    def test_deletes_only_what_expired_in_batches(self):
+        report = cleanup.collect(batch_size=2, pause=0)
+        self.assertEqual(report.deleted, {'sessions': 5, 'audit': 1, 'mail': 2, 'refresh': 0})
+        self.assertTrue(report.finished)
+        ## Sessions 2+2+1, audit 1, mail 2 and the empty batch that shows it is done, refresh 1
+        self.assertEqual(report.batches, 3 + 1 + 2 + 1)
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['live'])
+        self.assertEqual(list(LoginAudit.objects.values_list('identifier', flat=True)), ['recent'])
+        self.assertEqual(sorted(OutboundEmail.objects.values_list('subject', flat=True)), ['queued', 'recent'])
+
+    def test_time_budget_resumes_at_the_next_run(self):
+        ticks = iter(range(100))
+        with mock.patch.object(cleanup, 'clock', lambda: next(ticks)):
+            report = cleanup.collect(['sessions'], batch_size=2, budget=2, pause=0)
+        self.assertFalse(report.finished)
+        self.assertEqual(report.deleted, {'sessions': 2})
+        ## The oldest went first
+        self.assertFalse(Session.objects.filter(session_key__in=['expired4', 'expired3']).exists())
+        self.assertEqual(cleanup.collect(['sessions'], pause=0).deleted, {'sessions': 3})
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies', LOGIN_AUDIT_RETENTION_DAYS=0)
+    def test_nothing_to_collect_without_database_sessions_or_retention(self):
+        self.assertEqual(cleanup.collect(['sessions', 'audit']).deleted, {'sessions': 0, 'audit': 0})
+        self.assertEqual(Session.objects.count(), 6)
+
+    def test_command_reports_rows_per_second(self):
+        out = StringIO()
+        call_command('collect_garbage', target=['sessions'], stdout=out)
+        self.assertRegex(out.getvalue(), r'^Deleted 5 sessions in 1 batch\(es\), [\d.]+s \(\d+ rows/s\)')
+
+
+@override_settings(ACTIVITY_FLUSH_INTERVAL=60)
+class JsonApiTestCase(TestCase):
+
+    def setUp(self):
+        missing_identifiers.clear()
+        ratelimit.get_store().clear()
+        activity.get_writer().discard()
+        self.user = CustomUser.objects.create_user(email='api@example.com', username='apiuser', password='testpass123')
+
+    def post(self, name, data, **headers):
+        return self.client.post(reverse(name), data, content_type='application/json', headers=headers)
+
+    def login(self, password='testpass123'):
+        response = self.post('api_login', {'email_or_username': 'API@example.com', 'password': password})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_signup_and_login(self):
+        response = self.post('api_signup', {
+            'email': 'new@example.com', 'username': 'newuser', 'password1': 'Sup3r-secret-pw', 'password2': 'Sup3r-secret-pw',
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['username'], 'newuser')
+        response = self.post('api_signup', {
+            'email': 'NEW@example.com', 'username': 'other', 'password1': 'Sup3r-secret-pw', 'password2': 'Sup3r-secret-pw',
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()['errors']), ['email'])
+
+        pair = self.login()
+        self.assertEqual(pair['token_type'], 'Bearer')
+        self.assertEqual(pair['expires_in'], settings.API_ACCESS_TOKEN_TTL)
+        self.assertEqual(self.post('api_login', {'email_or_username': 'apiuser', 'password': 'wrong'}).status_code, 401)
+        ## No session, no CSRF cookie
+        self.assertNotIn('sessionid', self.client.cookies)
+
+    def test_access_token_is_checked_without_queries(self):
+        access = self.login()['access_token']
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('api_me'), headers={'Authorization': f'Bearer {access}'})
+        self.assertEqual(response.json(), {'id': self.user.pk})
+        expired = api_tokens.make_access_token(self.user.pk, expires=int(time.time()) - 1)
+        for header in ('', f'Bearer {expired}', f'Bearer {access}x', f'Basic {access}'):
+            response = self.client.get(reverse('api_me'), headers={'Authorization': header})
+            self.assertEqual(response.status_code, 401, header)
+            self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+
+    def test_refresh_rotates_and_reuse_revokes_the_family(self):
+        first = self.login()['refresh_token']
+        response = self.post('api_refresh', {'refresh_token': first})
+        self.assertEqual(response.status_code, 200)
+        second = response.json()['refresh_token']
+        self.assertNotEqual(first, second)
+        ## The first token again: it leaked, the rotated one goes too
+        self.assertEqual(self.post('api_refresh', {'refresh_token': first}).status_code, 401)
+        self.assertEqual(self.post('api_refresh', {'refresh_token': second}).status_code, 401)
+        self.assertFalse(RefreshToken.objects.exists())
+
+    def test_logout_revokes_the_refresh_token(self):
+        refresh = self.login()['refresh_token']
+        self.assertEqual(self.post('api_logout', {'refresh_token': refresh}).status_code, 204)
+        self.assertEqual(self.post('api_refresh', {'refresh_token': refresh}).status_code, 401)
+
+    def test_change_password_replaces_the_tokens(self):
+        pair = self.login()
+        other_device = self.login()['refresh_token']
+        response = self.post('api_change_password', {
+            'old_password': 'testpass123', 'new_password1': 'Sup3r-secret-pw', 'new_password2': 'Sup3r-secret-pw',
+        }, Authorization=f"Bearer {pair['access_token']}")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.post('api_refresh', {'refresh_token': other_device}).status_code, 401)
+        self.assertEqual(self.post('api_refresh', {'refresh_token': response.json()['refresh_token']}).status_code, 200)
+        self.login('Sup3r-secret-pw')
+
+    def test_password_change_elsewhere_voids_refresh_tokens(self):
+        refresh = self.login()['refresh_token']
+        self.user.set_password('Sup3r-secret-pw')
+        self.user.save()
+        self.assertEqual(self.post('api_refresh', {'refresh_token': refresh}).status_code, 401)
+
+    def test_forgot_and_reset_password(self):
+        refresh = self.login()['refresh_token']
+        self.assertEqual(self.post('api_forgot_password', {'email': 'nobody@example.com'}).status_code, 400)
+        self.assertEqual(self.post('api_forgot_password', {'email': 'api@example.com'}).status_code, 202)
+        self.assertEqual(OutboundEmail.objects.count(), 1)
+
+        token = tokens.make_token(self.user)
+        self.assertEqual(self.post('api_reset_password', {'token': 'bogus'}).status_code, 400)
+        response = self.post('api_reset_password', {'token': token, 'new_password': 'Sup3r-secret-pw', 'confirm_password': 'Sup3r-secret-pw'})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.post('api_refresh', {'refresh_token': refresh}).status_code, 401)
+        self.login('Sup3r-secret-pw')
+
+    def test_bad_requests(self):
+        response = self.client.post(reverse('api_login'), 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('body', response.json()['errors'])
+        response = self.client.get(reverse('api_login'))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response['Allow'], 'POST, OPTIONS')
+        ## Form encoded bodies work too
+        response = self.client.post(reverse('api_login'), {'email_or_username': 'apiuser', 'password': 'testpass123'})
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(AUTH_PERMISSION_CACHE_TTL=300)
+class PermissionCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(email='staff@example.com', username='staff', password='testpass123')
+        self.group = Group.objects.create(name='support')
+        self.group.permissions.add(Permission.objects.get(codename='view_customuser'))
+        self.user.groups.add(self.group)
+
+    def fresh(self):
+        ## The next request's user instance
+        return CustomUser.objects.get(pk=self.user.pk)
+
+    def test_cached_across_requests(self):
+        self.assertTrue(self.fresh().has_perm('users.view_customuser'))
+        user = self.fresh()
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('users.view_customuser'))
+            self.assertFalse(user.has_perm('users.change_customuser'))
+            self.assertTrue(user.has_module_perms('users'))
+
+    def test_invalidated_by_membership_and_permission_changes(self):
+        change = Permission.objects.get(codename='change_customuser')
+        delete = Permission.objects.get(codename='delete_customuser')
+        self.assertFalse(self.fresh().has_perm('users.change_customuser'))
+        self.group.permissions.add(change)
+        self.assertTrue(self.fresh().has_perm('users.change_customuser'))
+        self.user.user_permissions.add(delete)
+        self.assertTrue(self.fresh().has_perm('users.delete_customuser'))
+        delete.user_set.remove(self.user)
+        self.assertFalse(self.fresh().has_perm('users.delete_customuser'))
+        self.group.user_set.remove(self.user)
+        self.assertFalse(self.fresh().has_perm('users.view_customuser'))
+        self.group.user_set.add(self.user)
+        self.assertTrue(self.fresh().has_perm('users.view_customuser'))
+        self.group.delete()
+        self.assertEqual(self.fresh().get_all_permissions(), set())
+
+    def test_same_answers_as_model_backend(self):
+        self.user.user_permissions.add(Permission.objects.get(codename='add_group'))
+        cached = self.fresh().get_all_permissions()
+        with override_settings(AUTH_PERMISSION_CACHE_TTL=0):
+            self.assertEqual(self.fresh().get_all_permissions(), cached)
+        CustomUser.objects.filter(pk=self.user.pk).update(is_superuser=True)
+        invalidate_user(self.user.pk)
+        self.assertEqual(len(self.fresh().get_all_permissions()), Permission.objects.count())
+
+    def test_admin_pages_skip_permission_queries_when_warm(self):
+        CustomUser.objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.client.force_login(self.fresh())
+        self.client.get(reverse('admin:index'))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('admin:index')).status_code, 200)
+        self.assertFalse([query for query in queries.captured_queries if 'auth_permission' in query['sql']])
+
+
+@override_settings(
+    DATABASE_SHARDS=['shard1', 'shard2'], DATABASE_ROUTERS=['users.sharding.ShardRouter'], DATABASE_REPLICAS=[],
+)
+class ShardingTestCase(TestCase):
+    ## Two more SQLite files stand in for the shards, the test database is the default one.
+    ## Registered after the test case set up its databases, so their rows are managed here.
+    SHARDS = ['shard1', 'shard2']
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        for alias in cls.SHARDS:
+            connections.settings[alias] = {
+                **connections.settings['default'],
+                'NAME': os.path.join(cls.directory, f'{alias}.sqlite3'),
+                'TEST': {**connections.settings['default']['TEST'], 'NAME': None},
+            }
+            call_command('migrate', database=alias, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        for alias in cls.SHARDS:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        for name in os.listdir(cls.directory):
+            os.unlink(os.path.join(cls.directory, name))
+        os.rmdir(cls.directory)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        missing_identifiers.clear()
+        ratelimit.get_store().clear()
+        activity.get_writer().discard()
+        for alias in self.SHARDS:
+            CustomUser.objects.using(alias).all().delete()
+
+    def create(self, n):
+        return CustomUser.objects.create_user(email=f'User{n}@example.com', username=f'user{n}', password='testpass123')
+
+    def home(self, user):
+        ## Every database the user is on
+        return [alias for alias in ['default', *self.SHARDS] if CustomUser.objects.using(alias).filter(pk=user.pk).exists()]
+
+    def test_users_are_placed_by_email(self):
+        users = [self.create(n) for n in range(8)]
+        admin = CustomUser.objects.create_superuser('admin@example.com', 'admin', 'testpass123')
+        for user in users:
+            shard = sharding.shard_for_email(user.email)
+            self.assertEqual(self.home(user), [shard])
+            self.assertEqual(sharding.directory().get(pk=user.pk).shard, shard)
+        self.assertEqual({sharding.shard_for_email(user.email) for user in users}, set(self.SHARDS))
+        ## Staff stay with the groups and permissions, ids are unique across databases
+        self.assertEqual(self.home(admin), ['default'])
+        self.assertEqual(len({user.pk for user in [*users, admin]}), 9)
+        self.assertNotIn('users_userdirectory', connections['shard1'].introspection.table_names())
+
+    def test_login_and_session_on_a_shard(self):
+        user = self.create(1)
+        backend = EmailOrUsernameModelBackend()
+        self.assertEqual(backend.authenticate(None, username='user1@EXAMPLE.com', password='testpass123'), user)
+        self.assertEqual(backend.authenticate(None, username='user1', password='testpass123'), user)
+        response = self.client.post(reverse('login'), {'email_or_username': 'user1', 'password': 'testpass123'})
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+        cache.clear()
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+        ## Saves go to the shard too, as do the batched last_login updates
+        user.set_password('n3w-passw0rd')
+        user.save(update_fields=['password', 'password_stamp'])
+        self.assertTrue(CustomUser.objects.using(self.home(user)[0]).get(pk=user.pk).check_password('n3w-passw0rd'))
+        self.assertEqual(activity.get_writer().flush(), 2)
+        self.assertIsNotNone(CustomUser.objects.using(self.home(user)[0]).get(pk=user.pk).last_login)
+
+    def test_api_tokens_of_sharded_users(self):
+        self.create(1)
+        response = self.client.post(reverse('api_login'), {'email_or_username': 'user1', 'password': 'testpass123'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse('api_refresh'), {'refresh_token': response.json()['refresh_token']})
+        self.assertEqual(response.status_code, 200)
+
+    def test_identifiers_are_unique_across_shards(self):
+        self.create(1)
+        self.assertEqual(CustomUser.objects.taken_identifiers('USER1@example.com', 'User1'), ['email', 'username'])
+        with self.assertRaises(IntegrityError):
+            CustomUser.objects.create_user(email='other@example.com', username='user1', password='testpass123')
+        ## Same email, same shard: its unique index refuses it and the directory row goes
+        with self.assertRaises(IntegrityError):
+            CustomUser.objects.create_user(email='User1@example.com', username='other', password='testpass123')
+        self.assertEqual(sharding.directory().count(), 1)
+
+    def test_every_insert_takes_its_id_from_the_directory(self):
+        user = self.create(1)
+        ## createsuperuser names the default database
+        admin = CustomUser.objects.db_manager('default').create_superuser('admin@example.com', 'admin', 'testpass123')
+        added = CustomUser(email='added@example.com', username='added')
+        CustomUserAdmin(CustomUser, admin_site).save_model(None, added, mock.Mock(cleaned_data={}), change=False)
+        self.assertEqual(self.home(added), [sharding.shard_for_email(added.email)])
+        self.assertEqual(self.home(admin), ['default'])
+        self.assertEqual(set(sharding.directory().values_list('pk', flat=True)), {user.pk, admin.pk, added.pk})
+        with self.assertRaisesMessage(CommandError, 'does not support sharded users'):
+            call_command('users_import', os.devnull, '--workers', '1', stdout=StringIO())
+
+    def test_writes_wait_for_a_move(self):
+        user = self.create(1)
+        sharding.directory().filter(pk=user.pk).update(moving=True)
+
+        def move_ends(seconds):
+            sharding.directory().filter(pk=user.pk).update(moving=False)
+
+        user.email = 'during@example.com'
+        with mock.patch('users.sharding.time.sleep', side_effect=move_ends) as sleep:
+            user.save(update_fields=['email'])
+        sleep.assert_called_once()
+        self.assertEqual(CustomUser.objects.using(self.home(user)[0]).get(pk=user.pk).email, 'during@example.com')
+
+        sharding.directory().filter(pk=user.pk).update(moving=True)
+        with self.settings(SHARD_MOVE_WAIT=0), self.assertRaises(OperationalError):
+            user.save(update_fields=['email'])
+
+    def test_a_write_that_read_the_directory_before_a_move_is_not_lost(self):
+        user = self.create(1)
+        source = self.home(user)[0]
+        target = next(alias for alias in self.SHARDS if alias != source)
+        wait_for_moves = sharding._wait_for_moves
+
+        def move_after_the_read(user_ids):
+            ## The writer has its shard, the whole move runs before it writes there
+            homes = wait_for_moves(user_ids)
+            if homes[user.pk] == source:
+                sharding.move([user], source, target)
+            return homes
+
+        with mock.patch('users.sharding._wait_for_moves', side_effect=move_after_the_read) as read:
+            user.email = 'during@example.com'
+            user.save(update_fields=['email'])
+            self.assertEqual(read.call_count, 2)
+            self.assertEqual(self.home(user), [target])
+            self.assertEqual(CustomUser.objects.using(target).get(pk=user.pk).email, 'during@example.com')
+
+            ## A full save would have put the user back on the old shard with an INSERT
+            sharding.move([user], target, source)
+            source, target = target, source
+            user.username = 'renamed'
+            user.save()
+            self.assertEqual(self.home(user), [target])
+            self.assertEqual(CustomUser.objects.using(target).get(pk=user.pk).username, 'renamed')
+
+    def test_moves_lock_out_writes_on_sqlite(self):
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+
+        user = self.create(1)
+        source = self.home(user)[0]
+        writer = DatabaseWrapper(connections[source].settings_dict, 'writer')
+        self.addCleanup(writer.close)
+        with writer.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout = 0')
+        with transaction.atomic(using=source):
+            self.assertEqual(sharding._lock_users(source, [user.pk]), [user])
+            with self.assertRaisesMessage(OperationalError, 'locked'), writer.cursor() as cursor:
+                cursor.execute('UPDATE users_customuser SET username = %s WHERE id = %s', ['renamed', user.pk])
+        with writer.cursor() as cursor:
+            cursor.execute('UPDATE users_customuser SET username = %s WHERE id = %s', ['renamed', user.pk])
+        self.assertEqual(CustomUser.objects.using(source).get(pk=user.pk).username, 'renamed')
+
+    def test_users_given_groups_or_permissions_move_to_the_default_database(self):
+        group = Group.objects.create(name='editors')
+        permission = Permission.objects.get(codename='view_customuser')
+        first, second, third = self.create(1), self.create(2), self.create(3)
+        first.groups.add(group)
+        group.user_set.add(second)
+        third.user_permissions.add(permission)
+        for user in (first, second, third):
+            self.assertEqual(self.home(user), ['default'])
+            self.assertEqual(sharding.directory().get(pk=user.pk).shard, 'default')
+        connections['default'].check_constraints()
+        self.assertEqual(list(first.groups.all()), [group])
+        self.assertEqual(set(group.user_set.all()), {first, second})
+        self.assertTrue(CustomUser.objects.get(pk=third.pk).has_perm('users.view_customuser'))
+        ## Still reachable at login
+        self.assertEqual(EmailOrUsernameModelBackend().authenticate(None, username='user2', password='testpass123'), second)
+
+    def test_users_made_staff_move_to_the_default_database(self):
+        from django.contrib.admin.models import ADDITION, LogEntry
+        from django.contrib.contenttypes.models import ContentType
+
+        user = self.create(1)
+        user.is_staff = True
+        user.save(update_fields=['is_staff'])
+        self.assertEqual(self.home(user), ['default'])
+        self.assertTrue(CustomUser.objects.using('default').get(pk=user.pk).is_staff)
+        ## What the admin writes for every change they make
+        LogEntry.objects.log_action(user.pk, ContentType.objects.get_for_model(Group).pk, 1, 'editors', ADDITION)
+        connections['default'].check_constraints()
+
+        other = self.create(2)
+        other.is_superuser = True
+        other.save()
+        self.assertEqual(self.home(other), ['default'])
+
+    def test_failed_move_clears_the_mark(self):
+        user = self.create(1)
+        source = self.home(user)[0]
+        target = next(alias for alias in self.SHARDS if alias != source)
+        with mock.patch.object(QuerySet, 'bulk_create', side_effect=DatabaseError('disk full')), self.assertRaises(DatabaseError):
+            sharding.move([user], source, target)
+        self.assertEqual(self.home(user), [source])
+        self.assertEqual(sharding.directory().filter(pk=user.pk, moving=False, shard=source).count(), 1)
+        sharding.move([user], source, target)
+        self.assertEqual(self.home(user), [target])
+        self.assertFalse(sharding.directory().get(pk=user.pk).moving)
+
+    def test_rebalance_moves_users(self):
+        with self.settings(DATABASE_SHARDS=[]):
+            legacy = self.create('legacy')
+        self.assertEqual(self.home(legacy), ['default'])
+        ## The directory would hand out the legacy user's id again
+        with self.assertRaises(ImproperlyConfigured):
+            self.create(0)
+
+        with self.settings(DATABASE_SHARDS=['shard1']):
+            call_command('rebalance_users', pause=0, stdout=StringIO())
+            self.assertEqual(self.home(legacy), ['shard1'])
+            users = [self.create(n) for n in range(10)]
+            admin = CustomUser.objects.create_superuser('admin@example.com', 'admin', 'testpass123')
+        moving = [user for user in [legacy, *users] if sharding.shard_for_email(user.email) == 'shard2']
+        self.client.force_login(moving[0])
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+
+        out = StringIO()
+        call_command('rebalance_users', batch_size=3, pause=0, stdout=out)
+        self.assertIn(f'Moved {len(moving)} users from shard1 to shard2', out.getvalue())
+        for user in [legacy, *users]:
+            shard = sharding.shard_for_email(user.email)
+            self.assertEqual(self.home(user), [shard])
+            self.assertEqual(sharding.directory().get(pk=user.pk).shard, shard)
+        self.assertEqual(self.home(admin), ['default'])
+        moved = CustomUser.objects.using('shard2').get(pk=moving[0].pk)
+        self.assertEqual(moved.date_joined, moving[0].date_joined)
+        self.assertTrue(moved.check_password('testpass123'))
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+
+        out = StringIO()
+        call_command('rebalance_users', pause=0, stdout=out)
+        self.assertIn('Moved 0 users', out.getvalue())
+
+
+class ConditionalPageTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        rendering.clear_shells()
+        ratelimit.get_store().clear()
+        activity.get_writer().discard()
+        self.user = CustomUser.objects.create_user(email='etag@example.com', username='etaguser', password='testpass123')
+        self.client.force_login(self.user)
+        ## The first page sets the CSRF cookie the ETag is made of
+        self.client.get(reverse('dashboard'))
+
+    def decoded(self, response):
+        if response['Content-Encoding'] == 'gzip':
+            return gzip.decompress(response.content)
+        return middleware.brotli.decompress(response.content)
+
+    def test_revisit_is_not_modified(self):
+        first = self.client.get(reverse('dashboard'))
+        self.assertTrue(first['ETag'].startswith('W/"'))
+        self.assertIn('private', first['Cache-Control'])
+        self.assertIn('no-cache', first['Cache-Control'])
+
+        with mock.patch('users.views.render', wraps=views.render) as render:
+            revisit = self.client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(revisit.status_code, 304)
+        self.assertEqual(revisit.content, b'')
+        self.assertEqual(revisit['ETag'], first['ETag'])
+        self.assertEqual(render.call_count, 0)
+        self.assertEqual(revisit.templates, [])
+
+        ## Any change to the user, a new login or pending messages give a new page
+        self.user.first_name = 'Changed'
+        self.user.save()
+        changed = self.client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+        self.client.post(reverse('login'), {'email_or_username': 'etaguser', 'password': 'testpass123'})
+        relogged = self.client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=changed['ETag'])
+        self.assertEqual(relogged.status_code, 200)
+
+        response = self.client.post(reverse('change_password'), {
+            'old_password': 'testpass123', 'new_password1': 'N3w-secret-pw', 'new_password2': 'N3w-secret-pw',
+        })
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get(response.url, HTTP_IF_NONE_MATCH=relogged['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+    async def test_async_etag_matches_sync(self):
+        request = RequestFactory().get('/')
+        request.META['CSRF_COOKIE'] = 'secret'
+        etag = await rendering.apage_etag(request, self.user)
+        self.assertIsNotNone(etag)
+        self.assertEqual(etag, await sync_to_async(rendering.page_etag)(request, self.user))
+
+    def test_etag_is_per_user(self):
+        other = CustomUser.objects.create_user(email='other@example.com', username='otheruser', password='testpass123')
+        etag = self.client.get(reverse('profile'))['ETag']
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(reverse('profile'), HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_gzip(self):
+        plain = self.client.get(reverse('dashboard'))
+        response = self.client.get(reverse('dashboard'), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertLess(len(response.content), len(plain.content) * 0.6)
+        self.assertIn(b'hi,etaguser', self.decoded(response))
+        ## The page carries a CSRF token: a random length file name pads the output
+        self.assertTrue(response.content[3] & 0x08)
+
+        self.assertEqual(self.client.get(reverse('dashboard'), HTTP_ACCEPT_ENCODING='gzip;q=0').get('Content-Encoding'), None)
+
+    @skipUnless(middleware.brotli, 'brotli is not installed')
+    def test_brotli(self):
+        plain = self.client.get(reverse('dashboard'))
+        response = self.client.get(reverse('dashboard'), HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertLess(len(response.content), len(plain.content) * 0.6)
+        page = self.decoded(response)
+        self.assertIn(b'hi,etaguser', page)
+        self.assertRegex(page, rb'<!-- [\w-]* -->$')
+
+    def test_skipped_responses(self):
+        ## Too small to be worth it
+        response = self.client.get(reverse('api_me'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+        with self.settings(COMPRESSION_MIN_SIZE=0):
+            response = self.client.get(reverse('dashboard'), HTTP_ACCEPT_ENCODING='identity')
+        self.assertNotIn('Content-Encoding', response)
+
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        encoded = HttpResponse(b'x' * 2000, content_type='text/plain')
+        encoded['Content-Encoding'] = 'br'
+        compress = middleware.CompressionMiddleware(lambda request: encoded)
+        self.assertEqual(compress(request).content, b'x' * 2000)
+        image = HttpResponse(b'x' * 2000, content_type='image/png')
+        self.assertNotIn('Content-Encoding', middleware.CompressionMiddleware(lambda request: image)(request))
+
+    def test_streaming(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        compress = middleware.CompressionMiddleware(lambda request: StreamingHttpResponse(iter([b'a' * 1000, b'b' * 1000]), content_type='text/plain'))
+        response = compress(request)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response)
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), b'a' * 1000 + b'b' * 1000)
+
+
+class WarmUpTestCase(TestCase):
+
+    def test_warm_up(self):
+        with self.settings(PASSWORD_FILTER_PATH=os.path.join(tempfile.gettempdir(), 'missing.bloom')):
+            validator = next(v for v in get_default_password_validators() if isinstance(v, password_filter.BreachedPasswordValidator))
+            validator._fallback = None
+            ## The test case's transaction must survive the step that closes connections
+            with mock.patch.object(connections, 'close_all') as close_all:
+                timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['urls', 'templates', 'passwords', 'databases'])
+        close_all.assert_called_once()
+        self.assertIsNotNone(validator._fallback)
+        loader = engines.all()[0].engine.template_loaders[0]
+        for name in ('users/base.html', 'users/dashboard.html', 'users/login.html', 'users/messages.html'):
+            self.assertIn(name, loader.get_template_cache)
+
+    def test_unreachable_database_is_skipped(self):
+        ## The first alias fails, the others are still warmed up
+        failing = mock.patch.object(connections['default'], 'ensure_connection', side_effect=DatabaseError('unreachable'))
+        with failing, mock.patch.object(connections, 'close_all') as close_all, self.assertLogs('users.warmup', 'ERROR') as logs:
+            warmup.connect()
+            warmup.warm_databases()
+        close_all.assert_called_once()
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("'default'", logs.output[0])
+
+    def test_import_leaves_out_build_only_modules(self):
+        ## numpy (filter builds) and multiprocessing pools (process hashing, imports) load on use
+        code = (
+            'import django; django.setup(); '
+            'from whatbytes_assignment import urls; from users import password_filter, hashing; import sys; '
+            'print(sorted({"numpy", "concurrent.futures.process"} & set(sys.modules)))'
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', code], cwd=settings.BASE_DIR, check=True, capture_output=True, text=True,
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'whatbytes_assignment.settings'},
+        ).stdout
+        self.assertEqual(output.strip(), '[]')
@@ -0,0 +1,91 @@
+'''
+Compact, self-checking password reset tokens.
+
+    <user id, base36>-<issued at, base36>-<state>-<signature>
+
+The signature covers the other parts and the issue time bounds the token
+lifetime (PASSWORD_RESET_TIMEOUT), so forged, truncated or expired links
+are rejected before anything is loaded. ``state`` hashes the password
+hash, last login and email of the user: the token dies as soon as one of
+them changes, which makes it single use like Django's own tokens.
+
+The user behind a valid token is always read from the primary database,
+never from the user cache: a cached copy may predate the reset that used
+the token up, on this worker or on another one.
+'''
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import base36_to_int, int_to_base36
+
+from users import sharding
+
+KEY_SALT = 'users.tokens.PasswordResetToken'
+## Longer inputs cannot be one of our tokens, don't spend an HMAC on them
+MAX_TOKEN_LENGTH = 80
+
+ResetToken = namedtuple('ResetToken', ['user_id', 'issued', 'state'])
+
+
+def _secrets():
+    return [settings.SECRET_KEY, *settings.SECRET_KEY_FALLBACKS]
+
+
+def _sign(payload, secret):
+    return salted_hmac(KEY_SALT, payload, secret=secret, algorithm='sha256').hexdigest()[:32]
+
+
+def _state(user, secret):
+    ## Truncated like Django's generator: the DB value may have lost precision
+    login = '' if user.last_login is None else user.last_login.replace(microsecond=0, tzinfo=None)
+    value = f'{user.pk}{user.password}{login}{user.email}'
+    return salted_hmac(f'{KEY_SALT}.state', value, secret=secret, algorithm='sha256').hexdigest()[:16]
+
+
+def make_token(user, issued=None):
+    issued = int(time.time()) if issued is None else issued
+    payload = f'{int_to_base36(user.pk)}-{int_to_base36(issued)}-{_state(user, settings.SECRET_KEY)}'
+    return f'{payload}-{_sign(payload, settings.SECRET_KEY)}'
+
+
+def parse_token(token):
+    '''
+    Return a ResetToken for a genuine, unexpired token, else None. No queries.
+    '''
+    if not token or len(token) > MAX_TOKEN_LENGTH:
+        return None
+    try:
+        uid, issued, state, signature = token.split('-')
+        user_id, issued = base36_to_int(uid), base36_to_int(issued)
+    except ValueError:
+        return None
+
+    payload = token.rpartition('-')[0]
+    if not any(constant_time_compare(signature, _sign(payload, secret)) for secret in _secrets()):
+        return None
+    if not 0 <= time.time() - issued <= settings.PASSWORD_RESET_TIMEOUT:
+        return None
+    return ResetToken(user_id, issued, state)
+
+
+def check_user(user, parsed):
+    return any(constant_time_compare(parsed.state, _state(user, secret)) for secret in _secrets())
+
+
+async def aget_user(token):
+    '''
+    The user a reset token was issued to, or None if it is no longer valid.
+    '''
+    parsed = parse_token(token)
+    if parsed is None:
+        return None
+    ## The primary: a lagging replica would still have the password the token was made for
+    alias = await sharding.adb_for_user(parsed.user_id) or DEFAULT_DB_ALIAS
+    user = await get_user_model()._default_manager.db_manager(alias).filter(pk=parsed.user_id).afirst()
+    if user is None or not check_user(user, parsed):
+        return None
+    return user
@@ -1,4 +1,5 @@
 from django.urls import path
+from . import api
 from .views import RegisterView,CustomLoginView,Dashboard,Logout,ChangePasswordView,ProfileView,ForgotPassword,PasswordResetView
 urlpatterns = [
     path('signup/', RegisterView.as_view(), name='signup'),
@@ -10,3 +11,15 @@ urlpatterns = [
     path('forgot-password/', ForgotPassword.as_view(), name='forgot_password'),
     path('reset-password', PasswordResetView.as_view(), name='reset_password'),
 ]
+
+## JSON API (users/api.py)
+urlpatterns += [
+    path('api/signup/', api.SignupApi.as_view(), name='api_signup'),
+    path('api/login/', api.LoginApi.as_view(), name='api_login'),
+    path('api/refresh/', api.RefreshApi.as_view(), name='api_refresh'),
+    path('api/logout/', api.LogoutApi.as_view(), name='api_logout'),
+    path('api/me/', api.MeApi.as_view(), name='api_me'),
+    path('api/change-password/', api.ChangePasswordApi.as_view(), name='api_change_password'),
+    path('api/forgot-password/', api.ForgotPasswordApi.as_view(), name='api_forgot_password'),
+    path('api/reset-password/', api.ResetPasswordApi.as_view(), name='api_reset_password'),
+]
@@ -1,181 +1,192 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.views import View
-from django.contrib.auth import authenticate, login
-from django.utils.encoding import force_str
-from django.utils.http import urlsafe_base64_decode
+from django.contrib.auth import alogin, alogout, aupdate_session_auth_hash
+from users.caching import normalize_identifier
 from users.custom_auth import EmailOrUsernameModelBackend
-from users.email import send_forgot_email
+from users.decorators import alogin_required, conditional_page, use_replicas
+from users.email import asend_forgot_email
+from users.ratelimit import client_ip, forgot_password_limiter, login_limiter, ratelimit
+from users.rendering import render_shell
+from users import activity, tokens
 from .forms.user_form import ChangePasswordForm, CustomUserCreationForm, ForgotPasswordForm, LoginForm, ResetPasswordForm
-import re
 from django.conf import settings
-from django.contrib.auth.tokens import PasswordResetTokenGenerator
-from django.utils.http import urlsafe_base64_encode
-from django.utils.encoding import smart_bytes
-from .models import CustomUser
-from django.contrib.auth import update_session_auth_hash
-from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
-from django.contrib.auth import logout
 
-class RegisterView(View):
+AUTH_BACKEND = 'users.custom_auth.EmailOrUsernameModelBackend'
+
+
+class AsyncView(View):
+    '''
+    Base for the async views. The user is resolved once with request.auser()
+    so templates and context processors never hit the sync ORM from the
+    event loop (that also loads the session, which messages read from).
+    '''
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class RegisterView(AsyncView):
     '''
     Basic Registration view for user, using django built in Authentication :)
     '''
     form_class = CustomUserCreationForm
     template_name = 'users/signup.html'
 
-    def dispatch(self, request, *args, **kwargs):
+    async def dispatch(self, request, *args, **kwargs):
         ## Redirect user too dashbooard if he tries to go to signup page
-        if request.user.is_authenticated:
+        if (await request.auser()).is_authenticated:
             return redirect(to='/dashboard')
-        return super(RegisterView, self).dispatch(request, *args, **kwargs)
+        return await super(RegisterView, self).dispatch(request, *args, **kwargs)
 
-    def get(self, request, *args, **kwargs):
-        form = self.form_class()
-        return render(request, self.template_name, {'form': form})
+    async def get(self, request, *args, **kwargs):
+        return render_shell(request, self.template_name, lambda: {'form': self.form_class()})
 
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
         form = self.form_class(request.POST)
 
-        if form.is_valid():
-            form.save()
+        ## Model form uniqueness checks only exist on the sync ORM
+        if await sync_to_async(form.is_valid)() and await form.asave() is not None:
             username = form.cleaned_data.get('username')
             messages.success(request, f'Account created for {username}')
             return redirect('login')
         return render(request, self.template_name, {'form': form})
 
-class CustomLoginView(View):
+def normalize_email_identifier(email):
+    return email.strip().lower()
+
+@method_decorator(ratelimit(login_limiter, 'email_or_username', normalize_identifier), name='dispatch')
+class CustomLoginView(AsyncView):
     '''
     Custom Login View for user, using django built in Authentication :)
     '''
     template_name = 'users/login.html'
     form_class = LoginForm
 
-    def get(self, request):
+    async def get(self, request):
         if request.user.is_authenticated:
             return redirect('dashboard')
-        form = self.form_class()
-        return render(request, self.template_name, {'form': form})
+        return render_shell(request, self.template_name, lambda: {'form': self.form_class()})
 
-    def post(self, request):
+    async def post(self, request):
         form = self.form_class(request.POST)
         if form.is_valid():
             email_or_username = form.cleaned_data['email_or_username']
             password = form.cleaned_data['password']
-            ## Also could have set it as AUTHENTICATION_BACKENDS in settings.py
-            user = EmailOrUsernameModelBackend.authenticate(request, email_or_username, password=password)
+            user = await EmailOrUsernameModelBackend().aauthenticate(request, username=email_or_username, password=password)
+            identifier = normalize_identifier(email_or_username)
             if user is not None:
-                login(request, user)
+                await login_limiter.areset(client_ip(request), identifier)
+                await alogin(request, user, backend=AUTH_BACKEND)
                 return redirect('dashboard')  # Redirect to a dashboard or home page
             else:
+                await login_limiter.ahit(client_ip(request), identifier)
+                activity.get_writer().record_failure(identifier, client_ip(request))
                 form=self.form_class()
                 messages.error(request, 'Invalid email/username or password')
         return render(request, self.template_name, {'form': form})
-    
-@method_decorator(login_required(login_url='login'), name='dispatch')
-class Dashboard(View):
-    def get(self, request):
+
+@method_decorator(use_replicas, name='dispatch')
+@method_decorator(alogin_required(login_url='login'), name='dispatch')
+@method_decorator(conditional_page, name='dispatch')
+class Dashboard(AsyncView):
+    async def get(self, request):
         context={
             'user': request.user
         }
         return render(request, 'users/dashboard.html',context=context)
-    
-@method_decorator(login_required(login_url='login'), name='dispatch')
-class ProfileView(View):
-    def get(self, request):
+
+@method_decorator(use_replicas, name='dispatch')
+@method_decorator(alogin_required(login_url='login'), name='dispatch')
+@method_decorator(conditional_page, name='dispatch')
+class ProfileView(AsyncView):
+    async def get(self, request):
         context={
             'user': request.user
         }
         return render(request, 'users/profile.html',context=context)
 
-class Logout(View):
-    def post(self, request):
-        logout(request)
+class Logout(AsyncView):
+    async def post(self, request):
+        await alogout(request)
         return redirect('login')
 
-@method_decorator(login_required(login_url='login'), name='dispatch')
-class ChangePasswordView(View):
+@method_decorator(alogin_required(login_url='login'), name='dispatch')
+class ChangePasswordView(AsyncView):
     form_class = ChangePasswordForm
     template_name = 'users/change_password.html'
 
-    def get(self, request):
+    async def get(self, request):
         form = self.form_class(user=request.user)
         return render(request, self.template_name, {'form': form})
 
-    def post(self, request):
+    async def post(self, request):
         form = self.form_class(user=request.user, data=request.POST)
+        await form.acheck_old_password()
         if form.is_valid():
-            user = form.save()
-            update_session_auth_hash(request, user)  # for keeping the user logged in after password change
+            user = await form.asave()
+            await aupdate_session_auth_hash(request, user)  # for keeping the user logged in after password change
             messages.success(request, 'Your password was successfully updated.')
             return redirect('dashboard')
         return render(request, self.template_name, {'form': form})
-    
 
-class ForgotPassword(View):
+
+@method_decorator(ratelimit(forgot_password_limiter, 'email', normalize_email_identifier), name='dispatch')
+class ForgotPassword(AsyncView):
     '''
     View to reset password can be accessed by anaonymous user to rest password over mail
     '''
     form_class = ChangePasswordForm
     template_name = 'users/forgot_pass.html'
-    def get(self, request):
+    async def get(self, request):
         if request.user.is_authenticated:
             return redirect('dashboard')
-        form = ForgotPasswordForm()
-        return render(request, self.template_name, {'form': form})
-    
+        return render_shell(request, self.template_name, lambda: {'form': ForgotPasswordForm()})
+
     ## Not Using Django PasswordResetView as to show my understanding and custom is better
-    def post(self, request):
+    async def post(self, request):
+        ## Every attempt counts, valid or not: each one may cost a reset mail
+        await forgot_password_limiter.ahit(client_ip(request), normalize_email_identifier(request.POST.get('email', '')))
         form = ForgotPasswordForm(request.POST)
+        await form.alookup_user()
         if form.is_valid():
-            email = form.cleaned_data['email']
-            user = CustomUser.objects.get(email=email) ## Get as we already checked if user exsists
-            uidb64 = urlsafe_base64_encode(smart_bytes(user.pk))
-            token = PasswordResetTokenGenerator().make_token(user)
-            link = f"{settings.BASE_URL}reset-password?base={uidb64}&token={token}"
-            send_forgot_email(request,user.username, user.email, link)
+            user = form.user ## Already fetched while validating the form
+            token = tokens.make_token(user)
+            link = f"{settings.BASE_URL}reset-password?token={token}"
+            await asend_forgot_email(request,user.username, user.email, link)
             messages.success(request, 'We have sent you a link to reset your password.')
             return redirect('login')
         return render(request, self.template_name, {'form': form})
-    
+
  ## Not Using Django PasswordResetView as to show my understanding and custom is better
-class PasswordResetView(View):
+class PasswordResetView(AsyncView):
     form_class = ResetPasswordForm
     template_name = 'users/reset_password.html'
 
-    def get(self, request, *args, **kwargs):
-        uidb64 = request.GET.get('base', None)
-        token = request.GET.get('token', None)
-        try:
-            uid = force_str(urlsafe_base64_decode(uidb64))
-            user = CustomUser.objects.get(pk=uid)
-        except (TypeError, ValueError, OverflowError, CustomUser.DoesNotExist):
-            user = None
+    async def _get_user(self, request):
+        ## Bad or expired tokens are turned away before any query
+        return await tokens.aget_user(request.GET.get('token'))
 
-        if user is not None and PasswordResetTokenGenerator().check_token(user, token):
+    async def get(self, request, *args, **kwargs):
+        user = await self._get_user(request)
+        if user is not None:
             form = self.form_class(user=user)
             return render(request, self.template_name, {'form': form, 'validlink': True})
         else:
             return render(request, self.template_name, {'validlink': False})
 
-    def post(self, request, *args, **kwargs):
-        uidb64 = request.GET.get('base', None)
-        token = request.GET.get('token', None)
-        try:
-            uid = force_str(urlsafe_base64_decode(uidb64))
-            user = CustomUser.objects.get(pk=uid)
-        except (TypeError, ValueError, OverflowError, CustomUser.DoesNotExist):
-            user = None
-
-        if user is not None and PasswordResetTokenGenerator().check_token(user, token):
+    async def post(self, request, *args, **kwargs):
+        user = await self._get_user(request)
+        if user is not None:
             form = self.form_class(data=request.POST, user=user)
             if form.is_valid():
-                form.save()
+                await form.asave()
                 messages.success(request, 'Your password was reset successfully.')
                 return redirect('login')
             else:
-                
+
                 return render(request, self.template_name, {'form': form, 'validlink': True})
         else:
-            return render(request, self.template_name, {'validlink': False})
\ No newline at end of file
+            return render(request, self.template_name, {'validlink': False})
@@ -0,0 +1,130 @@
+'''
+Warm-up of a new web process, so that its first request is not the one
+paying for Django's lazy setup.
+
+``warm_up()`` runs, in order:
+
+    urls        import every view, fill the URL resolver and reverse caches
+    templates   compile users/templates into the cached template loader
+    passwords   load AUTH_PASSWORD_VALIDATORS (the breached password filter,
+                or Django's common password list) and PASSWORD_HASHERS
+    databases   connect to every database once: imports the backend, runs
+                the connect pragmas, reads the schema into the OS page cache
+
+wsgi.py and asgi.py call it on import when WARM_UP is on. A preforking
+server that preloads the application (gunicorn.conf.py) imports them in
+the master, so workers are forked with all of the above in memory and
+share those pages copy-on-write; ``freeze()`` keeps the workers' garbage
+collector from writing to, and so copying, them.
+
+Connections do not survive a fork: warm_up() closes them again, and
+``connect()`` opens them in each worker once it is forked. A database
+that cannot be reached is logged and skipped, by both: the requests that
+need it will report it.
+'''
+import asyncio
+import gc
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import get_hashers
+from django.contrib.auth.password_validation import get_default_password_validators
+from django.db import connections
+from django.template.loader import get_template
+from django.urls import get_resolver, resolve, reverse
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+def warm_urls():
+    resolver = get_resolver()
+    ## Imports every urlconf and view, and builds the reverse tables
+    resolver.reverse_dict
+    from users import urls
+
+    for pattern in urls.urlpatterns:
+        resolve(reverse(pattern.name))
+
+
+def warm_templates():
+    for path, _, names in os.walk(TEMPLATE_DIR):
+        for name in names:
+            if name.endswith('.html'):
+                get_template(os.path.relpath(os.path.join(path, name), TEMPLATE_DIR))
+
+
+def warm_passwords():
+    for validator in get_default_password_validators():
+        if hasattr(validator, 'warm_up'):
+            validator.warm_up()
+    get_hashers()
+
+
+def connect():
+    '''
+    Open a connection to every database in this thread.
+    '''
+    for alias in connections:
+        try:
+            connections[alias].ensure_connection()
+        except Exception:
+            logger.exception('Could not connect to database %r', alias)
+
+
+def warm_databases():
+    for alias in connections:
+        try:
+            with connections[alias].cursor() as cursor:
+                ## Reading the schema loads it, and the database's first pages, into memory
+                cursor.execute('SELECT 1')
+                connections[alias].introspection.table_names(cursor)
+        except Exception:
+            logger.exception('Could not warm up database %r', alias)
+    connections.close_all()
+
+
+STEPS = [
+    ('urls', warm_urls),
+    ('templates', warm_templates),
+    ('passwords', warm_passwords),
+    ('databases', warm_databases),
+]
+
+
+def warm_up():
+    '''
+    Run every step, and return {step: seconds}.
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        ## Some ASGI servers import the application inside their event loop, where the ORM refuses to connect
+        with ThreadPoolExecutor(1, thread_name_prefix='warm-up') as thread:
+            return thread.submit(warm_up).result()
+    timings = {}
+    for name, step in STEPS:
+        started = time.perf_counter()
+        step()
+        timings[name] = time.perf_counter() - started
+    logger.info('Warmed up in %.0f ms (%s)', sum(timings.values()) * 1000, ', '.join(
+        f'{name} {seconds * 1000:.0f} ms' for name, seconds in timings.items()
+    ))
+    return timings
+
+
+def freeze():
+    '''
+    Move everything allocated so far out of reach of the garbage collector,
+    right before forking workers.
+
+    A collection writes to the header of every object it visits, which
+    would copy every page of the master's heap into each worker.
+    '''
+    gc.collect()
+    gc.freeze()
@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "whatbytes_assignment.settings")
 
 application = get_asgi_application()
+
+## Do the first request's setup now, before a preloading server forks (users/warmup.py)
+if settings.WARM_UP:
+    from users.warmup import warm_up
+
+    warm_up()
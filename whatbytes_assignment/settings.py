@@ -10,8 +10,10 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import sys
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
+from django.core.exceptions import ImproperlyConfigured
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -24,6 +26,8 @@ SECRET_KEY = config("SECRET_KEY")
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = config("DEBUG", cast=bool)
+## `manage.py test`
+TESTING = sys.argv[1:2] == ["test"]
 
 ALLOWED_HOSTS = config("ALLOWED_HOSTS",cast=list)
 
@@ -41,23 +45,49 @@ INSTALLED_APPS = [
     "users"
 ]
 
+## Per-request query/latency instrumentation (users.perf), report with manage.py perf_report
+PERF_ENABLED = config("PERF_ENABLED", default=False, cast=bool)
+## Send the timings to clients as a Server-Timing header (handy in the browser devtools)
+PERF_SERVER_TIMING = config("PERF_SERVER_TIMING", default=True, cast=bool)
+## Every process writes its histograms to PERF_DIR/perf-<pid>.json at most every PERF_FLUSH_INTERVAL seconds
+PERF_DIR = config("PERF_DIR", default=str(BASE_DIR / "perf"))
+PERF_FLUSH_INTERVAL = config("PERF_FLUSH_INTERVAL", default=10, cast=int)
+
 MIDDLEWARE = [
+    ## Removes itself when PERF_ENABLED is off
+    "users.perf.PerfMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    ## Before sessions/auth: static requests skip the rest of the stack
+    "users.middleware.StaticFilesMiddleware",
+    ## gzip/brotli for the dynamic pages; after static files, which come precompressed
+    "users.middleware.CompressionMiddleware",
+    ## Removes itself without DB_REPLICAS; before sessions so session writes pin to the primary
+    "users.routers.StickyPrimaryMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "users.middleware.HashingBusyMiddleware",
 ]
 
 ROOT_URLCONF = "whatbytes_assignment.urls"
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "BACKEND": "users.perf.TimedDjangoTemplates" if PERF_ENABLED else "django.template.backends.django.DjangoTemplates",
         "DIRS": [],
-        "APP_DIRS": True,
         "OPTIONS": {
+            ## Compile each template once per process (APP_DIRS is implied by the app_directories loader)
+            "loaders": [
+                (
+                    "django.template.loaders.cached.Loader",
+                    [
+                        "django.template.loaders.filesystem.Loader",
+                        "django.template.loaders.app_directories.Loader",
+                    ],
+                ),
+            ],
             "context_processors": [
                 "django.template.context_processors.debug",
                 "django.template.context_processors.request",
@@ -68,28 +98,236 @@ TEMPLATES = [
     },
 ]
 
+## Serve login/signup/forgot password to anonymous visitors from a prerendered shell (users.rendering)
+TEMPLATE_SHELLS = config("TEMPLATE_SHELLS", default=True, cast=bool)
+
 WSGI_APPLICATION = "whatbytes_assignment.wsgi.application"
 AUTH_USER_MODEL = 'users.CustomUser'
+AUTHENTICATION_BACKENDS = ['users.custom_auth.EmailOrUsernameModelBackend']
+## Seconds login identifiers that matched no user are remembered, in CACHES["default"]
+AUTH_NEGATIVE_CACHE_TTL = config("AUTH_NEGATIVE_CACHE_TTL", default=30, cast=int)
 ## Email Config
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST=config("EMAIL_HOST")
 EMAIL_HOST_USER = config("EMAIL")
 EMAIL_PORT=config("EMAIL_PORT")
 EMAIL_HOST_PASSWORD =config("PASSWORD")
-EMAIL_USE_TLS = True 
+EMAIL_USE_TLS = True
+
+## Outbound mail queue (users.mail_queue)
+## Run `python manage.py send_queued_mail --loop` or enable the in-process worker thread
+MAIL_QUEUE_IN_PROCESS = config("MAIL_QUEUE_IN_PROCESS", default=False, cast=bool)
+MAIL_QUEUE_BATCH_SIZE = config("MAIL_QUEUE_BATCH_SIZE", default=50, cast=int)
+MAIL_QUEUE_MAX_ATTEMPTS = config("MAIL_QUEUE_MAX_ATTEMPTS", default=5, cast=int)
+MAIL_QUEUE_RETRY_BACKOFF = config("MAIL_QUEUE_RETRY_BACKOFF", default=30, cast=int)
+MAIL_QUEUE_MAX_BACKOFF = config("MAIL_QUEUE_MAX_BACKOFF", default=3600, cast=int)
+MAIL_QUEUE_POLL_INTERVAL = config("MAIL_QUEUE_POLL_INTERVAL", default=5, cast=float)
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
+## Database profile: "sqlite" (local, tuned for concurrent writes) or "postgres"
+DATABASE_PROFILE = config("DATABASE_PROFILE", default="sqlite")
+## Seconds a connection is kept for the next request (0 closes it after each request).
+## Under ASGI keep this at 0 and pool with DB_POOL=pgbouncer instead.
+DB_CONN_MAX_AGE = config("DB_CONN_MAX_AGE", default=60, cast=int)
+
+if DATABASE_PROFILE == "postgres":
+    ## Needs psycopg (pip install "psycopg[binary]")
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": config("DB_NAME", default="wbytes"),
+            "USER": config("DB_USER", default="wbytes"),
+            "PASSWORD": config("DB_PASSWORD", default=""),
+            "HOST": config("DB_HOST", default="127.0.0.1"),
+            "PORT": config("DB_PORT", default=5432, cast=int),
+            "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+            ## Ping reused connections once per request so a restarted server does not fail it
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": {
+                "connect_timeout": config("DB_CONNECT_TIMEOUT", default=5, cast=int),
+                "application_name": "wbytes",
+            },
+        }
+    }
+    ## "pgbouncer": connections go through a transaction-pooling PgBouncer at DB_HOST/DB_PORT.
+    ## Django then closes its connection after each request and avoids server-side cursors,
+    ## which do not survive transaction pooling.
+    if config("DB_POOL", default="") == "pgbouncer":
+        DATABASES["default"]["CONN_MAX_AGE"] = 0
+        DATABASES["default"]["DISABLE_SERVER_SIDE_CURSORS"] = True
+elif DATABASE_PROFILE == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": config("DB_NAME", default=str(BASE_DIR / "db.sqlite3")),
+            "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+            "OPTIONS": {
+                ## Seconds a writer waits for the lock before "database is locked"
+                "timeout": config("SQLITE_BUSY_TIMEOUT", default=20, cast=int),
+            },
+            ## A file for the tests too: the shared cache of an in-memory test database fails
+            ## concurrent writers with "table is locked" at once instead of waiting like WAL does
+            "TEST": {"NAME": str(BASE_DIR / "test-db.sqlite3")},
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}")
+
+## Read replicas (users.routers): comma separated hosts (postgres) or database files (sqlite)
+## kept in sync with the default database, which stays the primary. Each one is set up like
+## the primary, as replica1, replica2...
+DB_REPLICAS = config("DB_REPLICAS", default="", cast=Csv())
+for index, location in enumerate(DB_REPLICAS, 1):
+    DATABASES[f"replica{index}"] = {
+        **DATABASES["default"],
+        "HOST" if DATABASE_PROFILE == "postgres" else "NAME": location,
+        "OPTIONS": dict(DATABASES["default"]["OPTIONS"]),
+        ## Tests read the test database through them
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_REPLICAS = [f"replica{index}" for index in range(1, len(DB_REPLICAS) + 1)]
+
+## User shards (users.sharding): comma separated hosts (postgres) or database files (sqlite).
+## Users are spread over them by a hash of their email, as shard1, shard2...; the default
+## database keeps the user directory, staff users and everything else. After adding one,
+## migrate it (manage.py migrate --database shardN) and run manage.py rebalance_users.
+USER_SHARDS = config("USER_SHARDS", default="", cast=Csv())
+for index, location in enumerate(USER_SHARDS, 1):
+    DATABASES[f"shard{index}"] = {
+        **DATABASES["default"],
+        "HOST" if DATABASE_PROFILE == "postgres" else "NAME": location,
+        "OPTIONS": dict(DATABASES["default"]["OPTIONS"]),
+        "TEST": {"NAME": str(BASE_DIR / f"test-shard{index}.sqlite3")} if DATABASE_PROFILE == "sqlite" else {},
+    }
+DATABASE_SHARDS = [f"shard{index}" for index in range(1, len(USER_SHARDS) + 1)]
+## Seconds a write to a user waits while rebalance_users moves that user, before failing
+SHARD_MOVE_WAIT = config("SHARD_MOVE_WAIT", default=10, cast=float)
+DATABASE_ROUTERS = (
+    (["users.sharding.ShardRouter"] if DATABASE_SHARDS else [])
+    + (["users.routers.ReplicaRouter"] if DATABASE_REPLICAS else [])
+)
+## "round_robin" or "least_latency" (lowest moving average of query time)
+REPLICA_SELECTION = config("REPLICA_SELECTION", default="round_robin")
+## Seconds a client that wrote (signup, password change/reset...) keeps reading from the primary
+REPLICA_STICKY_SECONDS = config("REPLICA_STICKY_SECONDS", default=10, cast=int)
+
+## Applied to every new SQLite connection by users.db. WAL lets readers run alongside
+## the single writer and, with synchronous=NORMAL, only syncs at checkpoints.
+SQLITE_PRAGMAS = {
+    "journal_mode": config("SQLITE_JOURNAL_MODE", default="WAL"),
+    "synchronous": config("SQLITE_SYNCHRONOUS", default="NORMAL"),
+    ## Negative sizes are KiB: 20 MB of page cache per connection
+    "cache_size": -20000,
+    "temp_store": "MEMORY",
+    "mmap_size": 128 * 1024 * 1024,
+}
+
+
+## Password hashing pool (users.hashing)
+## "thread" (PBKDF2 releases the GIL), "process", or "inline" to hash on the request thread
+PASSWORD_HASHING_EXECUTOR = config("PASSWORD_HASHING_EXECUTOR", default="thread")
+## 0 means one worker per CPU core
+PASSWORD_HASHING_WORKERS = config("PASSWORD_HASHING_WORKERS", default=0, cast=int) or None
+## Hashes allowed to queue or run before requests get a 503, 0 means 8 per worker
+PASSWORD_HASHING_MAX_PENDING = config("PASSWORD_HASHING_MAX_PENDING", default=0, cast=int) or None
+
+## Password hashers (users.hashers), pick a tier per environment:
+## "standard" (PBKDF2-SHA256), "scrypt", "argon2" (needs argon2-cffi), or "fast" (MD5, manage.py test only)
+PASSWORD_HASHING_TIER = config("PASSWORD_HASHING_TIER", default="fast" if TESTING else "standard")
+PASSWORD_HASHING_TIERS = {
+    "standard": "users.hashers.PBKDF2PasswordHasher",
+    "scrypt": "users.hashers.ScryptPasswordHasher",
+    "argon2": "users.hashers.Argon2PasswordHasher",
+    "fast": "django.contrib.auth.hashers.MD5PasswordHasher",
+}
+if PASSWORD_HASHING_TIER not in PASSWORD_HASHING_TIERS:
+    raise ImproperlyConfigured(f"PASSWORD_HASHING_TIER must be one of {', '.join(PASSWORD_HASHING_TIERS)}")
+## Not even with DEBUG: settings.ini ships DEBUG = True, and MD5 hashes made then would outlive it
+if PASSWORD_HASHING_TIER == "fast" and not TESTING:
+    raise ImproperlyConfigured('PASSWORD_HASHING_TIER "fast" is for manage.py test only')
+## The tier's hasher makes new hashes, the others still verify old ones
+PASSWORD_HASHERS = [PASSWORD_HASHING_TIERS[PASSWORD_HASHING_TIER]] + [
+    hasher for tier, hasher in PASSWORD_HASHING_TIERS.items() if tier not in (PASSWORD_HASHING_TIER, "fast")
+] + [
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+]
+## Costs, `python manage.py calibrate_hashers` suggests values for this hardware.
+## Raising one upgrades each hash at the user's next login.
+PBKDF2_ITERATIONS = config("PBKDF2_ITERATIONS", default=720000, cast=int)
+SCRYPT_WORK_FACTOR = config("SCRYPT_WORK_FACTOR", default=2**14, cast=int)
+SCRYPT_BLOCK_SIZE = config("SCRYPT_BLOCK_SIZE", default=8, cast=int)
+SCRYPT_PARALLELISM = config("SCRYPT_PARALLELISM", default=1, cast=int)
+ARGON2_TIME_COST = config("ARGON2_TIME_COST", default=2, cast=int)
+## KiB
+ARGON2_MEMORY_COST = config("ARGON2_MEMORY_COST", default=102400, cast=int)
+ARGON2_PARALLELISM = config("ARGON2_PARALLELISM", default=8, cast=int)
+## Outdated hashes found at login: "background" (upgraded after the response), "inline" (before it) or "off"
+PASSWORD_REHASH = config("PASSWORD_REHASH", default="background")
+
+## Cache, sessions and the authenticated user cache
+## A shared backend (redis, memcached, database) is needed once there is more than one worker process
+CACHES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "BACKEND": config("CACHE_BACKEND", default="django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": config("CACHE_LOCATION", default="whatbytes"),
     }
 }
+## False for locmem, which every worker process keeps its own copy of
+CACHE_SHARED = CACHES["default"]["BACKEND"] != "django.core.cache.backends.locmem.LocMemCache"
+## "db" (one session read per request), "cached_db" (reads served by the cache) or "signed_cookies" (no server storage).
+## The caches below default to off on locmem: another worker would keep serving a logged out session or an old password_stamp
+SESSION_MODE = config("SESSION_MODE", default="cached_db" if CACHE_SHARED else "db")
+SESSION_ENGINE = {
+    "db": "django.contrib.sessions.backends.db",
+    "cached_db": "django.contrib.sessions.backends.cached_db",
+    "signed_cookies": "django.contrib.sessions.backends.signed_cookies",
+}[SESSION_MODE]
+## Seconds an authenticated user stays cached between requests (users.caching.user_cache_key), 0 turns that off
+AUTH_USER_CACHE_TTL = config("AUTH_USER_CACHE_TTL", default=300 if CACHE_SHARED else 0, cast=int)
+## Seconds a user's permission set stays cached across requests (users.permissions), 0 turns that off
+AUTH_PERMISSION_CACHE_TTL = config("AUTH_PERMISSION_CACHE_TTL", default=300 if CACHE_SHARED else 0, cast=int)
+
+## Login / forgot-password rate limiting (users.ratelimit)
+RATELIMIT_ENABLED = config("RATELIMIT_ENABLED", default=True, cast=bool)
+## "locmem" (per worker), "cache" (CACHES["default"]) or "redis"
+RATELIMIT_STORE = config("RATELIMIT_STORE", default="locmem")
+RATELIMIT_REDIS_URL = config("RATELIMIT_REDIS_URL", default="redis://127.0.0.1:6379/0")
+## Lockout doubles with every strike, from RATELIMIT_LOCKOUT_BASE up to RATELIMIT_LOCKOUT_MAX seconds
+RATELIMIT_LOCKOUT_BASE = config("RATELIMIT_LOCKOUT_BASE", default=30, cast=int)
+RATELIMIT_LOCKOUT_MAX = config("RATELIMIT_LOCKOUT_MAX", default=3600, cast=int)
+## Addresses or networks of the reverse proxies in front of the app, comma separated. Requests from them are
+## keyed by the right-most X-Forwarded-For hop that is not one of them; empty keys by REMOTE_ADDR alone
+RATELIMIT_TRUSTED_PROXIES = config("RATELIMIT_TRUSTED_PROXIES", default="", cast=Csv())
 
+## Buffered last_login and LoginAudit writes (users.activity)
+## Flushed after a request once the oldest entry is ACTIVITY_FLUSH_INTERVAL seconds old (0: after every request)
+ACTIVITY_FLUSH_INTERVAL = config("ACTIVITY_FLUSH_INTERVAL", default=5, cast=float)
+## ... or as soon as this many entries are pending
+ACTIVITY_BATCH_SIZE = config("ACTIVITY_BATCH_SIZE", default=500, cast=int)
+## Audit rows kept while the database is unreachable, the oldest are dropped beyond that
+ACTIVITY_MAX_PENDING = config("ACTIVITY_MAX_PENDING", default=10000, cast=int)
+
+## JSON API tokens (users.api_tokens): stateless access tokens, rotating refresh tokens, in seconds
+API_ACCESS_TOKEN_TTL = config("API_ACCESS_TOKEN_TTL", default=300, cast=int)
+API_REFRESH_TOKEN_TTL = config("API_REFRESH_TOKEN_TTL", default=14 * 24 * 3600, cast=int)
+
+## Incremental cleanup of expired sessions, old login audits and delivered mail (users.cleanup)
+## Run it with `python manage.py collect_garbage` (cron or --loop), or in process with CLEANUP_IN_PROCESS
+CLEANUP_IN_PROCESS = config("CLEANUP_IN_PROCESS", default=False, cast=bool)
+CLEANUP_INTERVAL = config("CLEANUP_INTERVAL", default=300, cast=float)
+## Rows per DELETE, each its own short transaction, with CLEANUP_BATCH_PAUSE seconds between batches
+CLEANUP_BATCH_SIZE = config("CLEANUP_BATCH_SIZE", default=500, cast=int)
+CLEANUP_BATCH_PAUSE = config("CLEANUP_BATCH_PAUSE", default=0.01, cast=float)
+## Seconds a run may take, the rest waits for the next run
+CLEANUP_TIME_BUDGET = config("CLEANUP_TIME_BUDGET", default=2.0, cast=float)
+## 0 keeps them forever
+LOGIN_AUDIT_RETENTION_DAYS = config("LOGIN_AUDIT_RETENTION_DAYS", default=90, cast=int)
+## Sent and dead mail, which holds password reset links
+MAIL_RETENTION_DAYS = config("MAIL_RETENTION_DAYS", default=7, cast=int)
 
-# Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -100,7 +338,8 @@ AUTH_PASSWORD_VALIDATORS = [
         "NAME": "django.contrib.auth.password_validation.MinimumLengthValidator",
     },
     {
-        "NAME": "django.contrib.auth.password_validation.CommonPasswordValidator",
+        ## Breached password filter, or Django's common password list until one is built
+        "NAME": "users.password_filter.BreachedPasswordValidator",
     },
     {
         "NAME": "django.contrib.auth.password_validation.NumericPasswordValidator",
@@ -108,6 +347,10 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+## Bloom filter of breached passwords (users.password_filter), memory-mapped and shared by all workers.
+## Build it with `python manage.py build_password_filter <list of passwords or SHA-1 hashes>`
+PASSWORD_FILTER_PATH = config("PASSWORD_FILTER_PATH", default=str(BASE_DIR / "data" / "breached-passwords.bloom"))
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
 
@@ -124,6 +367,33 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 
 STATIC_URL = "static/"
+STATIC_ROOT = config("STATIC_ROOT", default=str(BASE_DIR / "staticfiles"))
+
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    ## collectstatic writes content-hashed names plus .gz/.br variants (brotli is optional)
+    "staticfiles": {
+        "BACKEND": "users.storage.CompressedManifestStaticFilesStorage",
+    },
+}
+
+## Serve STATIC_ROOT from the app (users.middleware.StaticFilesMiddleware) once collectstatic has run
+STATIC_SERVE = config("STATIC_SERVE", default=True, cast=bool)
+## Cache lifetime of static files without a content hash in their name
+STATIC_MAX_AGE = config("STATIC_MAX_AGE", default=60, cast=int)
+
+## Compress responses with brotli or gzip (users.middleware.CompressionMiddleware)
+COMPRESSION_ENABLED = config("COMPRESSION_ENABLED", default=True, cast=bool)
+## Smaller bodies are sent as they are: the headers would eat the saving
+COMPRESSION_MIN_SIZE = config("COMPRESSION_MIN_SIZE", default=512, cast=int)
+## 0-11; above 5 costs much more CPU for a few percent
+COMPRESSION_BROTLI_QUALITY = config("COMPRESSION_BROTLI_QUALITY", default=4, cast=int)
+
+## Load URLs, templates, password validators and hashers and connect to the databases
+## when wsgi.py/asgi.py is imported instead of on the first request (users/warmup.py)
+WARM_UP = config("WARM_UP", default=True, cast=bool)
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
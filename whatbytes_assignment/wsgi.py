@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "whatbytes_assignment.settings")
 
 application = get_wsgi_application()
+
+## Do the first request's setup now, before a preloading server forks (users/warmup.py)
+if settings.WARM_UP:
+    from users.warmup import warm_up
+
+    warm_up()